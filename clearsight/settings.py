@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -75,23 +76,225 @@ WSGI_APPLICATION = "clearsight.wsgi.application"
 # Channels configuration
 ASGI_APPLICATION = 'clearsight.asgi.application'
 
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
-        'CONFIG': {
-            'capacity': 1500,  # Maximum number of messages that can be stored
+# CLEARSIGHT_CHANNEL_LAYER selects the channel layer: 'memory' reaches a single process only,
+# 'sqlite' is shared by every worker on this host (core/layers.py, needed for `manage.py runworkers`)
+CHANNEL_LAYER = os.environ.get('CLEARSIGHT_CHANNEL_LAYER', 'memory')
+
+if CHANNEL_LAYER == 'sqlite':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'core.layers.SQLiteChannelLayer',
+            'CONFIG': {
+                'path': os.environ.get('CLEARSIGHT_CHANNEL_DB', BASE_DIR / 'channels.sqlite3'),
+                'capacity': 1500,  # Messages queued per channel
+            },
         },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+            'CONFIG': {
+                'capacity': 1500,  # Maximum number of messages that can be stored
+            },
+        },
+    }
+
+# Telemetry ingestion: events are buffered per connection and written in batches
+TELEMETRY_BUFFER = {
+    'MAX_EVENTS': 100,  # Flush once this many events are pending
+    'MAX_AGE': 1.0,  # Flush pending events after this many seconds
+    'ACK_MODE': 'event',  # 'event' acks every event, 'cumulative' acks "recorded up to seq N"
+}
+
+# Database work of the WebSocket consumers runs on a dedicated writer pool (see core/writer.py) instead
+# of the single shared sync thread; queue wait and depth are exported on /metrics.
+TELEMETRY_DB_WRITER = {
+    'CONCURRENCY': 4,  # Writer threads per process on PostgreSQL; SQLite always uses one
+    'QUEUE_SIZE': 1000,  # Queued jobs per process before consumers wait for room
+}
+
+# Admission control for telemetry ingest (see core/admission.py): size limits, per-connection rate
+# limits and a cap on open WebSocket sessions, with slow_down hints to clients before anything is refused.
+TELEMETRY_ADMISSION = {
+    'MAX_FRAME_BYTES': 2 * 1024 * 1024,  # Larger WebSocket messages close the connection (1009)
+    'MAX_BODY_BYTES': 2 * 1024 * 1024,  # Larger HTTP bodies get a 413; keep within DATA_UPLOAD_MAX_MEMORY_SIZE
+    'RATE': 100,  # Messages per second per WebSocket connection or HTTP session
+    'BURST': 2.0,  # Seconds of rate a connection can save up
+    'MAX_SESSIONS': 1000,  # Open telemetry WebSocket connections per process; more are closed with 1013
+    'SLOW_DOWN_AT': 0.5,  # Clients are asked to back off at half their bucket or half the writer queue
+    'CLIENT_ADDRESS_HEADER': None,  # Set to 'X-Forwarded-For' behind a reverse proxy, which must append to it
+}
+
+# Batch envelopes posted to /api/telemetry/ by telemetry.js
+TELEMETRY_BATCH = {
+    'MAX_EVENTS': 500,  # Largest batch accepted in one request
+}
+
+# Replay seek data precomputed per session (see core/replay.py)
+TELEMETRY_REPLAY_INDEX = {
+    'SEEK_INTERVAL': 1000,  # Events between seek index entries
+    'KEYFRAME_INTERVAL_MS': 10000,  # Session time between keyframes of cursor, scroll and input state
+    'ACTIVE_REBUILD_INTERVAL': 10,  # Seconds an active session's index is reused before a rebuild
+}
+
+# Where recorded events are written (see core/backends.py). The ORM backend feeds replay and
+# the session views; add 'core.backends.OpenSearchBackend' to also index events for analytics.
+TELEMETRY_STORAGE = {
+    'BACKENDS': ['core.backends.ORMBackend'],
+    'ANALYTICS_BACKEND': 'core.backends.ORMBackend',  # Serves /api/analytics/events/
+}
+
+# Bulk indexing into OpenSearch, used when OpenSearchBackend is configured above
+TELEMETRY_OPENSEARCH = {
+    'HOSTS': ['http://localhost:9200'],
+    'INDEX_PREFIX': 'clearsight',  # Daily indices named clearsight-events-YYYY.MM.DD
+    'BULK_SIZE': 500,  # Events per _bulk request
+    'FLUSH_INTERVAL': 1.0,  # Seconds before a partial bulk is sent
+    'MAX_RETRIES': 5,  # Attempts, with exponential backoff, before a bulk returns to the spool
+    'SPOOL_MAX_EVENTS': 100_000,  # Events kept in memory during an outage
+    'SPOOL_DIR': None,  # Directory for overflow and shutdown spool files
+}
+
+# Write-ahead spool: when enabled, flushed events are appended and fsynced to local segment files
+# and acked without waiting on the database; `python manage.py drain_spool` writes them through
+TELEMETRY_SPOOL = {
+    'ENABLED': False,
+    'DIR': BASE_DIR / 'spool',
+    'SEGMENT_BYTES': 16 * 1024 * 1024,  # Segment size before rotating to a new file
+    'FSYNC_DELAY': 0.002,  # Seconds an fsync waits so concurrent appends share it
+}
+
+# Server-side reduction of pointer, scroll and resize streams before storage (see core/sampling.py).
+# The matching client policy is sent to telemetry.js on session start.
+TELEMETRY_SAMPLING = {
+    'ENABLED': True,
+    'PATH_TOLERANCE': 2.0,  # Pixels a simplified mouse path may deviate from the recorded one
+    'MERGE_TYPES': ('scroll', 'resize'),  # Consecutive runs thinned to one event per MERGE_INTERVAL_MS
+    'MERGE_INTERVAL_MS': 100,
+    # Events per second of mousemove, scroll and resize; '*' caps the three together per session.
+    # Other event types are never dropped.
+    'RATE_LIMITS': {'mousemove': 20, 'scroll': 10, 'resize': 4, '*': 60},
+    'BURST': 2.0,  # Seconds of rate a session can save up for bursts
+}
+
+# Session retention (see core/retention.py), applied by `python manage.py apply_retention` from cron.
+# The first policy whose MIN_EVENTS a session reaches sets how long after its last activity it is
+# archived to DIR and purged from the database; opening its replay restores it.
+TELEMETRY_RETENTION = {
+    'DIR': BASE_DIR / 'archive',
+    'POLICIES': [
+        {'MIN_EVENTS': 100_000, 'ARCHIVE_AFTER_DAYS': 7},
+        {'ARCHIVE_AFTER_DAYS': 30},
+    ],
+    'RESTORED_TTL_DAYS': 1,  # Restored sessions are purged again after this long
+    'DELETE_AFTER_DAYS': None,  # Delete archived sessions and their files after this long; None keeps them
+    'DELETE_BATCH_SIZE': 10000,  # Rows per DELETE when purging
+    'RESTORE_IN_BACKGROUND': True,  # Restore opened archived sessions on a thread of their own, not the request's
+}
+
+# Replay bundles (see core/bundles.py): when a session ends, its snapshot, seek index and events are
+# written to one precompressed file under DIR and served with long-lived cache headers. 'br' needs the
+# optional brotli package; sessions over MAX_EVENTS replay window by window instead.
+TELEMETRY_REPLAY_BUNDLES = {
+    'DIR': BASE_DIR / 'bundles',
+    'ENCODING': 'gzip',
+    'MAX_EVENTS': 200_000,
+}
+
+# Prometheus-style ingest metrics on /metrics (see core/metrics.py). With several workers, point
+# MULTIPROCESS_DIR at a directory they share so /metrics reports totals across all of them.
+TELEMETRY_METRICS = {
+    'ENABLED': True,
+    'MULTIPROCESS_DIR': os.environ.get('CLEARSIGHT_METRICS_DIR'),
+    'FLUSH_INTERVAL': 5.0,  # Seconds between each worker's snapshots in multiprocess mode
+}
+
+# Dashboard counters (see core/stats.py). Each counter is spread over SHARDS rows so concurrent
+# ingest transactions rarely wait on the same one.
+TELEMETRY_STATS = {
+    'SHARDS': 16,
+}
+
+# Per-session summaries (see core/summaries.py). `python manage.py sweep_sessions --interval 60` closes
+# active sessions that have had no events for IDLE_TIMEOUT seconds, e.g. tabs closed without a disconnect.
+TELEMETRY_SUMMARY = {
+    'IDLE_TIMEOUT': 1800,
+    'ERROR_TYPES': ('error',),  # Event types counted in a summary's error_count
+    'FINALIZE_IN_BACKGROUND': True,  # Build ended sessions' replay index and bundle on a thread of their own
+}
+
+# Session search on /api/search/sessions/ (see core/search.py). Set BACKEND to
+# 'core.search.OpenSearchSearchBackend' to keep the index in the TELEMETRY_OPENSEARCH cluster;
+# `python manage.py rebuild_search_index` (re)builds it from the tables.
+TELEMETRY_SEARCH = {
+    'BACKEND': 'core.search.DatabaseSearchBackend',
+    'EVENT_FIELDS': {  # Event type -> data keys indexed under that type; input values never are
+        'error': ['message', 'source'],
+        'input': ['name'],
     },
+    'PAGE_SIZE': 25,
+}
+
+# Page analytics on /api/analytics/pages/ (see core/analytics.py). Aggregates are stored per page and
+# WINDOW_SECONDS window once the window has been over for SETTLE_SECONDS; run
+# `python manage.py update_analytics` from cron so requests find them precomputed.
+TELEMETRY_ANALYTICS = {
+    'WINDOW_SECONDS': 3600,
+    'SETTLE_SECONDS': 600,  # Events arriving later than this after their window are not counted
+    'HEATMAP_BINS': 64,  # Heatmap cells per side, over the session's window size
+    'RAGE_CLICKS': 3,  # Clicks within RAGE_WINDOW_MS and RAGE_RADIUS pixels that make a rage click
+    'RAGE_WINDOW_MS': 1000,
+    'RAGE_RADIUS': 30,
+    'DEAD_CLICK_MS': 1000,  # A click with no REACTION_TYPES event this soon after is dead
+    'REACTION_TYPES': ['scroll', 'input', 'keypress', 'visibility', 'resize'],
+}
+
+# Live session viewers (ws/sessions/<id>/live/, see core/live.py)
+TELEMETRY_LIVE = {
+    'FPS': 20,  # Default frames per second per viewer; pointer and scroll events are coalesced per frame
+    'MAX_FPS': 60,  # Highest rate a viewer may request with ?fps=
+    'MAX_PENDING': 500,  # Clicks, keys and inputs buffered per viewer before the oldest are dropped
+    'MAX_UNACKED': 3,  # Frames in flight before a slow viewer stops receiving new ones
 }
 
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
-DATABASES = {
-    "default": {
-        "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+# CLEARSIGHT_DB selects the profile: 'sqlite' (default) or 'postgres'. On PostgreSQL the
+# event table is partitioned by month; run `manage.py create_event_partitions` from cron.
+DATABASE_PROFILE = os.environ.get('CLEARSIGHT_DB', 'sqlite')
+
+if DATABASE_PROFILE == 'postgres':
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.postgresql",
+            "NAME": os.environ.get('CLEARSIGHT_DB_NAME', 'clearsight'),
+            "USER": os.environ.get('CLEARSIGHT_DB_USER', 'clearsight'),
+            "PASSWORD": os.environ.get('CLEARSIGHT_DB_PASSWORD', ''),
+            "HOST": os.environ.get('CLEARSIGHT_DB_HOST', 'localhost'),
+            "PORT": os.environ.get('CLEARSIGHT_DB_PORT', '5432'),
+            "CONN_MAX_AGE": 60,
+            "CONN_HEALTH_CHECKS": True,
+        }
     }
+else:
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": os.environ.get('CLEARSIGHT_DB_NAME', BASE_DIR / "db.sqlite3"),
+            # An in-memory test database is shared-cache, which fails concurrent
+            # writers at once instead of waiting; tests with threads need a file
+            "TEST": {"NAME": BASE_DIR / "test_db.sqlite3"},
+        }
+    }
+
+# PRAGMAs applied to every SQLite connection (see core/database.py)
+TELEMETRY_SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',  # Readers don't block the ingest writer
+    'synchronous': 'normal',  # Safe with WAL; skips an fsync per commit
+    'busy_timeout': 5000,  # Milliseconds to wait for a lock instead of failing
+    'mmap_size': 256 * 1024 * 1024,
 }
 
 
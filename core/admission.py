@@ -0,0 +1,213 @@
+"""
+Admission control and backpressure for telemetry ingest.
+
+A few misbehaving pages shouldn't be able to starve everyone else's ingest
+or run a worker out of memory, so before a message is parsed:
+
+- WebSocket frames over MAX_FRAME_BYTES close the connection with 1009
+  (message too big), and HTTP bodies over MAX_BODY_BYTES get a 413, judged
+  by Content-Length before the body is read;
+- every telemetry WebSocket connection, and every session posting over
+  HTTP, has a token bucket of RATE messages a second with BURST seconds of
+  headroom. HTTP requests are keyed by their ``session_id`` query parameter
+  if that session exists, else by client address: the last entry of
+  CLIENT_ADDRESS_HEADER when set (behind a trusted proxy), else REMOTE_ADDR. A frame beyond it is dropped unacked and answered
+  with ``slow_down``; a request beyond it gets a 429 with ``Retry-After``;
+- at most MAX_SESSIONS telemetry WebSocket connections are open per
+  process; further ones are closed with 1013 (try again later).
+
+Clients are asked to back off before it comes to that: once a bucket is
+below SLOW_DOWN_AT of its capacity, or the database writer queue
+(core/writer.py) is SLOW_DOWN_AT full, WebSocket clients get a
+``{"type": "slow_down", "delay_ms": n}`` message (at most once per
+delay) and HTTP responses an ``X-Slow-Down: n`` header. telemetry.js then
+holds its next flush for ``delay_ms`` and stretches its flush interval
+until the hints stop.
+
+Like the samplers (core/sampling.py), buckets and session slots live in
+the receiving process, so with several workers every limit is per worker.
+"""
+import logging
+import math
+import threading
+from collections import OrderedDict
+from functools import wraps
+from uuid import UUID
+
+from django.conf import settings
+from django.core.exceptions import RequestDataTooBig
+from django.http import JsonResponse
+from django.utils import timezone
+
+from . import metrics
+from .models import Session
+from .sampling import TokenBucket
+from .writer import queue_load
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_DEFAULTS = {
+    'ENABLED': True,
+    'MAX_FRAME_BYTES': 2 * 1024 * 1024,  # Largest WebSocket message
+    'MAX_BODY_BYTES': 2 * 1024 * 1024,  # Largest HTTP body; Django's DATA_UPLOAD_MAX_MEMORY_SIZE applies too
+    'RATE': 100,  # Messages per second per connection or HTTP session
+    'BURST': 2.0,  # Seconds of rate a bucket can save up
+    'MAX_SESSIONS': 1000,  # Open telemetry WebSocket connections per process
+    'SLOW_DOWN_AT': 0.5,  # Bucket left, or writer queue used, at which clients are asked to back off
+    'SLOW_DOWN_MS': 1000,  # Delay asked of clients that should back off
+    'MAX_CLIENTS': 10000,  # HTTP buckets kept, least recently used evicted
+    'CLIENT_ADDRESS_HEADER': None,  # e.g. 'X-Forwarded-For' behind a proxy that appends the client address
+}
+
+_clients = OrderedDict()
+_clients_lock = threading.Lock()
+_open_sessions = 0
+_sessions_lock = threading.Lock()
+
+
+def get_admission_settings():
+    return {**ADMISSION_DEFAULTS, **getattr(settings, 'TELEMETRY_ADMISSION', {})}
+
+
+class Admission:
+    """One connection's or HTTP session's message rate limit (see the module docstring)."""
+
+    def __init__(self, config=None):
+        config = config or get_admission_settings()
+        self.bucket = TokenBucket(config['RATE'], config['BURST']) if config['RATE'] else None
+        self.slow_down_at = config['SLOW_DOWN_AT']
+        self.slow_down_ms = config['SLOW_DOWN_MS']
+        self._lock = threading.Lock()
+
+    def admit(self):
+        """Take one message's token. Returns ``(admitted, delay_ms)``, ``delay_ms`` None unless slowing down."""
+        pressured = queue_load() >= self.slow_down_at
+        if self.bucket is None:
+            return True, self.slow_down_ms if pressured else None
+        with self._lock:
+            if not self.bucket.refill(timezone.now()):
+                # Time until the next token, but no sooner than an ordinary slow down
+                wait = math.ceil((1 - self.bucket.tokens) / self.bucket.rate * 1000)
+                return False, max(wait, self.slow_down_ms)
+            self.bucket.tokens -= 1
+            if pressured or self.bucket.tokens < self.bucket.capacity * self.slow_down_at:
+                return True, self.slow_down_ms
+        return True, None
+
+
+def get_client_admission(key):
+    """Return the shared Admission for an HTTP client, or None when admission control is off."""
+    config = get_admission_settings()
+    if not config['ENABLED']:
+        return None
+    key = str(key)
+    with _clients_lock:
+        admission = _clients.get(key)
+        if admission is None:
+            admission = _clients[key] = Admission(config)
+            while len(_clients) > config['MAX_CLIENTS']:
+                _clients.popitem(last=False)
+        else:
+            _clients.move_to_end(key)
+        return admission
+
+
+def client_address(request, config):
+    header = config['CLIENT_ADDRESS_HEADER']
+    if header:
+        # The proxy appends the address it saw; entries before it are whatever the client sent
+        address = request.headers.get(header, '').split(',')[-1].strip()
+        if address:
+            return address
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def session_exists(session_id):
+    try:
+        return Session.objects.filter(pk=UUID(session_id)).exists()
+    except ValueError:
+        return False
+
+
+def client_key(request, config):
+    """The HTTP bucket of a request: its session's when that exists, else its client address's."""
+    session_id = request.GET.get('session_id')
+    if session_id:
+        key = f'session:{session_id}'
+        with _clients_lock:
+            known = key in _clients
+        # Made-up ids share their client's bucket rather than each getting a fresh one
+        if known or session_exists(session_id):
+            return key
+    return f'addr:{client_address(request, config)}'
+
+
+def body_size(request):
+    """The request body's declared size in bytes, without reading it."""
+    try:
+        return int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return 0
+
+
+def body_too_large(size, limit):
+    metrics.ADMISSION_REJECTED.inc(transport='http', reason='too_large')
+    logger.warning(f'Rejected telemetry request: {size} byte body exceeds {limit} bytes')
+    # The body is not read, let alone echoed back
+    return JsonResponse({
+        'status': 'error',
+        'message': f'Request body of {size} bytes exceeds the {limit} byte limit'
+    }, status=413)
+
+
+def admission_control(view):
+    """Apply the HTTP body size and rate limits to an ingest view."""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        config = get_admission_settings()
+        if not config['ENABLED']:
+            return view(request, *args, **kwargs)
+        size = body_size(request)
+        if size > config['MAX_BODY_BYTES']:
+            return body_too_large(size, config['MAX_BODY_BYTES'])
+
+        admitted, delay = get_client_admission(client_key(request, config)).admit()
+        if not admitted:
+            metrics.ADMISSION_REJECTED.inc(transport='http', reason='rate')
+            metrics.SLOW_DOWN_SENT.inc(transport='http')
+            response = JsonResponse({
+                'status': 'slow_down',
+                'message': 'Rate limit exceeded',
+                'delay_ms': delay
+            }, status=429)
+            response['Retry-After'] = str(math.ceil(delay / 1000))
+            response['X-Slow-Down'] = str(delay)
+            return response
+
+        try:
+            response = view(request, *args, **kwargs)
+        except RequestDataTooBig:
+            # Over Django's DATA_UPLOAD_MAX_MEMORY_SIZE
+            return body_too_large(size, settings.DATA_UPLOAD_MAX_MEMORY_SIZE)
+        if delay is not None:
+            metrics.SLOW_DOWN_SENT.inc(transport='http')
+            response['X-Slow-Down'] = str(delay)
+        return response
+    return wrapper
+
+
+def acquire_session_slot(config=None):
+    """Count a new telemetry connection. Returns False when the process has no slot left."""
+    global _open_sessions
+    config = config or get_admission_settings()
+    with _sessions_lock:
+        if config['ENABLED'] and config['MAX_SESSIONS'] is not None and _open_sessions >= config['MAX_SESSIONS']:
+            return False
+        _open_sessions += 1
+        return True
+
+
+def release_session_slot():
+    global _open_sessions
+    with _sessions_lock:
+        _open_sessions -= 1
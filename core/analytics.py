@@ -0,0 +1,463 @@
+"""
+Page analytics computed over event arrays with NumPy.
+
+Events are aggregated per page (``Session.page_url``) and per fixed time
+window of WINDOW_SECONDS. For each window the click, pointer, scroll and
+reaction events are loaded into flat arrays -- raw rows through JSON key
+lookups in SQL, compacted chunks straight from their column buffers -- and
+everything below is computed with vectorized array operations:
+
+- click and move heatmaps: 2D histograms of positions normalized by each
+  session's window size, HEATMAP_BINS square;
+- rage clicks: RAGE_CLICKS or more clicks of one session within
+  RAGE_WINDOW_MS and RAGE_RADIUS pixels, counted once per burst;
+- dead clicks: clicks not followed by any REACTION_TYPES event of the same
+  session within DEAD_CLICK_MS;
+- scroll depth: per session, deepest scroll offset plus window height,
+  histogrammed in SCROLL_DEPTH_BIN pixel bins;
+- time on page: per session, first to last event.
+
+A window is computed once, after it has been over for SETTLE_SECONDS, and
+stored as PageAnalytics rows: one per page plus a ``page_url=''`` row for
+all pages, which also marks the window as done. Queries add up the stored
+windows and compute the still-open ones on the fly, so cost grows with the
+number of windows asked for rather than the number of events. Sessions that
+span windows count towards each window's session metrics.
+"""
+import zlib
+from datetime import datetime, timedelta, timezone as dt_timezone
+from itertools import islice
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from .chunks import COUNT, HAS_XY
+from .models import Event, EventChunk, PageAnalytics, Session
+
+ANALYTICS_DEFAULTS = {
+    'WINDOW_SECONDS': 3600,  # Granularity of the stored aggregates
+    'SETTLE_SECONDS': 600,  # A window is stored once it has been over this long
+    'HEATMAP_BINS': 64,
+    'RAGE_CLICKS': 3,
+    'RAGE_WINDOW_MS': 1000,
+    'RAGE_RADIUS': 30,  # Pixels
+    'DEAD_CLICK_MS': 1000,
+    'REACTION_TYPES': ['scroll', 'input', 'keypress', 'visibility', 'resize'],
+    'SCROLL_DEPTH_BIN': 500,  # Pixels
+    'SCROLL_DEPTH_BINS': 40,  # The last bin collects everything deeper
+    'TIME_ON_PAGE_BINS': [10, 30, 60, 180, 600, 1800],  # Seconds; bin edges
+}
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+BATCH_SIZE = 50_000
+SESSION_BATCH_SIZE = 10_000
+ALL_PAGES = ''
+
+
+def get_analytics_settings():
+    return {**ANALYTICS_DEFAULTS, **getattr(settings, 'TELEMETRY_ANALYTICS', {})}
+
+
+def _micros(value):
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def _floats(values):
+    try:
+        return np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        # Hand-crafted payloads can carry strings or objects where coordinates belong
+        return np.array([value if isinstance(value, (int, float)) else None for value in values], dtype=np.float64)
+
+
+def window_start(value, seconds):
+    return EPOCH + timedelta(seconds=(_micros(value) // 1_000_000) // seconds * seconds)
+
+
+class EventArrays:
+    """Events of one time range as parallel arrays, with sessions and types as small integers."""
+
+    def __init__(self):
+        self.sessions = {}
+        self.types = {}
+        self._parts = []
+
+    def session_index(self, session_id):
+        return self.sessions.setdefault(session_id, len(self.sessions))
+
+    def type_index(self, event_type):
+        return self.types.setdefault(event_type, len(self.types))
+
+    def add(self, sessions, types, times, xs, ys):
+        self._parts.append((sessions, types, times, xs, ys))
+
+    def arrays(self):
+        if not self._parts:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty, np.zeros(0), np.zeros(0)
+        columns = zip(*self._parts)
+        sessions, types, times, xs, ys = (np.concatenate(column) for column in columns)
+        # Grouped by session, then in time order
+        order = np.lexsort((times, sessions))
+        return sessions[order], types[order], times[order], xs[order], ys[order]
+
+
+def load_events(start, end, types):
+    """Load the events of ``types`` in ``[start, end)``, raw and compacted, into EventArrays."""
+    events = EventArrays()
+    start_us, end_us = _micros(start), _micros(end)
+
+    rows = (
+        Event.objects.filter(timestamp__gte=start, timestamp__lt=end, type__in=types)
+        .order_by()
+        .values_list('session_id', 'type', 'timestamp', 'data__x', 'data__y')
+        .iterator(chunk_size=BATCH_SIZE)
+    )
+    while batch := list(islice(rows, BATCH_SIZE)):
+        session_ids, event_types, timestamps, xs, ys = zip(*batch)
+        events.add(
+            np.array([events.session_index(session_id) for session_id in session_ids], dtype=np.int64),
+            np.array([events.type_index(event_type) for event_type in event_types], dtype=np.int64),
+            np.array([_micros(timestamp) for timestamp in timestamps], dtype=np.int64),
+            _floats(xs),
+            _floats(ys),
+        )
+
+    wanted = set(types)
+    chunks = EventChunk.objects.filter(end_time__gte=start, start_time__lt=end).iterator(chunk_size=100)
+    for chunk in chunks:
+        if not wanted.intersection(chunk.types):
+            continue
+        codes, times, xs, ys = chunk_arrays(chunk)
+        type_map = np.array([events.type_index(name) if name in wanted else -1 for name in chunk.types], dtype=np.int64)
+        mapped = type_map[codes]
+        keep = (mapped >= 0) & (times >= start_us) & (times < end_us)
+        if not keep.any():
+            continue
+        count = int(keep.sum())
+        events.add(
+            np.full(count, events.session_index(chunk.session_id), dtype=np.int64),
+            mapped[keep], times[keep], xs[keep], ys[keep],
+        )
+    return events
+
+
+def chunk_arrays(chunk):
+    """Decode a chunk's type codes, timestamps (µs) and coordinates without building event dicts."""
+    blob = zlib.decompress(chunk.columns)
+    count, = COUNT.unpack_from(blob)
+    offset = COUNT.size
+    columns = []
+    # Same layout as core/chunks.py, always little-endian on disk
+    for dtype in ('<u2', '<i8', '<i4', '<i4', 'u1'):
+        column = np.frombuffer(blob, dtype=dtype, count=count, offset=offset)
+        columns.append(column)
+        offset += column.nbytes
+    codes, deltas, xs, ys, flags = columns
+    times = _micros(chunk.start_time) + np.cumsum(deltas)
+    has_xy = (flags & HAS_XY) != 0
+    return (
+        codes.astype(np.int64),
+        times,
+        np.where(has_xy, xs, np.nan),
+        np.where(has_xy, ys, np.nan),
+    )
+
+
+def session_info(session_ids):
+    """Return ``{session_id: (page_url, window_width, window_height)}``."""
+    info = {}
+    session_ids = list(session_ids)
+    for offset in range(0, len(session_ids), SESSION_BATCH_SIZE):
+        rows = Session.objects.filter(id__in=session_ids[offset:offset + SESSION_BATCH_SIZE]).values_list(
+            'id', 'page_url', 'window_width', 'window_height'
+        )
+        info.update((row[0], row[1:]) for row in rows)
+    return info
+
+
+def empty_aggregate(config):
+    bins = config['HEATMAP_BINS']
+    return {
+        'events': 0,
+        'sessions': 0,
+        'clicks': 0,
+        'moves': 0,
+        'rage_clicks': 0,
+        'dead_clicks': 0,
+        'time_on_page': 0.0,
+        'click_heatmap': np.zeros((bins, bins), dtype=np.int64),
+        'move_heatmap': np.zeros((bins, bins), dtype=np.int64),
+        'scroll_depth': np.zeros(config['SCROLL_DEPTH_BINS'], dtype=np.int64),
+        'time_on_page_histogram': np.zeros(len(config['TIME_ON_PAGE_BINS']) + 1, dtype=np.int64),
+    }
+
+
+def merge_aggregates(total, other):
+    for key, value in other.items():
+        total[key] = total[key] + value
+    return total
+
+
+def compute_window(start, end, config=None):
+    """Compute the aggregates of every page for events in ``[start, end)``. Returns ``{page_url: aggregate}``."""
+    config = config or get_analytics_settings()
+    dead_us = config['DEAD_CLICK_MS'] * 1000
+    reaction_types = list(config['REACTION_TYPES'])
+    types = list(dict.fromkeys(['click', 'mousemove', 'scroll', *reaction_types]))
+    # Clicks near the end of the window need the reactions just after it
+    events = load_events(start, end + timedelta(microseconds=dead_us), types)
+    s, ty, t, x, y = events.arrays()
+    if not len(s):
+        return {}
+
+    info = session_info(events.sessions)
+    session_ids = list(events.sessions)
+    pages = sorted({info[session_id][0] for session_id in session_ids if session_id in info})
+    page_index = {page: i for i, page in enumerate(pages)}
+    # Events of sessions deleted since they were loaded map to page -1 and are dropped below
+    session_page = np.array([page_index[info[sid][0]] if sid in info else -1 for sid in session_ids], dtype=np.int64)
+    session_w = np.array([info[sid][1] if sid in info else 0 for sid in session_ids], dtype=np.float64)
+    session_h = np.array([info[sid][2] if sid in info else 0 for sid in session_ids], dtype=np.float64)
+
+    type_id = {name: events.types.get(name, -1) for name in types}
+    page = session_page[s]
+    in_window = (t < _micros(end)) & (page >= 0)
+    P, B = len(pages), config['HEATMAP_BINS']
+
+    def per_page(mask, weights=None):
+        return np.bincount(page[mask], weights=weights, minlength=P)
+
+    def heatmap(mask):
+        width, height = session_w[s[mask]], session_h[s[mask]]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            nx, ny = x[mask] / width, y[mask] / height
+        ok = (width > 0) & (height > 0) & (nx >= 0) & (nx < 1) & (ny >= 0) & (ny < 1)
+        bx, by = (nx[ok] * B).astype(np.int64), (ny[ok] * B).astype(np.int64)
+        return np.bincount(page[mask][ok] * B * B + by * B + bx, minlength=P * B * B).reshape(P, B, B)
+
+    clicks = in_window & (ty == type_id['click'])
+    moves = in_window & (ty == type_id['mousemove'])
+
+    # Rage clicks: click i completes a burst if click i-k, k = RAGE_CLICKS - 1, is the same
+    # session, close enough in time and space; consecutive completions are one burst
+    c = np.flatnonzero(clicks)
+    cs, ct, cx, cy = s[c], t[c], x[c], y[c]
+    k = config['RAGE_CLICKS'] - 1
+    completes = np.zeros(len(c), dtype=bool)
+    if k > 0 and len(c) > k:
+        with np.errstate(invalid='ignore'):
+            completes[k:] = (
+                (cs[k:] == cs[:-k])
+                & (ct[k:] - ct[:-k] <= config['RAGE_WINDOW_MS'] * 1000)
+                & (np.hypot(cx[k:] - cx[:-k], cy[k:] - cy[:-k]) <= config['RAGE_RADIUS'])
+            )
+    burst_starts = completes & ~np.concatenate(([False], completes[:-1]))
+
+    # Dead clicks: look up the first reaction after each click on a (session, time) key;
+    # the key spacing between sessions is wider than any gap that could count as a reaction
+    reactions = np.isin(ty, [type_id[name] for name in reaction_types if type_id[name] >= 0])
+    base = int(t.min())
+    span = int(t.max()) - base + dead_us + 1
+    reaction_keys = s[reactions] * span + (t[reactions] - base)
+    click_keys = cs * span + (ct - base)
+    position = np.searchsorted(reaction_keys, click_keys, side='right')
+    following = reaction_keys[np.minimum(position, max(len(reaction_keys) - 1, 0))] if len(reaction_keys) else click_keys
+    reacted = (position < len(reaction_keys)) & (following - click_keys <= dead_us)
+    dead = ~reacted
+
+    # Per session within the window: first and last event, deepest scroll
+    S = len(session_ids)
+    present = np.zeros(S, dtype=bool)
+    present[s[in_window]] = True
+    first = np.full(S, np.iinfo(np.int64).max, dtype=np.int64)
+    last = np.zeros(S, dtype=np.int64)
+    np.minimum.at(first, s[in_window], t[in_window])
+    np.maximum.at(last, s[in_window], t[in_window])
+    deepest = np.zeros(S)
+    scrolls = in_window & (ty == type_id['scroll']) & np.isfinite(y)
+    np.maximum.at(deepest, s[scrolls], np.maximum(y[scrolls], 0))
+
+    present_ids = np.flatnonzero(present)
+    present_page = session_page[present_ids]
+    durations = (last[present_ids] - first[present_ids]) / 1_000_000
+    depth_bins = np.minimum(
+        ((deepest[present_ids] + session_h[present_ids]) // config['SCROLL_DEPTH_BIN']).astype(np.int64),
+        config['SCROLL_DEPTH_BINS'] - 1,
+    )
+    time_bins = np.searchsorted(config['TIME_ON_PAGE_BINS'], durations, side='right')
+    depth_bin_count, time_bin_count = config['SCROLL_DEPTH_BINS'], len(config['TIME_ON_PAGE_BINS']) + 1
+
+    click_pages = page[c]
+    results = {
+        'events': per_page(in_window),
+        'sessions': np.bincount(present_page, minlength=P),
+        'clicks': per_page(clicks),
+        'moves': per_page(moves),
+        'rage_clicks': np.bincount(click_pages[burst_starts], minlength=P),
+        'dead_clicks': np.bincount(click_pages[dead], minlength=P),
+        'time_on_page': np.bincount(present_page, weights=durations, minlength=P),
+        'click_heatmap': heatmap(clicks),
+        'move_heatmap': heatmap(moves),
+        'scroll_depth': np.bincount(present_page * depth_bin_count + depth_bins, minlength=P * depth_bin_count)
+        .reshape(P, depth_bin_count),
+        'time_on_page_histogram': np.bincount(present_page * time_bin_count + time_bins, minlength=P * time_bin_count)
+        .reshape(P, time_bin_count),
+    }
+    return {
+        page_url: {
+            key: (float(value[i]) if key == 'time_on_page' else int(value[i])) if value.ndim == 1 else value[i]
+            for key, value in results.items()
+        }
+        for page_url, i in page_index.items()
+    }
+
+
+def _encode_heatmap(heatmap):
+    return zlib.compress(heatmap.astype('<i4').tobytes(), 6)
+
+
+def _decode_heatmap(data, bins):
+    return np.frombuffer(zlib.decompress(data), dtype='<i4').reshape(bins, bins).astype(np.int64)
+
+
+def to_row(page_url, start, aggregate, config):
+    return PageAnalytics(
+        page_url=page_url,
+        window_start=start,
+        window_seconds=config['WINDOW_SECONDS'],
+        bins=config['HEATMAP_BINS'],
+        events=aggregate['events'],
+        sessions=aggregate['sessions'],
+        clicks=aggregate['clicks'],
+        moves=aggregate['moves'],
+        rage_clicks=aggregate['rage_clicks'],
+        dead_clicks=aggregate['dead_clicks'],
+        time_on_page=aggregate['time_on_page'],
+        click_heatmap=_encode_heatmap(aggregate['click_heatmap']),
+        move_heatmap=_encode_heatmap(aggregate['move_heatmap']),
+        scroll_depth=aggregate['scroll_depth'].tolist(),
+        time_on_page_histogram=aggregate['time_on_page_histogram'].tolist(),
+    )
+
+
+def from_row(row):
+    return {
+        'events': row.events,
+        'sessions': row.sessions,
+        'clicks': row.clicks,
+        'moves': row.moves,
+        'rage_clicks': row.rage_clicks,
+        'dead_clicks': row.dead_clicks,
+        'time_on_page': row.time_on_page,
+        'click_heatmap': _decode_heatmap(row.click_heatmap, row.bins),
+        'move_heatmap': _decode_heatmap(row.move_heatmap, row.bins),
+        'scroll_depth': np.array(row.scroll_depth, dtype=np.int64),
+        'time_on_page_histogram': np.array(row.time_on_page_histogram, dtype=np.int64),
+    }
+
+
+def stored_windows(queryset, config):
+    return queryset.filter(window_seconds=config['WINDOW_SECONDS'], bins=config['HEATMAP_BINS'])
+
+
+def store_window(start, config=None, replace=False):
+    """Compute one window and store its rows. Returns the number of pages it covered."""
+    config = config or get_analytics_settings()
+    end = start + timedelta(seconds=config['WINDOW_SECONDS'])
+    pages = compute_window(start, end, config)
+    total = empty_aggregate(config)
+    for aggregate in pages.values():
+        merge_aggregates(total, aggregate)
+    rows = [to_row(page_url, start, aggregate, config) for page_url, aggregate in pages.items()]
+    # The all-pages row doubles as the marker that this window is done
+    rows.append(to_row(ALL_PAGES, start, total, config))
+    if replace:
+        stored_windows(PageAnalytics.objects.filter(window_start=start), config).delete()
+    # A concurrent request may have stored the same window first
+    PageAnalytics.objects.bulk_create(rows, ignore_conflicts=True)
+    return len(pages)
+
+
+def update_windows(start, end, config=None, replace=False):
+    """Store every window in ``[start, end)`` that is over and settled. Returns how many were computed."""
+    config = config or get_analytics_settings()
+    seconds = config['WINDOW_SECONDS']
+    settled = timezone.now() - timedelta(seconds=config['SETTLE_SECONDS'])
+    done = set()
+    if not replace:
+        done = set(stored_windows(PageAnalytics.objects, config).filter(
+            page_url=ALL_PAGES, window_start__gte=window_start(start, seconds), window_start__lt=end,
+        ).values_list('window_start', flat=True))
+
+    computed = 0
+    current = window_start(start, seconds)
+    while current < end and current + timedelta(seconds=seconds) <= settled:
+        if current not in done:
+            store_window(current, config, replace)
+            computed += 1
+        current += timedelta(seconds=seconds)
+    return computed
+
+
+def page_analytics(page_url=None, start=None, end=None, config=None):
+    """Aggregate a page's analytics (all pages when ``page_url`` is None) over the windows covering ``[start, end)``."""
+    config = config or get_analytics_settings()
+    seconds = config['WINDOW_SECONDS']
+    end = end or timezone.now()
+    start = window_start(start or end - timedelta(days=1), seconds)
+    update_windows(start, end, config)
+
+    key = ALL_PAGES if page_url is None else page_url
+    total = empty_aggregate(config)
+    rows = stored_windows(PageAnalytics.objects, config).filter(page_url=key, window_start__gte=start, window_start__lt=end)
+    stored = set()
+    for row in rows:
+        merge_aggregates(total, from_row(row))
+        stored.add(row.window_start)
+    # The all-pages rows tell which windows are stored even where this page had no events
+    stored.update(stored_windows(PageAnalytics.objects, config).filter(
+        page_url=ALL_PAGES, window_start__gte=start, window_start__lt=end,
+    ).values_list('window_start', flat=True))
+
+    current = start
+    while current < end:
+        if current not in stored:
+            pages = compute_window(current, current + timedelta(seconds=seconds), config)
+            for url, aggregate in pages.items():
+                if page_url is None or url == page_url:
+                    merge_aggregates(total, aggregate)
+        current += timedelta(seconds=seconds)
+    return total
+
+
+def describe(aggregate, config=None):
+    """Turn an aggregate into JSON-ready data, heatmaps scaled to 0..1."""
+    config = config or get_analytics_settings()
+
+    def scaled(heatmap):
+        peak = heatmap.max()
+        return np.round(heatmap / peak, 4).tolist() if peak else heatmap.astype(float).tolist()
+
+    depth_bin = config['SCROLL_DEPTH_BIN']
+    time_edges = [0, *config['TIME_ON_PAGE_BINS']]
+    sessions = aggregate['sessions']
+    return {
+        'events': aggregate['events'],
+        'sessions': sessions,
+        'clicks': aggregate['clicks'],
+        'moves': aggregate['moves'],
+        'rage_clicks': aggregate['rage_clicks'],
+        'dead_clicks': aggregate['dead_clicks'],
+        'time_on_page': {
+            'total': round(aggregate['time_on_page'], 3),
+            'mean': round(aggregate['time_on_page'] / sessions, 3) if sessions else None,
+            # [from_seconds, sessions]; the last bin is open-ended
+            'histogram': [[edge, int(n)] for edge, n in zip(time_edges, aggregate['time_on_page_histogram'])],
+        },
+        # [from_pixels, sessions] by deepest point seen (scroll offset plus window height)
+        'scroll_depth': [[i * depth_bin, int(n)] for i, n in enumerate(aggregate['scroll_depth'])],
+        'click_heatmap': scaled(aggregate['click_heatmap']),
+        'move_heatmap': scaled(aggregate['move_heatmap']),
+    }
@@ -0,0 +1,411 @@
+"""
+Storage backends for recorded events.
+
+``record_events`` hands every batch to each backend listed in
+``TELEMETRY_STORAGE['BACKENDS']``:
+
+- ``ORMBackend`` writes Event rows through the Django ORM. Replay and the
+  session views read from it, so it should stay first in the list.
+- ``OpenSearchBackend`` indexes a copy of each event into daily
+  ``<prefix>-events-YYYY.MM.DD`` indices. Writes only enqueue, once the
+  ingest transaction commits; a background thread sends ``_bulk`` requests,
+  retries with exponential backoff and keeps unsent events spooled in
+  memory (overflowing to ``SPOOL_DIR`` on disk) while the cluster is
+  unreachable.
+
+``get_analytics_backend`` returns the backend that serves aggregate queries,
+so analytics can come from the search store instead of scanning the events
+table.
+"""
+import atexit
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from collections import Counter, deque
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models import BigIntegerField, Count, ExpressionWrapper
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from . import stats
+from .chunks import decode_chunk
+from .database import EpochSeconds
+from .models import Event, EventChunk
+
+logger = logging.getLogger(__name__)
+
+STORAGE_DEFAULTS = {
+    'BACKENDS': ['core.backends.ORMBackend'],  # Every batch is written to each of these, in order
+    'ANALYTICS_BACKEND': 'core.backends.ORMBackend',  # Serves aggregate queries
+}
+
+OPENSEARCH_DEFAULTS = {
+    'HOSTS': ['http://localhost:9200'],
+    'HTTP_AUTH': None,  # (user, password)
+    'TIMEOUT': 10,  # Seconds per request
+    'INDEX_PREFIX': 'clearsight',
+    'BULK_SIZE': 500,  # Events per _bulk request
+    'FLUSH_INTERVAL': 1.0,  # Seconds to wait for a full bulk before sending a partial one
+    'MAX_RETRIES': 5,  # Attempts per bulk before it goes back to the spool
+    'RETRY_BACKOFF': 0.5,  # Seconds before the first retry, doubled on each attempt
+    'RETRY_BACKOFF_MAX': 30.0,
+    'SPOOL_MAX_EVENTS': 100_000,  # Events held in memory while the cluster is unreachable
+    'SPOOL_DIR': None,  # Overflow (and shutdown) spool directory; oldest events are dropped without one
+}
+
+# Bulk item statuses worth sending again; anything else is a bad document
+RETRYABLE_STATUSES = (429, 502, 503, 504)
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_storage_settings():
+    return {**STORAGE_DEFAULTS, **getattr(settings, 'TELEMETRY_STORAGE', {})}
+
+
+def get_opensearch_settings():
+    return {**OPENSEARCH_DEFAULTS, **getattr(settings, 'TELEMETRY_OPENSEARCH', {})}
+
+
+def get_backend(path):
+    """Return the process-wide instance of the backend class at ``path``."""
+    with _backends_lock:
+        if path not in _backends:
+            _backends[path] = import_string(path)()
+        return _backends[path]
+
+
+def get_backends():
+    return [get_backend(path) for path in get_storage_settings()['BACKENDS']]
+
+
+def get_analytics_backend():
+    return get_backend(get_storage_settings()['ANALYTICS_BACKEND'])
+
+
+def close_backends():
+    with _backends_lock:
+        backends = list(_backends.values())
+        _backends.clear()
+    for backend in backends:
+        backend.close()
+
+
+atexit.register(close_backends)
+
+
+@receiver(setting_changed)
+def reset_backends(setting, **kwargs):
+    if setting in ('TELEMETRY_STORAGE', 'TELEMETRY_OPENSEARCH', 'TELEMETRY_SEARCH'):
+        close_backends()
+
+
+def histogram_bucket(timestamp, interval):
+    millis = int(timestamp.timestamp() * 1000)
+    return millis - millis % (interval * 1000)
+
+
+class EventBackend:
+    def write_events(self, events):
+        """Store a batch of unsaved Event instances."""
+        raise NotImplementedError
+
+    def event_stats(self, start, end, interval):
+        """Return event totals per type and per ``interval`` seconds in ``[start, end)``.
+
+        The result is ``{'total': n, 'types': {type: n}, 'histogram': [[bucket_ms, n], ...]}``
+        with buckets aligned to multiples of the interval since the epoch.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class ORMBackend(EventBackend):
+    def write_events(self, events):
+        # Counters move in the same transaction as the rows they count
+        with transaction.atomic():
+            Event.objects.bulk_create(events)
+            stats.increment(stats.EVENTS, len(events))
+
+    def event_stats(self, start, end, interval):
+        types = Counter()
+        buckets = Counter()
+        raw = Event.objects.filter(timestamp__gte=start, timestamp__lt=end).order_by()
+        for row in raw.values('type').annotate(count=Count('id')):
+            types[row['type']] += row['count']
+        bucket = ExpressionWrapper(EpochSeconds('timestamp') / interval, output_field=BigIntegerField())
+        for row in raw.annotate(bucket=bucket).values('bucket').annotate(count=Count('id')):
+            buckets[row['bucket'] * interval * 1000] += row['count']
+
+        # Chunks inside the range and one histogram bucket are counted from their metadata
+        undecoded = []
+        chunks = EventChunk.objects.filter(end_time__gte=start, start_time__lt=end).defer('columns')
+        for chunk in chunks.iterator(chunk_size=1000):
+            bucket_ms = histogram_bucket(chunk.start_time, interval)
+            if (chunk.type_counts is None or chunk.start_time < start or chunk.end_time >= end
+                    or histogram_bucket(chunk.end_time, interval) != bucket_ms):
+                undecoded.append(chunk.pk)
+                continue
+            types.update(dict(zip(chunk.types, chunk.type_counts)))
+            buckets[bucket_ms] += chunk.event_count
+
+        for chunk in EventChunk.objects.filter(pk__in=undecoded).iterator(chunk_size=100):
+            for event in decode_chunk(chunk):
+                if start <= event['timestamp'] < end:
+                    types[event['type']] += 1
+                    buckets[histogram_bucket(event['timestamp'], interval)] += 1
+
+        return {
+            'total': sum(types.values()),
+            'types': dict(types.most_common()),
+            'histogram': sorted(buckets.items()),
+        }
+
+
+class OpenSearchBackend(EventBackend):
+    def __init__(self, config=None):
+        from opensearchpy import OpenSearch
+
+        self.config = {**get_opensearch_settings(), **(config or {})}
+        self.client = OpenSearch(
+            hosts=self.config['HOSTS'],
+            http_auth=self.config['HTTP_AUTH'],
+            timeout=self.config['TIMEOUT'],
+            max_retries=0,  # Retries are handled here, with backoff
+        )
+        self.prefix = self.config['INDEX_PREFIX']
+        self.spool = deque()  # (index, doc_id, source) actions not yet acknowledged by the cluster
+        self.in_flight = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._backing_off = False
+        self._template_ready = False
+        self._thread = None
+
+    # Writing
+
+    def write_events(self, events):
+        actions = [self.action(event) for event in events]
+        # Rows of a rolled back ingest transaction must not reach the index. Robust: by the
+        # time this runs the rows are committed, so a closed backend mustn't fail the ingest
+        transaction.on_commit(lambda: self._enqueue(actions), robust=True)
+
+    def _enqueue(self, actions):
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('OpenSearch backend is closed')
+            self.spool.extend(actions)
+            self._trim_spool()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='opensearch-bulk', daemon=True)
+                self._thread.start()
+            # While the sender backs off from a failing cluster, a full bulk must not cut the wait short
+            if len(self.spool) >= self.config['BULK_SIZE'] and not self._backing_off:
+                self._cond.notify_all()
+
+    def action(self, event):
+        # A stable id per event keeps retried bulks idempotent
+        doc_id = str(event.pk) if event.pk is not None else uuid.uuid4().hex
+        return (
+            f"{self.prefix}-events-{event.timestamp:%Y.%m.%d}",
+            doc_id,
+            {
+                'session_id': str(event.session_id),
+                'type': event.type,
+                'timestamp': event.timestamp.isoformat(),
+                'data': event.data,
+            },
+        )
+
+    def flush(self, timeout=None):
+        """Block until every spooled event was sent, or ``timeout`` seconds pass.
+
+        Returns True when the spool drained.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._cond.notify_all()
+            while self.spool or self.in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=5.0):
+        """Send what can be sent within ``timeout`` and spill the rest to SPOOL_DIR."""
+        self.flush(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            unsent, self.spool = list(self.spool), deque()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if unsent:
+            self._spill(unsent)
+
+    def _trim_spool(self):
+        overflow = len(self.spool) - self.config['SPOOL_MAX_EVENTS']
+        if overflow <= 0:
+            return
+        oldest = [self.spool.popleft() for _ in range(overflow)]
+        self._spill(oldest)
+
+    def _spill(self, actions):
+        spool_dir = self.config['SPOOL_DIR']
+        if not spool_dir:
+            logger.warning(f'OpenSearch spool full, dropped {len(actions)} events')
+            return
+        os.makedirs(spool_dir, exist_ok=True)
+        path = os.path.join(spool_dir, f'{time.time_ns()}-{uuid.uuid4().hex[:8]}.ndjson')
+        with open(path + '.tmp', 'w') as f:
+            for action in actions:
+                f.write(json.dumps(action) + '\n')
+        # Rename last so the reader never sees a partly written file
+        os.replace(path + '.tmp', path)
+        logger.warning(f'Spooled {len(actions)} events to {path}')
+
+    def _load_spill(self):
+        """Move the oldest spool file back into memory, if there is one."""
+        spool_dir = self.config['SPOOL_DIR']
+        if not spool_dir or not os.path.isdir(spool_dir):
+            return False
+        files = sorted(name for name in os.listdir(spool_dir) if name.endswith('.ndjson'))
+        if not files:
+            return False
+        path = os.path.join(spool_dir, files[0])
+        with open(path) as f:
+            actions = [tuple(json.loads(line)) for line in f if line.strip()]
+        with self._cond:
+            self.spool.extend(actions)
+        os.remove(path)
+        logger.info(f'Loaded {len(actions)} spooled events from {path}')
+        return True
+
+    # Background sender
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if len(self.spool) < self.config['BULK_SIZE'] and not self._closed:
+                    self._cond.wait(self.config['FLUSH_INTERVAL'])
+                if self._closed:
+                    return
+                batch = [self.spool.popleft() for _ in range(min(self.config['BULK_SIZE'], len(self.spool)))]
+                self.in_flight = len(batch)
+
+            if not batch:
+                with self._cond:
+                    self.in_flight = 0
+                    self._cond.notify_all()
+                self._load_spill()
+                continue
+
+            failed = self._send_with_retry(batch)
+            with self._cond:
+                self.in_flight = 0
+                if failed and self._closed:
+                    self._spill(failed)
+                elif failed:
+                    # The cluster is down: keep the events at the head of the spool and back off
+                    self.spool.extendleft(reversed(failed))
+                    self._trim_spool()
+                self._cond.notify_all()
+                if failed and not self._closed:
+                    # Other notifications (flush waiters, spool changes) don't end the backoff; close does
+                    self._backing_off = True
+                    deadline = time.monotonic() + self.config['RETRY_BACKOFF_MAX']
+                    while not self._closed and (remaining := deadline - time.monotonic()) > 0:
+                        self._cond.wait(remaining)
+                    self._backing_off = False
+
+    def _send_with_retry(self, batch):
+        """Send a batch, retrying the retryable part. Returns the actions still unsent."""
+        for attempt in range(self.config['MAX_RETRIES']):
+            if attempt:
+                delay = min(self.config['RETRY_BACKOFF'] * 2 ** (attempt - 1), self.config['RETRY_BACKOFF_MAX'])
+                time.sleep(delay * random.uniform(0.5, 1.0))
+            try:
+                batch = self._send(batch)
+            except Exception as e:
+                logger.warning(f'OpenSearch bulk of {len(batch)} events failed (attempt {attempt + 1}): {e}')
+                continue
+            if not batch:
+                return []
+        return batch
+
+    def _send(self, batch):
+        """Send one _bulk request. Returns the actions that should be retried."""
+        self._ensure_template()
+        body = []
+        for index, doc_id, source in batch:
+            body.append({'index': {'_index': index, '_id': doc_id}})
+            body.append(source)
+        response = self.client.bulk(body=body)
+        if not response.get('errors'):
+            return []
+
+        retry = []
+        for action, item in zip(batch, response['items']):
+            result = item.get('index', {})
+            status = result.get('status', 500)
+            if status in RETRYABLE_STATUSES:
+                retry.append(action)
+            elif status >= 300:
+                logger.error(f'OpenSearch rejected event {action[1]}: {result.get("error")}')
+        return retry
+
+    def _ensure_template(self):
+        if self._template_ready:
+            return
+        self.client.indices.put_index_template(name=f'{self.prefix}-events', body={
+            'index_patterns': [f'{self.prefix}-events-*'],
+            'template': {
+                'mappings': {
+                    'properties': {
+                        'session_id': {'type': 'keyword'},
+                        'type': {'type': 'keyword'},
+                        'timestamp': {'type': 'date'},
+                        # Event payloads vary by type; keep them in _source without mapping every key
+                        'data': {'type': 'object', 'enabled': False},
+                    }
+                }
+            },
+        })
+        self._template_ready = True
+
+    # Analytics
+
+    def event_stats(self, start, end, interval):
+        response = self.client.search(index=f'{self.prefix}-events-*', body={
+            'size': 0,
+            'track_total_hits': True,
+            'query': {'range': {'timestamp': {'gte': start.isoformat(), 'lt': end.isoformat()}}},
+            'aggs': {
+                'types': {'terms': {'field': 'type', 'size': 100}},
+                'over_time': {'date_histogram': {'field': 'timestamp', 'fixed_interval': f'{interval}s'}},
+            },
+        }, params={'ignore_unavailable': 'true', 'allow_no_indices': 'true'})
+        aggregations = response.get('aggregations', {})
+        return {
+            'total': response['hits']['total']['value'],
+            'types': {
+                bucket['key']: bucket['doc_count']
+                for bucket in aggregations.get('types', {}).get('buckets', [])
+            },
+            'histogram': [
+                [bucket['key'], bucket['doc_count']]
+                for bucket in aggregations.get('over_time', {}).get('buckets', [])
+                if bucket['doc_count']
+            ],
+        }
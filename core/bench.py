@@ -0,0 +1,548 @@
+"""
+Load generation and timing for capacity planning.
+
+``bench_ingest`` drives a running server with synthetic browser sessions
+that speak the same protocol as telemetry.js: ``session_start`` followed by
+individual events over ``/ws/telemetry/`` (acked per event), or batch
+envelopes posted to ``/api/telemetry/``. Each session emits events from a
+configurable type mix at a Poisson-distributed rate. The report covers ack
+throughput and latency (from the moment an event is generated to its ack),
+rows the database gained, and the server's peak RSS.
+
+``bench_replay`` builds sessions of a given size directly in the database
+and times what a replay viewer requests: the replay page, the seek index
+(cold and cached) and every event window in turn.
+
+The WebSocket client here is a minimal RFC 6455 implementation (text
+frames, ping/pong, close) so the benchmark needs nothing beyond the
+project's own requirements.
+"""
+import asyncio
+import base64
+import http.client
+import json
+import os
+import random
+import resource
+import secrets
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from . import stats
+from .backends import get_backend
+from .chunks import compact_session, session_time_range, total_event_count
+from .ingest import create_session
+from .models import Event, ReplayIndex
+
+DEFAULT_MIX = {'mousemove': 60, 'scroll': 20, 'click': 8, 'keypress': 8, 'input': 4}
+
+WINDOW = (1280, 800)
+
+
+class ConnectionClosed(Exception):
+    pass
+
+
+def parse_mix(value):
+    """Parse ``'mousemove=60,scroll=20'`` into a weight per event type."""
+    mix = {}
+    for part in value.split(','):
+        event_type, _, weight = part.partition('=')
+        mix[event_type.strip()] = float(weight or 1)
+    return mix
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def process_tree_rss(pid):
+    """Resident set size in bytes of ``pid`` and all its descendants (Linux only)."""
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name may contain spaces; fields resume after its closing paren
+                fields = f.read().rpartition(')')[2].split()
+        except OSError:
+            continue
+        parents.setdefault(int(fields[1]), []).append(int(entry))
+
+    total, pending = 0, [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(parents.get(current, []))
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return total
+
+
+def own_peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class SyntheticBrowser:
+    """Generates session_start data and events for one simulated visitor."""
+
+    def __init__(self, mix, rate, seed=None):
+        self.types = list(mix)
+        self.weights = [mix[event_type] for event_type in self.types]
+        self.rate = rate
+        self.random = random.Random(seed)
+        self.x, self.y = WINDOW[0] // 2, WINDOW[1] // 2
+        self.dx = self.dy = 0.0
+        self.scroll = 0
+
+    def session_start(self):
+        return {
+            'type': 'session_start',
+            'pageUrl': 'http://bench.invalid/page',
+            'pageTitle': 'Benchmark page',
+            'userAgent': 'clearsight-bench',
+            'screenResolution': {'width': 1920, 'height': 1080},
+            'windowSize': {'width': WINDOW[0], 'height': WINDOW[1]},
+            'pageHtml': '<html><body><h1>Benchmark</h1><input></body></html>',
+            'pageStyles': 'body { margin: 0; }',
+        }
+
+    def next_delay(self):
+        return self.random.expovariate(self.rate)
+
+    def next_event(self):
+        event_type = self.random.choices(self.types, self.weights)[0]
+        now = int(time.time() * 1000)
+        if event_type == 'mousemove':
+            # A wandering pointer with some momentum, like a real cursor
+            self.dx = self.dx * 0.8 + self.random.gauss(0, 6)
+            self.dy = self.dy * 0.8 + self.random.gauss(0, 6)
+            self.x = min(max(0, int(self.x + self.dx)), WINDOW[0])
+            self.y = min(max(0, int(self.y + self.dy)), WINDOW[1])
+            data = {'x': self.x, 'y': self.y, 'timestamp': now}
+        elif event_type == 'scroll':
+            self.scroll = max(0, self.scroll + self.random.randint(-40, 120))
+            data = {'x': 0, 'y': self.scroll, 'timestamp': now}
+        elif event_type == 'click':
+            data = {'x': self.x, 'y': self.y, 'target': 'BUTTON', 'timestamp': now}
+        elif event_type == 'input':
+            data = {'selector': 'body > input:nth-of-type(1)', 'value': secrets.token_hex(4), 'timestamp': now}
+        elif event_type == 'resize':
+            data = {'width': WINDOW[0] + self.random.randint(-50, 50), 'height': WINDOW[1]}
+        elif event_type == 'visibility':
+            data = {'state': self.random.choice(('hidden', 'visible'))}
+        else:
+            data = {'timestamp': now}
+        return event_type, data
+
+
+class WebSocketClient:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self._fragments = []
+
+    @classmethod
+    async def connect(cls, url):
+        parts = urlsplit(url)
+        secure = parts.scheme in ('wss', 'https')
+        port = parts.port or (443 if secure else 80)
+        reader, writer = await asyncio.open_connection(parts.hostname, port, ssl=secure or None)
+        key = base64.b64encode(os.urandom(16)).decode()
+        origin = f"{'https' if secure else 'http'}://{parts.netloc}"
+        writer.write((
+            f'GET {parts.path or "/"} HTTP/1.1\r\n'
+            f'Host: {parts.netloc}\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            f'Sec-WebSocket-Key: {key}\r\n'
+            'Sec-WebSocket-Version: 13\r\n'
+            f'Origin: {origin}\r\n\r\n'
+        ).encode())
+        response = await reader.readuntil(b'\r\n\r\n')
+        status = response.split(b'\r\n', 1)[0]
+        if b' 101 ' not in status + b' ':
+            writer.close()
+            raise ConnectionClosed(f'Handshake failed: {status.decode(errors="replace")}')
+        return cls(reader, writer)
+
+    async def send(self, text):
+        await self._send_frame(0x1, text.encode())
+
+    async def recv(self):
+        while True:
+            head = await self.reader.readexactly(2)
+            final, opcode, length = head[0] & 0x80, head[0] & 0x0F, head[1] & 0x7F
+            if length == 126:
+                length, = struct.unpack('!H', await self.reader.readexactly(2))
+            elif length == 127:
+                length, = struct.unpack('!Q', await self.reader.readexactly(8))
+            key = await self.reader.readexactly(4) if head[1] & 0x80 else None
+            payload = await self.reader.readexactly(length)
+            if key:
+                payload = _mask(payload, key)
+
+            if opcode == 0x8:
+                raise ConnectionClosed(struct.unpack('!H', payload[:2])[0] if len(payload) >= 2 else None)
+            if opcode == 0x9:
+                await self._send_frame(0xA, payload)
+                continue
+            if opcode == 0xA:
+                continue
+            self._fragments.append(payload)
+            if final:
+                message, self._fragments = b''.join(self._fragments), []
+                return message.decode()
+
+    async def close(self):
+        try:
+            await self._send_frame(0x8, struct.pack('!H', 1000))
+        except (ConnectionError, RuntimeError):
+            pass
+        self.writer.close()
+
+    async def _send_frame(self, opcode, payload):
+        # Client frames must be masked
+        key = os.urandom(4)
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, 0x80 | length)
+        elif length < 1 << 16:
+            header = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, length)
+        self.writer.write(header + key + _mask(payload, key))
+        await self.writer.drain()
+
+
+def _mask(payload, key):
+    size = len(payload)
+    if not size:
+        return payload
+    repeated = (key * (size // 4 + 1))[:size]
+    return (int.from_bytes(payload, 'big') ^ int.from_bytes(repeated, 'big')).to_bytes(size, 'big')
+
+
+class IngestResults:
+    def __init__(self):
+        self.sessions = 0
+        self.sent = 0
+        self.acked = 0
+        self.errors = 0
+        self.latencies = []
+
+    def ack(self, sent_at, now=None):
+        self.acked += 1
+        self.latencies.append((now or time.monotonic()) - sent_at)
+
+
+async def ws_session(base_url, browser, deadline, results, drain_timeout):
+    parts = urlsplit(base_url)
+    scheme = 'wss' if parts.scheme == 'https' else 'ws'
+    try:
+        client = await WebSocketClient.connect(f'{scheme}://{parts.netloc}/ws/telemetry/')
+        await client.send(json.dumps(browser.session_start()))
+        while json.loads(await client.recv()).get('type') != 'session_started':
+            pass
+    except (OSError, ConnectionClosed, asyncio.IncompleteReadError):
+        results.errors += 1
+        return
+    results.sessions += 1
+
+    pending = {}
+    drained = asyncio.Event()
+
+    async def read_acks():
+        while True:
+            message = json.loads(await client.recv())
+            now = time.monotonic()
+            if message.get('type') == 'event_recorded' and message.get('seq') in pending:
+                results.ack(pending.pop(message['seq']), now)
+            elif message.get('type') == 'events_recorded':
+                for seq in [seq for seq in pending if seq <= message['seq']]:
+                    results.ack(pending.pop(seq), now)
+            elif message.get('type') == 'error':
+                results.errors += 1
+            if not pending and time.monotonic() >= deadline:
+                drained.set()
+
+    reader = asyncio.ensure_future(read_acks())
+    seq = 0
+    try:
+        while True:
+            await asyncio.sleep(browser.next_delay())
+            if time.monotonic() >= deadline or reader.done():
+                break
+            event_type, data = browser.next_event()
+            seq += 1
+            pending[seq] = time.monotonic()
+            await client.send(json.dumps({'type': event_type, 'seq': seq, 'data': data}))
+            results.sent += 1
+        if pending and not reader.done():
+            # Acks for the tail arrive when the server's buffer flushes
+            await asyncio.wait_for(drained.wait(), drain_timeout)
+    except (asyncio.TimeoutError, OSError, ConnectionClosed, asyncio.IncompleteReadError):
+        results.errors += 1
+    finally:
+        if reader.done() and not reader.cancelled() and reader.exception():
+            # The server closed the connection mid-run
+            results.errors += 1
+        reader.cancel()
+        await client.close()
+
+
+class HTTPSession:
+    """A keep-alive connection posting JSON to /api/telemetry/ with a CSRF cookie, like the browser."""
+
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.connection = connection_class(parts.hostname, parts.port, timeout=30)
+        # Django accepts any well-formed secret as long as cookie and header match
+        self.token = secrets.token_hex(16)
+        self.lock = threading.Lock()
+
+    def post(self, payload):
+        body = json.dumps(payload)
+        headers = {
+            'Content-Type': 'application/json',
+            'X-CSRFToken': self.token,
+            'Cookie': f'csrftoken={self.token}',
+        }
+        with self.lock:
+            try:
+                self.connection.request('POST', '/api/telemetry/', body, headers)
+                response = self.connection.getresponse()
+            except (ConnectionError, http.client.HTTPException):
+                # The server closed the idle connection; retry once on a fresh one
+                self.connection.close()
+                self.connection.request('POST', '/api/telemetry/', body, headers)
+                response = self.connection.getresponse()
+            return response.status, json.loads(response.read() or b'{}')
+
+    def close(self):
+        self.connection.close()
+
+
+async def http_session(base_url, browser, deadline, results, executor, flush_interval, max_batch):
+    loop = asyncio.get_running_loop()
+    client = HTTPSession(base_url)
+    try:
+        status, body = await loop.run_in_executor(executor, client.post, browser.session_start())
+    except (OSError, http.client.HTTPException, ValueError):
+        status, body = None, {}
+    if status != 200:
+        results.errors += 1
+        client.close()
+        return
+    results.sessions += 1
+    session_id = body['session_id']
+
+    async def flush(batch):
+        envelope = {
+            'type': 'batch',
+            'session_id': session_id,
+            'sentAt': int(time.time() * 1000),
+            'events': [event for _, event in batch],
+        }
+        try:
+            status, _ = await loop.run_in_executor(executor, client.post, envelope)
+        except (OSError, http.client.HTTPException, ValueError):
+            status = None
+        if status != 200:
+            results.errors += 1
+            return
+        now = time.monotonic()
+        for created, _ in batch:
+            results.ack(created, now)
+
+    queue, flushes, seq = [], [], 0
+    next_flush = time.monotonic() + flush_interval
+    while True:
+        await asyncio.sleep(browser.next_delay())
+        now = time.monotonic()
+        if now < deadline:
+            event_type, data = browser.next_event()
+            seq += 1
+            queue.append((now, {'type': event_type, 'timestamp': int(time.time() * 1000), 'seq': seq, 'data': data}))
+            results.sent += 1
+        if queue and (len(queue) >= max_batch or now >= next_flush or now >= deadline):
+            # Like telemetry.js, recording continues while a batch is in flight
+            flushes.append(asyncio.ensure_future(flush(queue)))
+            queue, next_flush = [], now + flush_interval
+        if now >= deadline:
+            break
+    await asyncio.gather(*flushes)
+    client.close()
+
+
+async def run_ingest(base_url, transport, sessions, duration, rate, mix, ramp_up=1.0, flush_interval=2.0,
+                     max_batch=100, drain_timeout=10.0, seed=None):
+    results = IngestResults()
+    deadline = time.monotonic() + ramp_up + duration
+    executor = ThreadPoolExecutor(max_workers=max(4, min(sessions, 256)), thread_name_prefix='bench-http')
+    seeds = random.Random(seed)
+
+    async def start(index):
+        # Spread connection setup over the ramp-up so the server isn't hit by one burst
+        await asyncio.sleep(ramp_up * index / max(1, sessions))
+        browser = SyntheticBrowser(mix, rate, seeds.random())
+        if transport == 'ws':
+            await ws_session(base_url, browser, deadline, results, drain_timeout)
+        else:
+            await http_session(base_url, browser, deadline, results, executor, flush_interval, max_batch)
+
+    try:
+        await asyncio.gather(*(start(index) for index in range(sessions)))
+    finally:
+        executor.shutdown(wait=False)
+    return results
+
+
+class RSSMonitor:
+    """Samples the peak RSS of a process tree from a background thread."""
+
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='bench-rss', daemon=True)
+
+    def __enter__(self):
+        if self.pid:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, process_tree_rss(self.pid))
+            self._stop.wait(self.interval)
+
+
+def ingest_benchmark(base_url, transport, sessions, duration, rate, mix=None, server_pid=None, **options):
+    """Run one ingest benchmark and return its report as a dict."""
+    rows_before = total_event_count()
+    with RSSMonitor(server_pid) as monitor:
+        started = time.monotonic()
+        results = asyncio.run(run_ingest(base_url, transport, sessions, duration, rate, mix or DEFAULT_MIX, **options))
+        elapsed = time.monotonic() - started
+    rows = total_event_count() - rows_before
+
+    latencies = results.latencies
+    return {
+        'transport': transport,
+        'sessions': results.sessions,
+        'elapsed': elapsed,
+        'events_sent': results.sent,
+        'events_acked': results.acked,
+        'errors': results.errors,
+        'events_per_sec': results.acked / elapsed,
+        'ack_p50_ms': percentile(latencies, 0.5) * 1000 if latencies else None,
+        'ack_p99_ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+        'ack_max_ms': max(latencies) * 1000 if latencies else None,
+        'db_rows': rows,
+        'db_rows_per_sec': rows / elapsed,
+        'server_rss_peak': monitor.peak or None,
+        'client_rss_peak': own_peak_rss(),
+    }
+
+
+def create_replay_session(event_count, rate=50, mix=None, batch_size=10000, seed=None):
+    """Create an ended session holding ``event_count`` synthetic events, ``rate`` per second of session time."""
+    browser = SyntheticBrowser(mix or DEFAULT_MIX, rate, seed)
+    session, _ = create_session(browser.session_start())
+    backend = get_backend('core.backends.ORMBackend')
+
+    start = session.start_time
+    for offset in range(0, event_count, batch_size):
+        events = []
+        for i in range(offset, min(offset + batch_size, event_count)):
+            event_type, data = browser.next_event()
+            events.append(Event(session=session, type=event_type, timestamp=start + timedelta(seconds=i / rate), data=data))
+        backend.write_events(events)
+
+    session.end_time = start + timedelta(seconds=event_count / rate)
+    session.is_active = False
+    session.save(update_fields=['end_time', 'is_active'])
+    stats.increment(stats.ACTIVE_SESSIONS, -1)
+    return session
+
+
+def time_replay(session):
+    """Time the requests a replay viewer makes for ``session``, in seconds."""
+    client = Client(raise_request_exception=True)
+    timings = {}
+
+    started = time.perf_counter()
+    client.get(reverse('session_replay', args=[session.id]))
+    timings['page'] = time.perf_counter() - started
+
+    ReplayIndex.objects.filter(session=session).delete()
+    for name in ('index_cold', 'index_warm'):
+        started = time.perf_counter()
+        client.get(reverse('session_replay_index', args=[session.id]))
+        timings[name] = time.perf_counter() - started
+
+    first, last = session_time_range(session)
+    events_url = reverse('session_replay_events', args=[session.id])
+    start = int(first.timestamp() * 1000)
+    end = int(last.timestamp() * 1000)
+    streamed = windows = 0
+    started = time.perf_counter()
+    while start <= end:
+        response = client.get(events_url, {'start': start})
+        streamed += b''.join(response.streaming_content).count(b'\n')
+        windows += 1
+        if windows == 1:
+            # What a viewer waits for before playback starts
+            timings['first_window'] = time.perf_counter() - started
+        start = int(response['X-Window-End'])
+    timings['all_windows'] = time.perf_counter() - started
+    timings['windows'] = windows
+    timings['events'] = streamed
+    return timings
+
+
+def replay_benchmark(sizes, rate=50, compact=False, keep=False, seed=None, progress=None):
+    """Build a session per size in ``sizes`` and time its replay. Returns one report per size."""
+    reports = []
+    for size in sizes:
+        started = time.perf_counter()
+        session = create_replay_session(size, rate, seed=seed)
+        report = {'size': size, 'session_id': str(session.id), 'create': time.perf_counter() - started}
+        if compact:
+            started = time.perf_counter()
+            compact_session(session, timezone.now() + timedelta(days=1))
+            report['compact'] = time.perf_counter() - started
+        if progress:
+            progress(f'Created session {session.id} with {size} events in {report["create"]:.1f}s')
+        try:
+            report.update(time_replay(session))
+        finally:
+            if not keep:
+                session.delete()
+        report['rss_peak'] = own_peak_rss()
+        reports.append(report)
+    return reports
@@ -0,0 +1,202 @@
+"""
+Precompressed replay bundles for ended sessions.
+
+When a session ends, ``finalize_session`` (core/summaries.py) writes its page
+snapshot, seek index (core/replay.py) and events to one compressed NDJSON
+file: a header line, then one event per line in the replay events format.
+The file name and URL carry an ETag of the compressed bytes, so it is served
+as immutable, with ``Range`` support. ENCODING ``br`` needs the optional
+``brotli`` package. Active sessions and sessions over MAX_EVENTS replay from
+the tables, and events stored for an ended session discard its bundle.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils import timezone
+
+from .chunks import iter_session_events
+from .dom import expand_dom_snapshots
+from .models import ReplayBundle, ReplayIndex
+from .replay import get_replay_index
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+BUNDLE_DEFAULTS = {
+    'ENABLED': True,
+    'DIR': 'bundles',
+    'ENCODING': 'gzip',  # 'gzip' or 'br'
+    'LEVEL': 9,  # Compression level; bundles are written once and served many times
+    'MAX_EVENTS': 200_000,  # Larger sessions replay window by window
+    'BUILD_ON_CLOSE': True,  # Build when a session ends rather than on its first replay
+}
+
+BUNDLE_FORMAT = 'clearsight-replay'
+BUNDLE_VERSION = 1
+EXTENSIONS = {'gzip': 'gz', 'br': 'br'}
+READ_SIZE = 64 * 1024
+
+
+def get_bundle_settings():
+    return {**BUNDLE_DEFAULTS, **getattr(settings, 'TELEMETRY_REPLAY_BUNDLES', {})}
+
+
+def bundle_encoding(config):
+    if config['ENCODING'] == 'br' and brotli is None:
+        logger.warning('TELEMETRY_REPLAY_BUNDLES asks for brotli but the brotli package is not installed; using gzip')
+        return 'gzip'
+    if config['ENCODING'] not in EXTENSIONS:
+        raise ValueError(f"Unsupported replay bundle encoding {config['ENCODING']!r}")
+    return config['ENCODING']
+
+
+def bundle_path(bundle):
+    return os.path.join(str(get_bundle_settings()['DIR']), bundle.path)
+
+
+def _to_millis(value):
+    return int(value.timestamp() * 1000)
+
+
+class _BrotliFile:
+    """The write/close subset of GzipFile over a brotli stream."""
+
+    def __init__(self, raw, level):
+        self.raw = raw
+        self.compressor = brotli.Compressor(quality=min(level, 11))
+
+    def write(self, data):
+        self.raw.write(self.compressor.process(data))
+
+    def close(self):
+        self.raw.write(self.compressor.finish())
+
+
+def _open_compressed(raw, encoding, level):
+    if encoding == 'br':
+        return _BrotliFile(raw, level)
+    # A fixed mtime keeps identical content at identical bytes, and so at the same ETag
+    return gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=level, mtime=0)
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(READ_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()[:32]
+
+
+def iter_decompressed(path, encoding):
+    """Yield a bundle file's uncompressed bytes, for clients that accept neither encoding."""
+    if encoding == 'br':
+        decompressor = brotli.Decompressor()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(READ_SIZE), b''):
+                yield decompressor.process(block)
+        return
+    with gzip.open(path, 'rb') as f:
+        yield from iter(lambda: f.read(READ_SIZE), b'')
+
+
+def write_bundle(session, index, directory, encoding, level):
+    """Write a session's bundle file. Returns ``(relative_path, etag, size, event_count, start_ms, end_ms)``."""
+    month = os.path.join(f'{session.start_time:%Y}', f'{session.start_time:%m}')
+    os.makedirs(os.path.join(directory, month), exist_ok=True)
+    # Unique per writer, so concurrent builds of one session can't interleave
+    fd, temp = tempfile.mkstemp(prefix=f'{session.id}.', suffix='.tmp', dir=os.path.join(directory, month))
+
+    header = {
+        'format': BUNDLE_FORMAT,
+        'version': BUNDLE_VERSION,
+        'session': str(session.id),
+        'snapshot': {
+            'page_html': session.page_html or '<html><body><p>No content captured</p></body></html>',
+            'page_styles': session.page_styles or '',
+        },
+        'seek_index': index.seek_index,
+        'keyframes': index.keyframes,
+    }
+    count = 0
+    start_ms = end_ms = None
+    with os.fdopen(fd, 'wb') as raw:
+        f = _open_compressed(raw, encoding, level)
+        f.write(json.dumps(header, cls=DjangoJSONEncoder).encode() + b'\n')
+        for event in expand_dom_snapshots(iter_session_events(session)):
+            timestamp = _to_millis(event['timestamp'])
+            start_ms = timestamp if start_ms is None else start_ms
+            end_ms = timestamp
+            f.write(json.dumps({
+                'type': event['type'],
+                'timestamp': timestamp,
+                'data': event['data'],
+            }, cls=DjangoJSONEncoder).encode() + b'\n')
+            count += 1
+        f.close()
+
+    etag = _file_digest(temp)
+    relative = os.path.join(month, f'{session.id}-{etag}.ndjson.{EXTENSIONS[encoding]}')
+    os.replace(temp, os.path.join(directory, relative))
+    return relative, etag, os.path.getsize(os.path.join(directory, relative)), count, start_ms, end_ms
+
+
+def build_bundle(session, config=None):
+    """Write and record the replay bundle of an ended session. Returns None when it gets none."""
+    config = config or get_bundle_settings()
+    if not config['ENABLED'] or session.is_active:
+        return None
+    index = get_replay_index(session)
+    if config['MAX_EVENTS'] is not None and index.event_count > config['MAX_EVENTS']:
+        ReplayBundle.objects.filter(session=session).delete()
+        return None
+
+    encoding = bundle_encoding(config)
+    relative, etag, size, count, start_ms, end_ms = write_bundle(
+        session, index, str(config['DIR']), encoding, config['LEVEL'])
+    previous = ReplayBundle.objects.filter(session=session).first()
+    fields = {'path': relative, 'etag': etag, 'encoding': encoding, 'size': size,
+              'event_count': count, 'start_ms': start_ms, 'end_ms': end_ms}
+    # Written before it is read back (see core/database.py)
+    with transaction.atomic():
+        if not ReplayBundle.objects.filter(session=session).update(built_at=timezone.now(), **fields):
+            ReplayBundle.objects.bulk_create([ReplayBundle(session=session, **fields)], ignore_conflicts=True)
+        bundle = ReplayBundle.objects.get(session=session)
+    if previous is not None and previous.path not in (relative, bundle.path):
+        transaction.on_commit(lambda: remove_bundle_file(previous))
+    logger.info(f'Built replay bundle of session {session.id}: {count} events, {size} bytes ({encoding})')
+    return bundle
+
+
+def get_replay_bundle(session, build=True):
+    """Return an ended session's bundle, building it first if it has none and ``build`` is set."""
+    if session.is_active:
+        return None
+    bundle = ReplayBundle.objects.filter(session=session).first()
+    if bundle is not None and os.path.exists(bundle_path(bundle)):
+        return bundle
+    return build_bundle(session) if build else None
+
+
+def discard_stale_bundles(session_ids):
+    """Drop the replay indexes and bundles of ended sessions in ``session_ids``, built before events just stored."""
+    # Rebuilt on next use; the bundle files go with the rows (core/signals.py)
+    ReplayIndex.objects.filter(session_id__in=session_ids, session__is_active=False).delete()
+    ReplayBundle.objects.filter(session_id__in=session_ids, session__is_active=False).delete()
+
+
+def remove_bundle_file(bundle):
+    try:
+        os.remove(bundle_path(bundle))
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,244 @@
+"""
+Columnar storage for compacted session events.
+
+An EventChunk holds a window of one session's events as zlib-compressed
+column arrays instead of one row per event::
+
+    count (u32)
+    type codes       u16[count]  index into EventChunk.types
+    timestamp deltas i64[count]  microseconds since the previous event
+    x, y             i32[count]  pointer coordinates, when the event had them
+    flags            u8[count]   bit 0: x/y moved to the columns, bit 1: non-object data
+    payload offsets  u32[count + 1]
+    payload          the rest of each event's data as concatenated JSON
+
+``session_events`` merges decoded chunks with the raw Event rows that have
+not been compacted yet, so readers don't need to know which tier an event
+lives in.
+"""
+import json
+import logging
+import struct
+import sys
+import zlib
+from array import array
+from datetime import timedelta
+from itertools import accumulate
+
+from django.db import transaction
+from django.db.models import Count, Max, Min, Sum
+
+from .models import Event, EventChunk
+
+logger = logging.getLogger(__name__)
+
+COUNT = struct.Struct('<I')
+HAS_XY = 1
+WRAPPED = 2
+INT32 = (-2 ** 31, 2 ** 31 - 1)
+
+
+def _micros(delta):
+    return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+
+def _is_int32(value):
+    return isinstance(value, int) and not isinstance(value, bool) and INT32[0] <= value <= INT32[1]
+
+
+def _pack(values):
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def _unpack(blob, offset, typecode, count):
+    values = array(typecode)
+    end = offset + values.itemsize * count
+    values.frombytes(blob[offset:end])
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values, end
+
+
+def encode_chunk(session, events):
+    """Build an unsaved EventChunk from Event rows sorted by timestamp."""
+    types = []
+    type_counts = []
+    type_codes = {}
+    codes, deltas, xs, ys, flags = array('H'), array('q'), array('i'), array('i'), array('B')
+    offsets = array('I', [0])
+    payload = bytearray()
+
+    start_time = previous = events[0].timestamp
+    for event in events:
+        if event.type not in type_codes:
+            type_codes[event.type] = len(types)
+            types.append(event.type)
+            type_counts.append(0)
+        codes.append(type_codes[event.type])
+        type_counts[type_codes[event.type]] += 1
+        deltas.append(_micros(event.timestamp - previous))
+        previous = event.timestamp
+
+        data = event.data
+        if not isinstance(data, dict):
+            xs.append(0)
+            ys.append(0)
+            flags.append(WRAPPED)
+        elif _is_int32(data.get('x')) and _is_int32(data.get('y')):
+            xs.append(data['x'])
+            ys.append(data['y'])
+            flags.append(HAS_XY)
+            data = {key: value for key, value in data.items() if key not in ('x', 'y')}
+        else:
+            xs.append(0)
+            ys.append(0)
+            flags.append(0)
+
+        if data or flags[-1] & WRAPPED:
+            payload += json.dumps(data, separators=(',', ':')).encode()
+        offsets.append(len(payload))
+
+    blob = COUNT.pack(len(events)) + b''.join(
+        _pack(column) for column in (codes, deltas, xs, ys, flags, offsets)
+    ) + bytes(payload)
+
+    return EventChunk(
+        session=session,
+        start_time=start_time,
+        end_time=previous,
+        event_count=len(events),
+        types=types,
+        type_counts=type_counts,
+        columns=zlib.compress(blob, 6),
+    )
+
+
+def decode_chunk(chunk):
+    """Decode a chunk into event dicts shaped like ``Event.objects.values()``."""
+    blob = zlib.decompress(chunk.columns)
+    count, = COUNT.unpack_from(blob)
+    offset = COUNT.size
+    codes, offset = _unpack(blob, offset, 'H', count)
+    deltas, offset = _unpack(blob, offset, 'q', count)
+    xs, offset = _unpack(blob, offset, 'i', count)
+    ys, offset = _unpack(blob, offset, 'i', count)
+    flags, offset = _unpack(blob, offset, 'B', count)
+    offsets, offset = _unpack(blob, offset, 'I', count + 1)
+    payload = blob[offset:]
+
+    events = []
+    micros = accumulate(deltas)
+    for i in range(count):
+        start, end = offsets[i], offsets[i + 1]
+        data = json.loads(payload[start:end]) if end > start else {}
+        if flags[i] & HAS_XY:
+            data = {'x': xs[i], 'y': ys[i], **data}
+        events.append({
+            'id': None,
+            'session_id': chunk.session_id,
+            'type': chunk.types[codes[i]],
+            'timestamp': chunk.start_time + timedelta(microseconds=next(micros)),
+            'data': data,
+        })
+    return events
+
+
+def session_events(session, start=None, end=None, bounds=None):
+    """Return a session's events in ``[start, end)`` ordered by timestamp.
+
+    Compacted chunks and the raw tail are merged transparently; chunk events
+    have ``id`` set to None. ``bounds``, a ``(max_event_id, max_chunk_id)``
+    pair, leaves out rows written after those ids.
+    """
+    chunks = EventChunk.objects.filter(session=session)
+    raw = Event.objects.filter(session=session)
+    if bounds is not None:
+        raw = raw.filter(id__lte=bounds[0])
+        chunks = chunks.filter(id__lte=bounds[1])
+    if start is not None:
+        chunks = chunks.filter(end_time__gte=start)
+        raw = raw.filter(timestamp__gte=start)
+    if end is not None:
+        chunks = chunks.filter(start_time__lt=end)
+        raw = raw.filter(timestamp__lt=end)
+
+    events = []
+    for chunk in chunks:
+        events.extend(
+            event for event in decode_chunk(chunk)
+            if (start is None or event['timestamp'] >= start) and (end is None or event['timestamp'] < end)
+        )
+    events.extend(raw.order_by('timestamp', 'id').values())
+    # Stable sort keeps chunk order for equal timestamps; both inputs are mostly sorted runs
+    events.sort(key=lambda event: event['timestamp'])
+    return events
+
+
+def iter_session_events(session, window=timedelta(minutes=10), bounds=None):
+    """Yield all of a session's events in timestamp order, one time window at a time.
+
+    Keeps memory bounded by the busiest window instead of the whole session.
+    """
+    first, last = session_time_range(session)
+    if first is None:
+        return
+    start = first
+    while start <= last:
+        yield from session_events(session, start, start + window, bounds)
+        start += window
+
+
+def session_time_range(session):
+    """Return the ``(first, last)`` event timestamps across chunks and raw events."""
+    raw = Event.objects.filter(session=session).aggregate(first=Min('timestamp'), last=Max('timestamp'))
+    chunked = EventChunk.objects.filter(session=session).aggregate(first=Min('start_time'), last=Max('end_time'))
+    firsts = [value for value in (raw['first'], chunked['first']) if value is not None]
+    lasts = [value for value in (raw['last'], chunked['last']) if value is not None]
+    return (min(firsts) if firsts else None, max(lasts) if lasts else None)
+
+
+def session_event_count(session):
+    raw = Event.objects.filter(session=session).aggregate(count=Count('id'))['count']
+    chunked = EventChunk.objects.filter(session=session).aggregate(count=Sum('event_count'))['count']
+    return raw + (chunked or 0)
+
+
+def total_event_count():
+    chunked = EventChunk.objects.aggregate(count=Sum('event_count'))['count']
+    return Event.objects.count() + (chunked or 0)
+
+
+def compact_session(session, before, window=timedelta(minutes=1), delete_batch_size=500):
+    """Roll a session's raw events older than ``before`` into chunks.
+
+    Events are grouped into chunks per ``window`` of wall-clock time. Each
+    chunk is written in a short transaction of its own, which deletes
+    exactly the rows it encoded. Returns the number of events compacted.
+    """
+    raw = Event.objects.filter(session=session, timestamp__lt=before)
+    compacted = 0
+    while True:
+        first = raw.aggregate(first=Min('timestamp'))['first']
+        if first is None:
+            return compacted
+        index = _micros(first - session.start_time) // _micros(window)
+        end = min(session.start_time + window * (index + 1), before)
+        events = list(raw.filter(timestamp__lt=end).order_by('timestamp', 'id'))
+        ids = [event.id for event in events]
+
+        # Read outside the transaction, so it starts with the chunk's INSERT (see core/database.py)
+        with transaction.atomic():
+            encode_chunk(session, events).save()
+            deleted = sum(
+                # Events have no dependents, so this is a plain DELETE rather than a per-row collect
+                Event.objects.filter(id__in=ids[i:i + delete_batch_size]).delete()[0]
+                for i in range(0, len(ids), delete_batch_size)
+            )
+            if deleted != len(ids):
+                # Another compaction or a purge removed some of them first; read the window again
+                logger.warning(f'Compaction of session {session.id} raced another delete; retrying window')
+                transaction.set_rollback(True)
+                continue
+        compacted += len(ids)
@@ -0,0 +1,137 @@
+"""
+Compact binary wire format for high-frequency pointer and scroll events.
+
+Instead of one JSON object per sample, the browser packs runs of samples
+into delta-encoded integer columns. A frame is::
+
+    b'CS' | version (u8) | sent_at (u64 ms)
+
+followed by one or more blocks::
+
+    type code (u8) | count (u16) | t0 (u64 ms) | x0 (i32) | y0 (i32)
+    dt[count - 1] (u16) | dx[count - 1] (i16) | dy[count - 1] (i16)
+
+All integers are little-endian. Sample times must lie within MAX_OFFSET_MS
+of ``sent_at``, since they are anchored to the server clock by their offset
+from it. Columns are decoded with ``array`` and
+``itertools.accumulate`` so the per-sample work stays in C.
+"""
+import struct
+import sys
+from array import array
+from itertools import accumulate
+
+PACKED_MAGIC = b'CS'
+PACKED_VERSION = 1
+PACKED_TYPES = {1: 'mousemove', 2: 'scroll'}
+PACKED_CODES = {name: code for code, name in PACKED_TYPES.items()}
+
+FRAME_HEADER = struct.Struct('<2sBQ')
+BLOCK_HEADER = struct.Struct('<BHQii')
+
+MAX_OFFSET_MS = 24 * 60 * 60 * 1000
+
+
+class DecodeError(ValueError):
+    pass
+
+
+def _column(frame, offset, typecode, count):
+    values = array(typecode)
+    end = offset + values.itemsize * count
+    if end > len(frame):
+        raise DecodeError('Truncated packed frame')
+    values.frombytes(frame[offset:end])
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values, end
+
+
+def decode_packed(frame):
+    """Decode a packed frame into ``(sent_at, events)``.
+
+    Events have the same shape as the JSON messages sent by telemetry.js:
+    ``{'type': ..., 'timestamp': ms, 'data': {'x': ..., 'y': ..., 'timestamp': ms}}``.
+    """
+    frame = bytes(frame)
+    if len(frame) < FRAME_HEADER.size:
+        raise DecodeError('Packed frame too short')
+
+    magic, version, sent_at = FRAME_HEADER.unpack_from(frame)
+    if magic != PACKED_MAGIC:
+        raise DecodeError('Not a packed telemetry frame')
+    if version != PACKED_VERSION:
+        raise DecodeError(f'Unsupported packed frame version: {version}')
+
+    events = []
+    offset = FRAME_HEADER.size
+    while offset < len(frame):
+        if offset + BLOCK_HEADER.size > len(frame):
+            raise DecodeError('Truncated packed frame')
+        code, count, t0, x0, y0 = BLOCK_HEADER.unpack_from(frame, offset)
+        offset += BLOCK_HEADER.size
+
+        event_type = PACKED_TYPES.get(code)
+        if event_type is None:
+            raise DecodeError(f'Unknown packed event type code: {code}')
+        if count == 0:
+            continue
+
+        dts, offset = _column(frame, offset, 'H', count - 1)
+        dxs, offset = _column(frame, offset, 'h', count - 1)
+        dys, offset = _column(frame, offset, 'h', count - 1)
+
+        # Times only grow within a block, so its first and last samples bound the rest
+        if abs(t0 - sent_at) > MAX_OFFSET_MS or abs(t0 + sum(dts) - sent_at) > MAX_OFFSET_MS:
+            raise DecodeError('Packed sample time too far from the frame time')
+
+        for t, x, y in zip(accumulate(dts, initial=t0), accumulate(dxs, initial=x0), accumulate(dys, initial=y0)):
+            events.append({'type': event_type, 'timestamp': t, 'data': {'x': x, 'y': y, 'timestamp': t}})
+
+    return sent_at, events
+
+
+def encode_packed(events, sent_at):
+    """Encode pointer events into a packed frame.
+
+    The inverse of ``decode_packed``; runs are split into new blocks whenever
+    the type changes or a delta doesn't fit its column.
+    """
+    frame = bytearray(FRAME_HEADER.pack(PACKED_MAGIC, PACKED_VERSION, int(sent_at)))
+
+    block = []
+    for event in events:
+        if block and (len(block) == 0xFFFF or not _fits(block[-1], event)):
+            frame += _encode_block(block)
+            block = []
+        block.append(event)
+    if block:
+        frame += _encode_block(block)
+    return bytes(frame)
+
+
+def _fits(previous, event):
+    return (
+        previous['type'] == event['type']
+        and 0 <= event['timestamp'] - previous['timestamp'] <= 0xFFFF
+        and -0x8000 <= event['data']['x'] - previous['data']['x'] <= 0x7FFF
+        and -0x8000 <= event['data']['y'] - previous['data']['y'] <= 0x7FFF
+    )
+
+
+def _encode_block(block):
+    first = block[0]
+    columns = [array('H'), array('h'), array('h')]
+    for previous, event in zip(block, block[1:]):
+        columns[0].append(event['timestamp'] - previous['timestamp'])
+        columns[1].append(event['data']['x'] - previous['data']['x'])
+        columns[2].append(event['data']['y'] - previous['data']['y'])
+
+    encoded = bytearray(BLOCK_HEADER.pack(
+        PACKED_CODES[first['type']], len(block), first['timestamp'], first['data']['x'], first['data']['y']
+    ))
+    for column in columns:
+        if sys.byteorder == 'big':
+            column.byteswap()
+        encoded += column.tobytes()
+    return encoded
@@ -1,45 +1,108 @@
+import asyncio
 import json
+import logging
+import time
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.db import DatabaseError
 from django.utils import timezone
-from .models import Session, Event
+from .admission import Admission, acquire_session_slot, get_admission_settings, release_session_slot
+from .codec import DecodeError
+from . import metrics
+from .ingest import ACK_MODES, EventBuffer, create_session, get_buffer_settings, parse_packed
+from .live import FrameCoalescer, get_live_settings, publish_events, publish_session_ended, session_group
+from .models import Session
+from .sampling import SessionSampler, client_policy, get_sampling_settings
+from .snapshots import SnapshotError, upload_snapshot
+from .summaries import close_session
+from .writer import run_in_writer
+
+logger = logging.getLogger(__name__)
 
 class TelemetryConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        await self.accept()
         self.session = None
+        self.buffer = None
+        self.ack_mode = None
+        self.seq = 0
+        # Set before the slot check: frames can arrive before a refused connection's close goes out
+        self.admission = None
+        self.max_frame_bytes = None
+        self.slow_down_until = 0
+        self.slotted = False
+        await self.accept()
+        config = get_admission_settings()
+        if not acquire_session_slot(config):
+            # Accepted first so the client sees the close code rather than a failed handshake
+            metrics.ADMISSION_REJECTED.inc(transport='ws', reason='sessions')
+            logger.warning('Refused telemetry connection: no session slot left in this process')
+            await self.close(code=1013)
+            return
+        self.admission = Admission(config) if config['ENABLED'] else None
+        self.max_frame_bytes = config['MAX_FRAME_BYTES'] if config['ENABLED'] else None
+        self.slotted = True
+        metrics.CONNECTIONS.inc(consumer='telemetry')
 
     async def disconnect(self, close_code):
+        if not self.slotted:
+            return
+        self.slotted = False
+        release_session_slot()
+        metrics.CONNECTIONS.dec(consumer='telemetry')
+        if self.buffer:
+            await self.buffer.close()
         if self.session:
-            await self.end_session()
+            try:
+                await self.end_session()
+            except DatabaseError as e:
+                # Left active for the idle sweeper to close; viewers still learn it ended
+                logger.error(f'Failed to close session {self.session.id}: {e}')
+            await publish_session_ended(self.session.id)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if not await self.admit(len(bytes_data) if bytes_data is not None else len(text_data)):
+            return
 
-    async def receive(self, text_data):
         try:
+            if bytes_data is not None:
+                metrics.BYTES_RECEIVED.inc(len(bytes_data), transport='ws')
+                await self.receive_packed(bytes_data)
+                return
+
+            metrics.BYTES_RECEIVED.inc(len(text_data), transport='ws')
+            started = time.perf_counter()
             data = json.loads(text_data)
-            
+            metrics.DECODE_SECONDS.observe(time.perf_counter() - started, transport='ws')
+
             if not self.session and data.get('type') == 'session_start':
-                # Log the received data
-                print(f"Received session start data - HTML size: {len(data.get('pageHtml', ''))} bytes, Styles size: {len(data.get('pageStyles', ''))} bytes")
-                
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(
+                        f"Received session start data - HTML size: {len(data.get('pageHtml', ''))} bytes, "
+                        f"Styles size: {len(data.get('pageStyles', ''))} bytes"
+                    )
+
                 # Create new session
-                self.session = await self.create_session(data)
-                
-                # Log the created session
-                print(f"Created session {self.session.id} with HTML size: {len(self.session.page_html)} bytes")
-                
-                # Send confirmation
+                self.session, missing = await self.create_session(data)
+                self.start_buffer(data)
+
+                logger.info(f'Created session {self.session.id}, missing snapshots: {missing}')
+
+                # Send confirmation, listing snapshot bodies the client should upload
                 await self.send(json.dumps({
                     'type': 'session_started',
-                    'session_id': str(self.session.id)
+                    'session_id': str(self.session.id),
+                    'ack_mode': self.ack_mode,
+                    'missing_snapshots': missing,
+                    'sampling': client_policy()
                 }))
+            elif self.session and data.get('type') == 'snapshot_upload':
+                await self.upload_snapshot(data)
             elif self.session:
-                # Record event for existing session
-                await self.create_event(data)
-                # Send confirmation
-                await self.send(json.dumps({
-                    'type': 'event_recorded',
-                    'event_type': data.get('type')
-                }))
+                # Buffer event for existing session; acks are sent when the buffer flushes
+                self.seq += 1
+                seq = data.get('seq')
+                await self.buffer.add(data, seq if isinstance(seq, int) else self.seq, timezone.now())
         except json.JSONDecodeError:
             await self.send(json.dumps({
                 'type': 'error',
@@ -51,34 +114,209 @@ class TelemetryConsumer(AsyncWebsocketConsumer):
                 'message': str(e)
             }))
 
-    @database_sync_to_async
-    def create_session(self, data):
-        session = Session.objects.create(
-            page_url=data.get('pageUrl', ''),
-            page_title=data.get('pageTitle', ''),
-            user_agent=data.get('userAgent', ''),
-            screen_width=data.get('screenResolution', {}).get('width', 0),
-            screen_height=data.get('screenResolution', {}).get('height', 0),
-            window_width=data.get('windowSize', {}).get('width', 0),
-            window_height=data.get('windowSize', {}).get('height', 0),
-            page_html=data.get('pageHtml', ''),  # Save the captured HTML
-            page_styles=data.get('pageStyles', '')  # Save the captured styles
+    async def admit(self, size):
+        """Apply the frame size and rate limits; see core/admission.py."""
+        if not self.slotted:
+            # Refused or already disconnected
+            return False
+        if self.max_frame_bytes is not None and size > self.max_frame_bytes:
+            metrics.ADMISSION_REJECTED.inc(transport='ws', reason='too_large')
+            logger.warning(f'Closing telemetry connection: {size} byte frame exceeds {self.max_frame_bytes} bytes')
+            await self.send(json.dumps({
+                'type': 'error',
+                'message': f'Frame of {size} bytes exceeds the {self.max_frame_bytes} byte limit'
+            }))
+            await self.close(code=1009)
+            return False
+        if self.admission is None:
+            return True
+
+        admitted, delay = self.admission.admit()
+        if not admitted:
+            metrics.ADMISSION_REJECTED.inc(transport='ws', reason='rate')
+            metrics.SLOW_DOWN_SENT.inc(transport='ws')
+            # Dropped unacked, so clients that resend unacked events send it again later
+            await self.send(json.dumps({'type': 'slow_down', 'delay_ms': delay, 'dropped': True}))
+            return False
+        now = time.monotonic()
+        if delay is not None and now >= self.slow_down_until:
+            # One hint per delay; the client is already waiting out the last one
+            self.slow_down_until = now + delay / 1000
+            metrics.SLOW_DOWN_SENT.inc(transport='ws')
+            await self.send(json.dumps({'type': 'slow_down', 'delay_ms': delay}))
+        return True
+
+    async def receive_packed(self, frame):
+        # Binary frames carry delta-encoded pointer and scroll samples
+        if not self.session:
+            await self.send(json.dumps({
+                'type': 'error',
+                'message': 'Packed frame received before session_start'
+            }))
+            return
+
+        try:
+            with metrics.DECODE_SECONDS.time(transport='ws_packed'):
+                events = parse_packed(frame)
+        except DecodeError as e:
+            await self.send(json.dumps({
+                'type': 'error',
+                'message': f'Invalid packed frame: {e}'
+            }))
+            return
+
+        for _, event, timestamp in events:
+            self.seq += 1
+            await self.buffer.add(event, self.seq, timestamp)
+
+    def start_buffer(self, data):
+        config = get_buffer_settings()
+        # Clients may opt into a different ack mode in their session_start message
+        self.ack_mode = data.get('ackMode') if data.get('ackMode') in ACK_MODES else config['ACK_MODE']
+        sampling = get_sampling_settings()
+        self.buffer = EventBuffer(
+            self.session,
+            max_events=config['MAX_EVENTS'],
+            max_age=config['MAX_AGE'],
+            on_flush=self.events_recorded,
+            on_error=self.send_flush_error,
+            sampler=SessionSampler(sampling) if sampling['ENABLED'] else None
         )
-        return session
 
-    @database_sync_to_async
-    def create_event(self, data):
+    async def events_recorded(self, batch, stored):
+        # Events the sampler dropped are acked too; the client has nothing to resend
+        await self.send_acks([(seq, event.type) for seq, event in batch])
+        # Live viewers of this session, on any worker
+        if stored:
+            await publish_events(self.session.id, stored)
+
+    async def send_acks(self, recorded):
+        if self.ack_mode == 'cumulative':
+            await self.send(json.dumps({
+                'type': 'events_recorded',
+                'seq': max(seq for seq, _ in recorded),
+                'count': len(recorded)
+            }))
+            return
+
+        for seq, event_type in recorded:
+            await self.send(json.dumps({
+                'type': 'event_recorded',
+                'event_type': event_type,
+                'seq': seq
+            }))
+
+    async def send_flush_error(self, error):
+        await self.send(json.dumps({
+            'type': 'error',
+            'message': f'Failed to record events: {error}'
+        }))
+
+    async def upload_snapshot(self, data):
+        try:
+            await run_in_writer(upload_snapshot, data.get('hash'), data.get('content'), kind='snapshot')
+        except SnapshotError as e:
+            await self.send(json.dumps({
+                'type': 'error',
+                'message': str(e)
+            }))
+            return
+        await self.send(json.dumps({
+            'type': 'snapshot_stored',
+            'hash': data.get('hash')
+        }))
+
+    async def create_session(self, data):
+        return await run_in_writer(create_session, data, kind='session')
+
+    async def end_session(self):
         if self.session:
-            Event.objects.create(
-                session=self.session,
-                type=data.get('type', 'unknown'),
-                timestamp=timezone.now(),
-                data=data.get('data', {})
-            )
+            await run_in_writer(close_session, self.session, kind='session')
+
+
+class LiveSessionConsumer(AsyncWebsocketConsumer):
+    """Streams a session's events to a viewer as they are recorded.
+
+    Events arrive through the session's channel-layer group and are sent as
+    ``frame`` messages at most ``fps`` times a second (``?fps=`` in the URL,
+    capped at MAX_FPS). The viewer acks each frame with
+    ``{"type": "ack", "frame": n}``; while MAX_UNACKED frames are
+    unacknowledged nothing is sent and new events keep being coalesced, so a
+    slow viewer sees fewer, denser frames instead of a growing backlog.
+    """
+
+    async def connect(self):
+        self.session_id = str(self.scope['url_route']['kwargs']['session_id'])
+        self.sender = None
+        session = await self.get_session()
+        if session is None:
+            await self.close(code=4404)
+            return
+
+        config = get_live_settings()
+        try:
+            fps = int(parse_qs(self.scope['query_string'].decode()).get('fps', [config['FPS']])[0])
+        except ValueError:
+            fps = config['FPS']
+        fps = max(1, min(fps, config['MAX_FPS']))
+        self.frame_interval = 1 / fps
+        self.max_unacked = config['MAX_UNACKED']
+        self.coalescer = FrameCoalescer(config['MAX_PENDING'])
+        self.frame = 0
+        self.acked = 0
+        self.ended = False
+        self.wakeup = asyncio.Event()
+
+        await self.channel_layer.group_add(session_group(self.session_id), self.channel_name)
+        await self.accept()
+        metrics.CONNECTIONS.inc(consumer='live')
+        await self.send(json.dumps({
+            'type': 'live_started',
+            'session_id': self.session_id,
+            'is_active': session.is_active,
+            'fps': fps
+        }))
+        self.sender = asyncio.ensure_future(self.send_frames())
+
+    async def disconnect(self, close_code):
+        if self.sender:
+            metrics.CONNECTIONS.dec(consumer='live')
+            self.sender.cancel()
+            await self.channel_layer.group_discard(session_group(self.session_id), self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = json.loads(text_data or '')
+        except json.JSONDecodeError:
+            return
+        if data.get('type') == 'ack' and isinstance(data.get('frame'), int):
+            self.acked = max(self.acked, min(data['frame'], self.frame))
+            self.wakeup.set()
+
+    async def session_events(self, message):
+        self.coalescer.add(message['events'])
+        self.wakeup.set()
+
+    async def session_ended(self, message):
+        self.ended = True
+        self.wakeup.set()
+
+    async def send_frames(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            if self.coalescer and not (self.max_unacked and self.frame - self.acked >= self.max_unacked):
+                self.frame += 1
+                await self.send(json.dumps({'type': 'frame', 'frame': self.frame, **self.coalescer.take()}))
+            elif self.coalescer:
+                # Wait for an ack; events keep coalescing in the meantime
+                continue
+            if self.ended:
+                await self.send(json.dumps({'type': 'session_ended'}))
+                await self.close()
+                return
+            await asyncio.sleep(self.frame_interval)
 
     @database_sync_to_async
-    def end_session(self):
-        if self.session:
-            self.session.end_time = timezone.now()
-            self.session.is_active = False
-            self.session.save()
+    def get_session(self):
+        return Session.objects.only('id', 'is_active').filter(id=self.session_id).first()
@@ -0,0 +1,93 @@
+"""
+Database tuning for the two supported profiles.
+
+SQLite connections get the PRAGMAs in ``TELEMETRY_SQLITE_PRAGMAS`` as they
+are opened: WAL journaling lets replay reads run alongside ingest writes,
+``synchronous=NORMAL`` skips the per-commit fsync WAL makes unnecessary, and
+a busy timeout makes a locked database wait instead of failing.
+
+The wait only helps transactions that start with a write. One that reads
+and then writes fails at once with "database is locked" if another
+connection committed in between. So transactions that can race other
+writers write first: upserts try an UPDATE, then fall back to an
+``ignore_conflicts`` insert, instead of ``update_or_create``.
+
+On PostgreSQL the event table is range-partitioned by month on
+``timestamp`` (migration 0010). ``create_event_partitions`` adds the monthly
+partitions ahead of time; rows outside every partition land in
+``core_event_default``.
+"""
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db.models import BigIntegerField, Func
+
+SQLITE_PRAGMA_DEFAULTS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'busy_timeout': 5000,  # Milliseconds to wait on a lock held by another connection
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -32000,  # Negative values are KiB
+    'temp_store': 'memory',
+}
+
+EVENT_TABLE = 'core_event'
+
+
+def get_sqlite_pragmas():
+    return {**SQLITE_PRAGMA_DEFAULTS, **getattr(settings, 'TELEMETRY_SQLITE_PRAGMAS', {})}
+
+
+def configure_connection(connection):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, value in get_sqlite_pragmas().items():
+            # PRAGMA values can't be bound as parameters; they come from settings only
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+
+class EpochSeconds(Func):
+    """Whole seconds since the epoch of a datetime column, computed in SQL."""
+    output_field = BigIntegerField()
+    template = 'CAST(FLOOR(EXTRACT(EPOCH FROM %(expressions)s)) AS BIGINT)'
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        # Doubled twice: once for this template, once for the backend's parameter style
+        return self.as_sql(compiler, connection, template="CAST(STRFTIME('%%%%s', %(expressions)s) AS INTEGER)",
+                           **extra_context)
+
+
+def month_start(value):
+    return datetime(value.year, value.month, 1, tzinfo=dt_timezone.utc)
+
+
+def next_month(value):
+    return datetime(value.year + value.month // 12, value.month % 12 + 1, 1, tzinfo=dt_timezone.utc)
+
+
+def is_partitioned(connection, table=EVENT_TABLE):
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)', [table])
+        return cursor.fetchone() is not None
+
+
+def create_event_partitions(connection, start, end):
+    """Create the monthly event partitions covering ``[start, end)``. Returns the names created."""
+    created = []
+    month = month_start(start)
+    with connection.cursor() as cursor:
+        while month < end:
+            following = next_month(month)
+            name = f'{EVENT_TABLE}_y{month.year}m{month.month:02d}'
+            cursor.execute('SELECT to_regclass(%s)', [name])
+            if cursor.fetchone()[0] is None:
+                cursor.execute(
+                    f"CREATE TABLE {name} PARTITION OF {EVENT_TABLE} "
+                    f"FOR VALUES FROM ('{month.isoformat()}') TO ('{following.isoformat()}')"
+                )
+                created.append(name)
+            month = following
+    return created
@@ -0,0 +1,81 @@
+"""
+Incremental DOM recording: full ``dom_snapshot`` trees and ``dom_mutation`` diffs.
+
+telemetry.js gives every recorded DOM node a numeric id and sends two event
+types besides the session's static ``pageHtml``:
+
+- ``dom_snapshot`` ``{"tree": node}``: the whole document, right after the
+  session starts and then every so often while the page keeps changing. A
+  node is ``{"id", "tag", "ns"?, "attrs", "children"}`` for elements and
+  ``{"id", "text"}`` for text; scripts and comments are left out.
+- ``dom_mutation`` ``{"ops": [...]}``: what a MutationObserver saw during
+  one animation frame, addressed by node id. Ops are ``["remove", id]``,
+  ``["add", parent_id, after_id, node]`` (``after_id`` null for the first
+  child), ``["attr", id, name, value]`` (value null when removed) and
+  ``["text", id, text]``, and are applied in order.
+
+Snapshot trees are big and repeat (a page changing back, every session of
+the same app), so ``store_dom_snapshots`` moves each tree into a
+content-addressed SnapshotBlob (core/snapshots.py) referenced once per
+session, and the stored event keeps only ``{"hash", "size"}``. Replay
+reads put the tree back with ``expand_dom_snapshots``. Events published to
+live viewers are the received ones and carry their tree inline.
+
+The replay index (core/replay.py) records the last snapshot before each
+keyframe, so a seek rebuilds the DOM from that snapshot and the mutations
+after it instead of from the start of the session.
+"""
+import json
+
+from .models import Event, SnapshotBlob
+from .snapshots import attach_snapshot
+
+DOM_SNAPSHOT = 'dom_snapshot'
+DOM_MUTATION = 'dom_mutation'
+DOM_TYPES = (DOM_SNAPSHOT, DOM_MUTATION)
+
+
+def snapshot_tree(event_type, data):
+    """Return the inline tree of a ``dom_snapshot`` event's data, or None."""
+    if event_type != DOM_SNAPSHOT or not isinstance(data, dict):
+        return None
+    return data.get('tree')
+
+
+def store_dom_snapshots(events):
+    """Return the Event rows to store for ``events``, with DOM snapshot trees moved to blobs.
+
+    The events passed in are left as they are, tree included.
+    """
+    if not any(event.type == DOM_SNAPSHOT for event in events):
+        return events
+    stored = []
+    for event in events:
+        tree = snapshot_tree(event.type, event.data)
+        if tree is None:
+            stored.append(event)
+            continue
+        content = json.dumps(tree, separators=(',', ':'))
+        blob = attach_snapshot(event.session_id, content)
+        stored.append(Event(
+            session_id=event.session_id,
+            type=event.type,
+            timestamp=event.timestamp,
+            data={'hash': blob.hash, 'size': len(content)},
+        ))
+    return stored
+
+
+def expand_dom_snapshots(events):
+    """Yield event dicts with each stored DOM snapshot reference replaced by its tree."""
+    cached_hash = cached_tree = None
+    for event in events:
+        data = event['data']
+        if event['type'] == DOM_SNAPSHOT and isinstance(data, dict) and 'hash' in data and 'tree' not in data:
+            # Consecutive snapshots of an unchanged page share a blob; load it once
+            if data['hash'] != cached_hash:
+                blob = SnapshotBlob.objects.filter(hash=data['hash']).first()
+                content = blob.content if blob is not None else None
+                cached_hash, cached_tree = data['hash'], json.loads(content) if content else None
+            event = {**event, 'data': {**data, 'tree': cached_tree}}
+        yield event
@@ -0,0 +1,252 @@
+"""
+Event ingestion shared by the telemetry consumer and the HTTP endpoint.
+
+Events received on a connection are collected in memory and written with a
+single ``bulk_create`` once the buffer reaches a size or age limit, instead
+of one INSERT per WebSocket message. HTTP batches are validated here and
+written through the same ``store_events``, which goes to the write-ahead
+spool (core/spool.py) instead of the database when that is enabled.
+"""
+import asyncio
+import logging
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import metrics, stats
+
+from .backends import get_backends
+from .bundles import discard_stale_bundles
+from .codec import decode_packed
+from .dom import DOM_TYPES, store_dom_snapshots
+from .models import Event, Session, SessionSummary
+from .search import index_events, index_session
+from .snapshots import missing_snapshots, reference_snapshot
+from .spool import encode_record, get_spool_writer
+from .summaries import update_summaries
+from .writer import run_in_writer
+
+logger = logging.getLogger(__name__)
+
+BUFFER_DEFAULTS = {
+    'MAX_EVENTS': 100,   # Flush once this many events are pending
+    'MAX_AGE': 1.0,      # Flush pending events after this many seconds
+    'ACK_MODE': 'event', # 'event' (one ack per event) or 'cumulative'
+}
+
+ACK_MODES = ('event', 'cumulative')
+
+BATCH_DEFAULTS = {
+    'MAX_EVENTS': 500,  # Largest batch envelope the HTTP endpoint accepts
+}
+
+# Event types the HTTP endpoint accepts, singly or inside a batch envelope
+EVENT_TYPES = ('click', 'mousemove', 'keypress', 'scroll', 'resize', 'input', 'visibility', 'error', *DOM_TYPES)
+
+
+class BatchError(ValueError):
+    pass
+
+
+def get_buffer_settings():
+    return {**BUFFER_DEFAULTS, **getattr(settings, 'TELEMETRY_BUFFER', {})}
+
+
+def get_batch_settings():
+    return {**BATCH_DEFAULTS, **getattr(settings, 'TELEMETRY_BATCH', {})}
+
+
+def parse_batch(data, received_at=None):
+    """Validate a batch envelope and return ``(seq, event, timestamp)`` tuples.
+
+    Event times are taken relative to the envelope's ``sentAt`` and anchored
+    to the server clock, so a skewed browser clock doesn't reorder events
+    across batches.
+    """
+    events = data.get('events')
+    if not isinstance(events, list) or not events:
+        raise BatchError('Batch must contain a non-empty events list')
+
+    max_events = get_batch_settings()['MAX_EVENTS']
+    if len(events) > max_events:
+        raise BatchError(f'Batch exceeds {max_events} events')
+
+    received_at = received_at or timezone.now()
+    sent_at = data.get('sentAt')
+
+    parsed = []
+    for index, event in enumerate(events):
+        if not isinstance(event, dict):
+            raise BatchError(f'Event {index} is not an object')
+        if event.get('type') not in EVENT_TYPES:
+            raise BatchError(f"Event {index} has unknown type: {event.get('type')}")
+        if not isinstance(event.get('data', {}), dict):
+            raise BatchError(f'Event {index} data must be an object')
+
+        client_ms = event.get('timestamp')
+        if isinstance(client_ms, (int, float)) and isinstance(sent_at, (int, float)):
+            timestamp = received_at + timedelta(milliseconds=client_ms - sent_at)
+        else:
+            timestamp = received_at
+
+        seq = event.get('seq')
+        parsed.append((seq if isinstance(seq, int) else index, event, timestamp))
+    return parsed
+
+
+def parse_packed(frame, received_at=None):
+    """Decode a packed pointer frame into ``(seq, event, timestamp)`` tuples.
+
+    Timestamps are anchored to the server clock the same way as batches,
+    using the frame's ``sent_at`` header. Raises ``codec.DecodeError``.
+    """
+    received_at = received_at or timezone.now()
+    sent_at, events = decode_packed(frame)
+    return [
+        (index, event, received_at + timedelta(milliseconds=event['timestamp'] - sent_at))
+        for index, event in enumerate(events, start=1)
+    ]
+
+
+def create_session(data):
+    """Create a Session from a session_start message.
+
+    Snapshots are sent either in full (``pageHtml``/``pageStyles``) or as
+    SHA-256 hashes (``pageHtmlHash``/``pageStylesHash``). Returns the session
+    and the hashes whose bodies the client still needs to upload.
+    """
+    html_blob = reference_snapshot(data.get('pageHtml'), data.get('pageHtmlHash'))
+    styles_blob = reference_snapshot(data.get('pageStyles'), data.get('pageStylesHash'))
+    session = Session.objects.create(
+        page_url=data.get('pageUrl', ''),
+        page_title=data.get('pageTitle', ''),
+        user_agent=data.get('userAgent', ''),
+        screen_width=data.get('screenResolution', {}).get('width', 0),
+        screen_height=data.get('screenResolution', {}).get('height', 0),
+        window_width=data.get('windowSize', {}).get('width', 0),
+        window_height=data.get('windowSize', {}).get('height', 0),
+        page_html_blob=html_blob,
+        page_styles_blob=styles_blob
+    )
+    # Created up front so the first batch only has to update it
+    SessionSummary.objects.create(session=session)
+    index_session(session)
+    stats.increment(stats.SESSIONS)
+    stats.increment(stats.ACTIVE_SESSIONS)
+    return session, missing_snapshots(html_blob, styles_blob)
+
+
+def build_event(session, data, timestamp=None):
+    """Build an unsaved Event row from a telemetry message."""
+    event_type = data.get('type', 'unknown')
+    # WebSocket messages aren't checked against EVENT_TYPES, so keep the label set bounded
+    metrics.EVENTS_RECEIVED.inc(type=event_type if event_type in EVENT_TYPES else 'other')
+    return Event(
+        session=session,
+        type=event_type,
+        timestamp=timestamp or timezone.now(),
+        data=data.get('data', {})
+    )
+
+
+def record_events(events):
+    """Write events to every configured storage backend (see core/backends.py), session summaries and the search index."""
+    with metrics.WRITE_SECONDS.time(sink='database'), transaction.atomic():
+        # DOM snapshot trees go to blobs; the events passed in keep them for live viewers
+        stored = store_dom_snapshots(events)
+        for backend in get_backends():
+            backend.write_events(stored)
+        update_summaries(events)
+        index_events(events)
+        discard_stale_bundles({event.session_id for event in events})
+
+
+def store_events(events):
+    """Append events to the write-ahead spool when it is enabled, else write them through."""
+    writer = get_spool_writer()
+    if writer is not None:
+        with metrics.WRITE_SECONDS.time(sink='spool'):
+            writer.write(encode_record(events))
+    else:
+        record_events(events)
+
+
+async def write_events(events):
+    if get_spool_writer() is not None:
+        # Off the shared sync thread, so concurrent connections' appends share one fsync
+        await sync_to_async(store_events, thread_sensitive=False)(events)
+    else:
+        await run_in_writer(record_events, events, kind='events')
+
+
+class EventBuffer:
+    """Collects events for one session and flushes them in batches.
+
+    ``on_flush`` is awaited with the list of ``(seq, event)`` pairs that
+    were flushed and the events actually stored, which is fewer when a
+    ``sampler`` (core/sampling.py) reduced the batch. ``on_error`` is awaited
+    with the exception when a write fails.
+    """
+
+    def __init__(self, session, max_events, max_age, on_flush=None, on_error=None, sampler=None):
+        self.session = session
+        self.sampler = sampler
+        self.max_events = max_events
+        self.max_age = max_age
+        self.on_flush = on_flush
+        self.on_error = on_error
+        self.pending = []
+        self._lock = asyncio.Lock()
+        self._timer = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    async def add(self, data, seq, timestamp=None):
+        self.pending.append((seq, build_event(self.session, data, timestamp)))
+        metrics.BUFFER_PENDING.inc()
+
+        if len(self.pending) >= self.max_events:
+            self._cancel_timer()
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.ensure_future(self._flush_later())
+
+    async def flush(self):
+        async with self._lock:
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, []
+            metrics.BUFFER_PENDING.dec(len(batch))
+            events = [event for _, event in batch]
+            if self.sampler:
+                events = self.sampler.reduce(events)
+            try:
+                if events:
+                    await write_events(events)
+            except Exception as e:
+                logger.error(f'Failed to write {len(events)} events for session {self.session.id}: {e}')
+                if self.on_error:
+                    await self.on_error(e)
+                return
+
+        if self.on_flush:
+            await self.on_flush(batch, events)
+
+    async def close(self):
+        self._cancel_timer()
+        await self.flush()
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.max_age)
+        # Clear the handle first so a size-triggered flush can't cancel us mid-write
+        self._timer = None
+        await self.flush()
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
@@ -0,0 +1,242 @@
+"""
+A channel layer shared by every worker process on one host.
+
+InMemoryChannelLayer only reaches consumers in its own process, so once
+several Daphne workers run side by side a live viewer connected to one of
+them never sees events ingested by another. SQLiteChannelLayer keeps
+messages and group memberships in a SQLite file (WAL mode) that all the
+workers open:
+
+- Every layer instance has a client prefix, and its consumers' channels are
+  named ``specific.<prefix>!<id>``. A single poller task per process claims
+  all messages addressed to that prefix with one indexed DELETE ... RETURNING
+  and hands them to per-channel queues, so the polling cost depends on the
+  number of processes, not connections.
+- Messages on plain channels (no ``!``) are claimed by whichever receiver
+  polls first.
+
+Messages must be JSON-serializable.
+"""
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS messages ('
+    ' id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT NOT NULL, prefix TEXT NOT NULL,'
+    ' expires REAL NOT NULL, body TEXT NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS messages_prefix ON messages (prefix, id)',
+    'CREATE INDEX IF NOT EXISTS messages_channel ON messages (channel)',
+    'CREATE TABLE IF NOT EXISTS memberships ('
+    ' "group" TEXT NOT NULL, channel TEXT NOT NULL, joined REAL NOT NULL, PRIMARY KEY ("group", channel))',
+    'CREATE INDEX IF NOT EXISTS memberships_channel ON memberships (channel)',
+)
+
+
+def non_local_name(channel):
+    # 'specific.abc!xyz' is delivered through the process that owns 'specific.abc!'
+    return channel[:channel.index('!') + 1] if '!' in channel else channel
+
+
+class SQLiteChannelLayer(BaseChannelLayer):
+    extensions = ['groups', 'flush']
+
+    def __init__(self, path, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None,
+                 poll_interval=0.01, cleanup_interval=30, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.path = str(path)
+        self.group_expiry = group_expiry
+        self.poll_interval = poll_interval
+        self.cleanup_interval = cleanup_interval
+        self.client_prefix = uuid.uuid4().hex[:12]
+        # One thread owns the connection, so calls are serialized without locking
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='channel-layer')
+        self._db = None
+        self._loop = None
+        self._poller = None
+        self._queues = {}
+        self._prefixes = {f'specific.{self.client_prefix}!'}  # Non-local names the poller claims
+        self._last_cleanup = 0.0
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        assert '__asgi_channel__' not in message
+        body = json.dumps(message)
+        if not await self._run(self._send, channel, body):
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        if '!' not in channel:
+            return await self._receive_plain(channel)
+
+        self._bind_loop()
+        queue = self._queues.setdefault(channel, asyncio.Queue())
+        try:
+            while True:
+                expires, message = await queue.get()
+                if expires >= time.time():
+                    return message
+        finally:
+            if queue.empty() and self._queues.get(channel) is queue:
+                del self._queues[channel]
+
+    async def new_channel(self, prefix='specific'):
+        self._prefixes.add(f'{prefix}.{self.client_prefix}!')
+        return f'{prefix}.{self.client_prefix}!{uuid.uuid4().hex[:12]}'
+
+    async def flush(self):
+        await self._run(self._flush)
+        self._queues = {}
+
+    async def close(self):
+        if self._poller is not None:
+            self._poller.cancel()
+            self._poller = None
+        await self._run(self._close)
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        await self._run(self._execute, 'INSERT OR REPLACE INTO memberships VALUES (?, ?, ?)',
+                        [group, channel, time.time()])
+
+    async def group_discard(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        await self._run(self._execute, 'DELETE FROM memberships WHERE "group" = ? AND channel = ?',
+                        [group, channel])
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        assert self.valid_group_name(group), 'Group name not valid'
+        await self._run(self._group_send, group, json.dumps(message))
+
+    # Event loop side
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Queues and the poller belong to one event loop; tests and async_to_sync may bring new ones
+            self._loop = loop
+            self._queues = {}
+            self._poller = None
+        if self._poller is None or self._poller.done():
+            self._poller = loop.create_task(self._poll())
+
+    async def _poll(self):
+        while True:
+            try:
+                rows = await self._run(self._claim, sorted(self._prefixes))
+            except sqlite3.Error as e:
+                logger.error(f'Channel layer poll failed: {e}')
+                rows = []
+            for channel, expires, body in rows:
+                queue = self._queues.setdefault(channel, asyncio.Queue())
+                if queue.qsize() >= self.get_capacity(channel):
+                    # The receiver isn't keeping up; drop rather than grow without bound
+                    continue
+                queue.put_nowait((expires, json.loads(body)))
+            if not rows:
+                await asyncio.sleep(self.poll_interval)
+
+    async def _receive_plain(self, channel):
+        while True:
+            rows = await self._run(self._claim, [channel], 1)
+            if rows:
+                return json.loads(rows[0][2])
+            await asyncio.sleep(self.poll_interval)
+
+    # Database side, always on the executor thread
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode = wal')
+            self._db.execute('PRAGMA synchronous = normal')
+            for statement in SCHEMA:
+                self._db.execute(statement)
+        return self._db
+
+    def _execute(self, sql, params=()):
+        return self._connect().execute(sql, params)
+
+    def _send(self, channel, body):
+        db = self._connect()
+        count, = db.execute('SELECT COUNT(*) FROM messages WHERE channel = ?', [channel]).fetchone()
+        if count >= self.get_capacity(channel):
+            return False
+        db.execute('INSERT INTO messages (channel, prefix, expires, body) VALUES (?, ?, ?, ?)',
+                   [channel, non_local_name(channel), time.time() + self.expiry, body])
+        return True
+
+    def _group_send(self, group, body):
+        db = self._connect()
+        channels = [row[0] for row in db.execute('SELECT channel FROM memberships WHERE "group" = ?', [group])]
+        if not channels:
+            return
+        placeholders = ','.join('?' * len(channels))
+        queued = dict(db.execute(
+            f'SELECT channel, COUNT(*) FROM messages WHERE channel IN ({placeholders}) GROUP BY channel', channels
+        ))
+        expires = time.time() + self.expiry
+        # Members at capacity miss this message, as with the other layers
+        rows = [
+            (channel, non_local_name(channel), expires, body)
+            for channel in channels if queued.get(channel, 0) < self.get_capacity(channel)
+        ]
+        db.execute('BEGIN')
+        db.executemany('INSERT INTO messages (channel, prefix, expires, body) VALUES (?, ?, ?, ?)', rows)
+        db.execute('COMMIT')
+
+    def _claim(self, prefixes, limit=-1):
+        db = self._connect()
+        now = time.time()
+        if now - self._last_cleanup >= self.cleanup_interval:
+            self._cleanup(now)
+        placeholders = ','.join('?' * len(prefixes))
+        rows = db.execute(
+            f'DELETE FROM messages WHERE id IN (SELECT id FROM messages WHERE prefix IN ({placeholders}) '
+            'ORDER BY id LIMIT ?) RETURNING id, channel, expires, body', [*prefixes, limit]
+        ).fetchall()
+        # RETURNING order is unspecified; deliver in send order
+        rows.sort()
+        return [(channel, expires, body) for _, channel, expires, body in rows if expires >= now]
+
+    def _cleanup(self, now):
+        db = self._connect()
+        db.execute('BEGIN')
+        # A channel with expired messages is gone, so it leaves its groups
+        db.execute('DELETE FROM memberships WHERE channel IN (SELECT channel FROM messages WHERE expires < ?)', [now])
+        db.execute('DELETE FROM messages WHERE expires < ?', [now])
+        db.execute('DELETE FROM memberships WHERE joined < ?', [now - self.group_expiry])
+        db.execute('COMMIT')
+        self._last_cleanup = now
+
+    def _flush(self):
+        db = self._connect()
+        db.execute('DELETE FROM messages')
+        db.execute('DELETE FROM memberships')
+
+    def _close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -0,0 +1,116 @@
+"""
+Fan-out of ingested events to live viewers.
+
+Every recorded batch is published to its session's channel-layer group, so
+viewers connected to any worker process receive it as long as the layer
+spans processes (see core/layers.py). Each LiveSessionConsumer folds what
+it receives into frames with a FrameCoalescer and sends at most ``FPS``
+frames a second, so a busy session costs a viewer a bounded amount of
+memory and bandwidth.
+"""
+import logging
+from collections import deque
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+LIVE_DEFAULTS = {
+    'FPS': 20,  # Frames per second sent to a viewer unless it asks for another rate
+    'MAX_FPS': 60,
+    'MAX_PENDING': 500,  # Discrete events held per viewer between frames; the oldest are dropped beyond this
+    'MAX_UNACKED': 3,  # Frames sent ahead of the viewer's acks before sending pauses (0 disables)
+}
+
+# Only the latest of these matters to a viewer, so a frame carries at most one of each
+COALESCED_TYPES = ('mousemove', 'scroll', 'resize')
+
+
+def get_live_settings():
+    return {**LIVE_DEFAULTS, **getattr(settings, 'TELEMETRY_LIVE', {})}
+
+
+def session_group(session_id):
+    return f'session.{session_id}'
+
+
+def serialize_event(event):
+    return {
+        'type': event.type,
+        'timestamp': int(event.timestamp.timestamp() * 1000),
+        'data': event.data,
+    }
+
+
+async def publish_events(session_id, events):
+    layer = get_channel_layer()
+    if layer is None or not events:
+        return
+    try:
+        await layer.group_send(session_group(session_id), {
+            'type': 'session.events',
+            'events': [serialize_event(event) for event in events],
+        })
+    except Exception as e:
+        # Live viewing is best effort; never fail ingest over it
+        logger.warning(f'Failed to publish {len(events)} events for session {session_id}: {e}')
+
+
+def publish_events_sync(session_id, events):
+    async_to_sync(publish_events)(session_id, events)
+
+
+async def publish_session_ended(session_id):
+    layer = get_channel_layer()
+    if layer is None:
+        return
+    try:
+        await layer.group_send(session_group(session_id), {'type': 'session.ended'})
+    except Exception as e:
+        logger.warning(f'Failed to publish the end of session {session_id}: {e}')
+
+
+class FrameCoalescer:
+    """Collects a session's events for one viewer until the next frame is sent.
+
+    Pointer, scroll and resize events are reduced to their latest value.
+    Other events are kept in order up to ``max_pending``, after which the
+    oldest are dropped; frames report how many events were coalesced or
+    dropped since the previous one.
+    """
+
+    def __init__(self, max_pending):
+        self.max_pending = max_pending
+        self.latest = {}
+        self.pending = deque()
+        self.coalesced = 0
+        self.dropped = 0
+
+    def __bool__(self):
+        return bool(self.latest or self.pending)
+
+    def add(self, events):
+        for event in events:
+            if event['type'] in COALESCED_TYPES:
+                if event['type'] in self.latest:
+                    self.coalesced += 1
+                self.latest[event['type']] = event
+                continue
+            if len(self.pending) >= self.max_pending:
+                self.pending.popleft()
+                self.dropped += 1
+            self.pending.append(event)
+
+    def take(self):
+        frame = {
+            'events': sorted([*self.pending, *self.latest.values()], key=lambda event: event['timestamp']),
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+        }
+        self.latest = {}
+        self.pending = deque()
+        self.coalesced = 0
+        self.dropped = 0
+        return frame
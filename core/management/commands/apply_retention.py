@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.retention import apply_retention
+
+
+class Command(BaseCommand):
+    help = 'Archive, purge and delete sessions according to TELEMETRY_RETENTION'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report what would be done without changing anything')
+        parser.add_argument('--limit', type=int, help='Archive at most this many sessions per run')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Keep running, applying the policy every this many seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            result = apply_retention(dry_run=options['dry_run'], limit=options['limit'])
+            prefix = 'Would have ' if options['dry_run'] else ''
+            self.stdout.write(self.style.SUCCESS(
+                f"{prefix}archived {result['archived']} sessions ({result['archived_events']} events), "
+                f"re-purged {result['repurged']} restored sessions, deleted {result['deleted']} sessions"
+            ))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
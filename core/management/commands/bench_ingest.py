@@ -0,0 +1,101 @@
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.bench import DEFAULT_MIX, ingest_benchmark, parse_mix
+
+
+class Command(BaseCommand):
+    help = 'Drive the telemetry endpoints with synthetic browser sessions and report ingest capacity'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='Base URL of a running server (default: start one with runworkers)')
+        parser.add_argument('--server-pid', type=int, help='PID of the server given by --url, to report its RSS')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Worker processes for the server this command starts (default: 1)')
+        parser.add_argument('--transport', choices=('ws', 'http', 'both'), default='both',
+                            help='Protocol the sessions speak (default: both, one run each)')
+        parser.add_argument('--sessions', type=int, default=50, help='Concurrent sessions (default: 50)')
+        parser.add_argument('--duration', type=float, default=30, help='Seconds each run sends events (default: 30)')
+        parser.add_argument('--rate', type=float, default=20, help='Events per second per session (default: 20)')
+        parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                            help='Event type weights, e.g. mousemove=60,scroll=20,click=10 (default: %(default)s)')
+        parser.add_argument('--ramp-up', type=float, default=2, help='Seconds over which sessions connect (default: 2)')
+        parser.add_argument('--flush-interval', type=float, default=2,
+                            help='Seconds between HTTP batch posts per session, as telemetry.js (default: 2)')
+        parser.add_argument('--seed', type=int, help='Random seed for reproducible event streams')
+        parser.add_argument('--json', action='store_true', help='Print the reports as JSON')
+
+    def handle(self, *args, **options):
+        server = None
+        url, pid = options['url'], options['server_pid']
+        if not url:
+            server, url = self.start_server(options['workers'], options['verbosity'] > 1)
+            pid = server.pid
+
+        transports = ('ws', 'http') if options['transport'] == 'both' else (options['transport'],)
+        reports = []
+        try:
+            for transport in transports:
+                if not options['json']:
+                    self.stdout.write(f'Running {transport} with {options["sessions"]} sessions for {options["duration"]}s...')
+                reports.append(ingest_benchmark(
+                    url, transport, options['sessions'], options['duration'], options['rate'], options['mix'],
+                    server_pid=pid, ramp_up=options['ramp_up'], flush_interval=options['flush_interval'],
+                    seed=options['seed'],
+                ))
+        finally:
+            if server is not None:
+                server.send_signal(signal.SIGTERM)
+                server.wait(timeout=30)
+
+        if options['json']:
+            self.stdout.write(json.dumps(reports, indent=2))
+            return
+        for report in reports:
+            self.write_report(report)
+
+    def start_server(self, workers, verbose):
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        manage = os.path.join(settings.BASE_DIR, 'manage.py')
+        # The access log would drown the report; show it with --verbosity 2
+        output = None if verbose else subprocess.DEVNULL
+        server = subprocess.Popen(
+            [sys.executable, manage, 'runworkers', '--workers', str(workers), '--port', str(port)],
+            stdout=output, stderr=output,
+        )
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise CommandError(f'Server exited with status {server.returncode}')
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return server, f'http://127.0.0.1:{port}'
+            except OSError:
+                time.sleep(0.2)
+        server.terminate()
+        raise CommandError('Server did not start accepting connections within 30s')
+
+    def write_report(self, report):
+        def ms(value):
+            return f'{value:.1f} ms' if value is not None else '-'
+
+        def mb(value):
+            return f'{value / 1024 / 1024:.0f} MB' if value else '-'
+
+        self.stdout.write(self.style.SUCCESS(f'{report["transport"]}: {report["sessions"]} sessions, {report["elapsed"]:.1f}s'))
+        self.stdout.write(f'  events sent/acked   {report["events_sent"]} / {report["events_acked"]} ({report["errors"]} errors)')
+        self.stdout.write(f'  acked events/sec    {report["events_per_sec"]:.0f}')
+        self.stdout.write(f'  ack latency p50/p99 {ms(report["ack_p50_ms"])} / {ms(report["ack_p99_ms"])} (max {ms(report["ack_max_ms"])})')
+        self.stdout.write(f'  db rows/sec         {report["db_rows_per_sec"]:.0f} ({report["db_rows"]} rows)')
+        self.stdout.write(f'  server RSS peak     {mb(report["server_rss_peak"])}')
+        self.stdout.write(f'  client RSS peak     {mb(report["client_rss_peak"])}')
@@ -0,0 +1,39 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from core.bench import replay_benchmark
+
+
+def parse_sizes(value):
+    return [int(size) for size in value.split(',')]
+
+
+class Command(BaseCommand):
+    help = 'Time session replay for synthetic sessions of the given sizes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=parse_sizes, default=[1000, 100_000, 1_000_000],
+                            help='Comma-separated event counts, one session each (default: 1000,100000,1000000)')
+        parser.add_argument('--rate', type=float, default=50,
+                            help='Events per second of session time (default: 50)')
+        parser.add_argument('--compact', action='store_true', help='Compact the events into chunks before timing')
+        parser.add_argument('--keep', action='store_true', help='Keep the generated sessions instead of deleting them')
+        parser.add_argument('--seed', type=int, help='Random seed for reproducible event streams')
+        parser.add_argument('--json', action='store_true', help='Print the reports as JSON')
+
+    def handle(self, *args, **options):
+        progress = None if options['json'] else self.stdout.write
+        reports = replay_benchmark(options['sizes'], options['rate'], options['compact'], options['keep'],
+                                   options['seed'], progress)
+        if options['json']:
+            self.stdout.write(json.dumps(reports, indent=2))
+            return
+
+        for report in reports:
+            self.stdout.write(self.style.SUCCESS(f'{report["size"]} events ({report["windows"]} windows)'))
+            for name in ('create', 'compact', 'page', 'index_cold', 'index_warm', 'first_window', 'all_windows'):
+                if name in report:
+                    self.stdout.write(f'  {name:<13}{report[name] * 1000:10.1f} ms')
+            self.stdout.write(f'  events/sec   {report["events"] / report["all_windows"]:10.0f}')
+            self.stdout.write(f'  RSS peak     {report["rss_peak"] / 1024 / 1024:10.0f} MB')
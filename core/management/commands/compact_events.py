@@ -0,0 +1,47 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.chunks import compact_session
+from core.models import Event, Session, SessionArchive
+
+
+class Command(BaseCommand):
+    help = 'Roll raw Event rows into compressed EventChunk windows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=int, default=10,
+                            help='Only compact events older than this many minutes (default: 10)')
+        parser.add_argument('--window', type=int, default=60,
+                            help='Seconds of events stored per chunk (default: 60)')
+        parser.add_argument('--session', help='Only compact this session')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Keep running, compacting every this many seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            self.compact(options)
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+
+    def compact(self, options):
+        before = timezone.now() - timedelta(minutes=options['min_age'])
+        window = timedelta(seconds=options['window'])
+
+        session_ids = Event.objects.filter(timestamp__lt=before)
+        if options['session']:
+            session_ids = session_ids.filter(session_id=options['session'])
+        session_ids = session_ids.order_by().values_list('session_id', flat=True).distinct()
+
+        total = 0
+        # Rows left by an interrupted archive run are the archive's to purge, not to re-chunk
+        sessions = Session.objects.filter(id__in=list(session_ids)).exclude(archive__state=SessionArchive.ARCHIVING)
+        for session in sessions.only('id', 'start_time'):
+            compacted = compact_session(session, before, window)
+            total += compacted
+            self.stdout.write(f'Compacted {compacted} events for session {session.id}')
+
+        self.stdout.write(self.style.SUCCESS(f'Compacted {total} events'))
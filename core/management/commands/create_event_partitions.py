@@ -0,0 +1,26 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from core.database import create_event_partitions, is_partitioned
+
+
+class Command(BaseCommand):
+    help = 'Create upcoming monthly partitions of the event table (PostgreSQL)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months', type=int, default=3,
+                            help='Create partitions this many months ahead (default: 3)')
+
+    def handle(self, *args, **options):
+        if not is_partitioned(connection):
+            self.stdout.write('The event table is not partitioned on this database; nothing to do')
+            return
+
+        now = timezone.now()
+        created = create_event_partitions(connection, now, now + timedelta(days=31 * options['months']))
+        for name in created:
+            self.stdout.write(f'Created {name}')
+        self.stdout.write(self.style.SUCCESS(f'Created {len(created)} partitions'))
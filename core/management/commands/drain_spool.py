@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.spool import drain_spool, get_spool_settings
+
+
+class Command(BaseCommand):
+    help = 'Write events from the write-ahead spool to the storage backends'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', help='Spool directory (default: TELEMETRY_SPOOL["DIR"])')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Events written per transaction (default: 1000)')
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Keep running, draining every this many seconds')
+
+    def handle(self, *args, **options):
+        directory = options['dir'] or get_spool_settings()['DIR']
+        while True:
+            drained = drain_spool(directory, options['batch_size'])
+            if drained or not options['interval']:
+                self.stdout.write(self.style.SUCCESS(f'Drained {drained} events'))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,68 @@
+import os
+from datetime import datetime, time, timezone as dt_timezone
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from core.models import Session
+from core.transfer import FORMATS, PARTITION_HOURS, TransferError, export_telemetry
+
+
+def parse_moment(value):
+    """A date (midnight UTC) or an ISO datetime; naive datetimes are taken as UTC."""
+    try:
+        moment = parse_datetime(value)
+        if moment is None:
+            day = parse_date(value)
+            moment = day and datetime.combine(day, time(), tzinfo=dt_timezone.utc)
+    except ValueError:
+        moment = None
+    if moment is None:
+        raise CommandError(f'Not a date or datetime: {value}')
+    return moment if timezone.is_aware(moment) else moment.replace(tzinfo=dt_timezone.utc)
+
+
+class Command(BaseCommand):
+    help = 'Export the sessions started in a date range, with their events, to NDJSON and columnar files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Directory to write the export to')
+        parser.add_argument('--start', help='Earliest session start to export, as a date or ISO datetime '
+                                            '(default: the first session)')
+        parser.add_argument('--end', help='Export sessions started before this (default: now)')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Processes writing partitions (default: one per CPU)')
+        parser.add_argument('--format', action='append', choices=FORMATS, dest='formats',
+                            help='File format to write; repeat for both (default: both)')
+        parser.add_argument('--partition-hours', type=int, default=PARTITION_HOURS,
+                            help=f'Hours of session start time per partition (default: {PARTITION_HOURS})')
+
+    def handle(self, *args, **options):
+        end = parse_moment(options['end']) if options['end'] else timezone.now()
+        if options['start']:
+            start = parse_moment(options['start'])
+        else:
+            first = Session.objects.order_by('start_time').values_list('start_time', flat=True).first()
+            if first is None:
+                self.stdout.write('No sessions to export')
+                return
+            start = first.replace(minute=0, second=0, microsecond=0)
+        if options['partition_hours'] < 1:
+            raise CommandError('--partition-hours must be at least 1')
+
+        try:
+            manifest = export_telemetry(
+                options['directory'], start, end,
+                workers=options['workers'],
+                formats=options['formats'] or FORMATS,
+                partition_hours=options['partition_hours'],
+            )
+        except TransferError as e:
+            raise CommandError(str(e))
+        sessions = sum(entry['sessions'] for entry in manifest['partitions'])
+        events = sum(entry['events'] for entry in manifest['partitions'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Exported {sessions} sessions and {events} events in {len(manifest['partitions'])} partitions "
+            f"to {options['directory']}"
+        ))
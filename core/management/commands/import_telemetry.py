@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.transfer import TransferError, import_telemetry
+
+
+class Command(BaseCommand):
+    help = 'Load a directory written by export_telemetry, skipping sessions that already exist'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Directory of the export')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Processes loading partitions; more than one only helps on PostgreSQL (default: 1)')
+
+    def handle(self, *args, **options):
+        try:
+            sessions, events = import_telemetry(options['directory'], workers=options['workers'])
+        except TransferError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(f'Imported {sessions} sessions and {events} events'))
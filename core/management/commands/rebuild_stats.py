@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from core.stats import rebuild_counters
+from core.summaries import rebuild_summaries
+
+
+class Command(BaseCommand):
+    help = 'Recompute the dashboard counters from the session and event tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--summaries', action='store_true',
+                            help='Also recompute every session summary from its events')
+
+    def handle(self, *args, **options):
+        for name, value in rebuild_counters().items():
+            self.stdout.write(f'{name}: {value}')
+        if options['summaries']:
+            self.stdout.write(f'summaries: {rebuild_summaries()}')
+        self.stdout.write(self.style.SUCCESS('Counters rebuilt'))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import Session
+from core.retention import ArchiveError, restore_session
+
+
+class Command(BaseCommand):
+    help = "Load an archived session's events back into the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('session_id', help='ID of the archived session')
+
+    def handle(self, *args, **options):
+        try:
+            session = Session.objects.get(id=options['session_id'])
+        except (Session.DoesNotExist, ValueError):
+            raise CommandError(f"Session not found: {options['session_id']}")
+        try:
+            restored = restore_session(session)
+        except ArchiveError as e:
+            raise CommandError(str(e))
+        if restored:
+            self.stdout.write(self.style.SUCCESS(f'Restored session {session.id}'))
+        else:
+            self.stdout.write(f'Session {session.id} is not archived')
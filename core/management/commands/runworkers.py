@@ -0,0 +1,80 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.metrics import clear_snapshots, get_metrics_settings
+
+
+class Command(BaseCommand):
+    help = 'Run several Daphne worker processes that share one listening socket'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Number of worker processes (default: one per CPU)')
+        parser.add_argument('--bind', default='127.0.0.1', help='Address to listen on (default: 127.0.0.1)')
+        parser.add_argument('--port', type=int, default=8000, help='Port to listen on (default: 8000)')
+        parser.add_argument('--application', default='clearsight.asgi:application',
+                            help='ASGI application to serve (default: clearsight.asgi:application)')
+        parser.add_argument('--proxy-headers', action='store_true',
+                            help='Use X-Forwarded-For/X-Forwarded-Port from a reverse proxy')
+
+    def handle(self, *args, **options):
+        backend = settings.CHANNEL_LAYERS.get('default', {}).get('BACKEND', '')
+        if options['workers'] > 1 and backend.endswith('InMemoryChannelLayer'):
+            raise CommandError(
+                'InMemoryChannelLayer only reaches consumers in its own process; '
+                'set CLEARSIGHT_CHANNEL_LAYER=sqlite to run several workers'
+            )
+
+        family = socket.AF_INET6 if ':' in options['bind'] else socket.AF_INET
+        listener = socket.socket(family, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((options['bind'], options['port']))
+        listener.listen(1024)
+        # Every worker accepts on the same socket, so the kernel spreads connections across them
+        listener.set_inheritable(True)
+
+        command = [sys.executable, '-m', 'daphne', '--fd', str(listener.fileno())]
+        if options['proxy_headers']:
+            command.append('--proxy-headers')
+        command.append(options['application'])
+
+        def spawn():
+            return subprocess.Popen(command, pass_fds=[listener.fileno()])
+
+        # Snapshots from a previous run would be added to this run's metrics
+        clear_snapshots(get_metrics_settings()['MULTIPROCESS_DIR'])
+
+        stopping = False
+
+        def stop(signum, frame):
+            nonlocal stopping
+            stopping = True
+
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+
+        workers = [spawn() for _ in range(options['workers'])]
+        self.stdout.write(f"Serving on {options['bind']}:{options['port']} with {len(workers)} workers")
+
+        while not stopping:
+            time.sleep(1)
+            for index, worker in enumerate(workers):
+                if worker.poll() is not None and not stopping:
+                    self.stderr.write(f'Worker {worker.pid} exited with {worker.returncode}, restarting')
+                    workers[index] = spawn()
+
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            try:
+                worker.wait(10)
+            except subprocess.TimeoutExpired:
+                worker.kill()
+        listener.close()
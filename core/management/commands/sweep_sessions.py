@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.summaries import sweep_sessions
+
+
+class Command(BaseCommand):
+    help = 'Close active sessions whose last event is older than TELEMETRY_SUMMARY["IDLE_TIMEOUT"]'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--idle-timeout', type=int, help='Seconds without events; overrides IDLE_TIMEOUT')
+        parser.add_argument('--limit', type=int, help='Close at most this many sessions per run')
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Keep running, sweeping every this many seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            closed = sweep_sessions(idle_timeout=options['idle_timeout'], limit=options['limit'])
+            self.stdout.write(self.style.SUCCESS(f'Closed {closed} idle sessions'))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,21 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.analytics import update_windows
+
+
+class Command(BaseCommand):
+    help = 'Compute and store the page analytics of every settled window not stored yet (see TELEMETRY_ANALYTICS)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=24, help='Cover windows from this many hours back')
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Recompute windows already stored, e.g. after late events were loaded')
+
+    def handle(self, *args, **options):
+        end = timezone.now()
+        start = end - timedelta(hours=options['hours'])
+        computed = update_windows(start, end, replace=options['rebuild'])
+        self.stdout.write(self.style.SUCCESS(f'Computed {computed} analytics windows'))
@@ -0,0 +1,297 @@
+"""
+Ingest instrumentation exposed in the Prometheus text format on ``/metrics``.
+
+Metrics are plain in-process counters, gauges and histograms; recording one
+is a dict update under a lock, cheap enough for the per-event paths.
+
+Each worker process only sees its own metrics. With several workers (see
+``runworkers``) set ``TELEMETRY_METRICS['MULTIPROCESS_DIR']``: every process
+then writes a snapshot of its metrics to ``<dir>/<pid>.json`` every
+FLUSH_INTERVAL seconds and on exit, and ``/metrics`` answers with the sum
+over all snapshots. Counters and histograms of processes that have exited
+are kept, so totals don't drop when a worker restarts; their gauges are
+not, since a dead process holds no connections.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+METRICS_DEFAULTS = {
+    'ENABLED': True,  # Serve /metrics
+    'MULTIPROCESS_DIR': None,  # Shared snapshot directory when several workers serve /metrics
+    'FLUSH_INTERVAL': 5.0,  # Seconds between snapshots in multiprocess mode
+}
+
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = {}
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def get_metrics_settings():
+    return {**METRICS_DEFAULTS, **getattr(settings, 'TELEMETRY_METRICS', {})}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY[name] = self
+
+    def _key(self, labels):
+        if _exporter is None:
+            _start_exporter()
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def render(self, samples):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for key, value in sorted(samples.items()):
+            lines.append(f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}')
+        return lines
+
+    @staticmethod
+    def merge(total, value):
+        return total + value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # Per-bucket counts, then sum and count; made cumulative when rendered
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+            state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), list(value)] for key, value in self._values.items()]
+
+    def render(self, samples):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        bounds = [*self.buckets, float('inf')]
+        for key, state in sorted(samples.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, state):
+                cumulative += count
+                labels = _format_labels(self.labels, key, [('le', _format_value(bound))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labels, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(state[-2])}')
+            lines.append(f'{self.name}_count{labels} {state[-1]}')
+        return lines
+
+    @staticmethod
+    def merge(total, value):
+        return [a + b for a, b in zip(total, value)]
+
+
+DECODE_SECONDS = Histogram(
+    'clearsight_ingest_decode_seconds', 'Time spent decoding telemetry messages.', ['transport'])
+WRITE_SECONDS = Histogram(
+    'clearsight_ingest_write_seconds', 'Time spent writing a batch of events to storage.', ['sink'])
+BUFFER_PENDING = Gauge(
+    'clearsight_ingest_buffer_pending_events', 'Events received on WebSocket connections and not yet written.')
+CONNECTIONS = Gauge(
+    'clearsight_websocket_connections', 'Open WebSocket connections.', ['consumer'])
+EVENTS_RECEIVED = Counter(
+    'clearsight_events_received_total', 'Events received, by type.', ['type'])
+EVENTS_DROPPED = Counter(
+    'clearsight_events_dropped_total', 'Events the ingest sampler did not store, by type.', ['type'])
+BYTES_RECEIVED = Counter(
+    'clearsight_ingest_bytes_total', 'Bytes of telemetry payload received.', ['transport'])
+WRITER_QUEUE_WAIT = Histogram(
+    'clearsight_db_writer_queue_wait_seconds', 'Time database jobs waited for a writer thread.', ['kind'])
+WRITER_QUEUE_DEPTH = Gauge(
+    'clearsight_db_writer_queue_depth', 'Database jobs queued or waiting to be queued for a writer thread.')
+ADMISSION_REJECTED = Counter(
+    'clearsight_admission_rejected_total', 'Telemetry messages and connections refused by admission control.',
+    ['transport', 'reason'])
+SLOW_DOWN_SENT = Counter(
+    'clearsight_slow_down_sent_total', 'Requests to back off sent to telemetry clients.', ['transport'])
+
+
+def snapshot():
+    return {
+        'pid': os.getpid(),
+        'metrics': {name: metric.snapshot() for name, metric in REGISTRY.items()},
+    }
+
+
+def _merge(snapshots):
+    merged = {name: {} for name in REGISTRY}
+    for data in snapshots:
+        for name, samples in data['metrics'].items():
+            metric = REGISTRY.get(name)
+            if metric is None:
+                continue
+            if metric.type == 'gauge' and not data.get('alive', True):
+                continue
+            for key, value in samples:
+                key = tuple(key)
+                current = merged[name].get(key)
+                merged[name][key] = value if current is None else metric.merge(current, value)
+    return merged
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read_snapshots(directory):
+    snapshots = []
+    for filename in os.listdir(directory):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, filename)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            # Replaced mid-read or left half-written by a crash
+            continue
+        data['alive'] = _pid_alive(data['pid'])
+        snapshots.append(data)
+    return snapshots
+
+
+def render():
+    """Return every metric in the Prometheus text exposition format."""
+    directory = get_metrics_settings()['MULTIPROCESS_DIR']
+    if directory:
+        write_snapshot(directory)
+        merged = _merge(read_snapshots(directory))
+    else:
+        merged = _merge([snapshot()])
+    lines = []
+    for name, metric in REGISTRY.items():
+        lines.extend(metric.render(merged[name]))
+    return '\n'.join(lines) + '\n'
+
+
+def clear_snapshots(directory):
+    if not directory or not os.path.isdir(directory):
+        return
+    for filename in os.listdir(directory):
+        if filename.endswith(('.json', '.tmp')):
+            os.remove(os.path.join(directory, filename))
+
+
+def write_snapshot(directory):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{os.getpid()}.json')
+    temp = f'{path}.tmp'
+    with open(temp, 'w') as f:
+        json.dump(snapshot(), f)
+    os.replace(temp, path)
+
+
+def _start_exporter():
+    global _exporter
+    with _exporter_lock:
+        if _exporter is not None:
+            return
+        config = get_metrics_settings()
+        if not config['MULTIPROCESS_DIR']:
+            _exporter = False
+            return
+        _exporter = threading.Thread(
+            target=_export_loop, args=(str(config['MULTIPROCESS_DIR']), config['FLUSH_INTERVAL']),
+            name='metrics-exporter', daemon=True,
+        )
+        _exporter.start()
+        atexit.register(write_snapshot, str(config['MULTIPROCESS_DIR']))
+
+
+def _export_loop(directory, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            write_snapshot(directory)
+        except OSError as e:
+            logger.warning(f'Failed to write metrics snapshot to {directory}: {e}')
@@ -0,0 +1,29 @@
+# Generated by Django 5.0 on 2026-10-17 00:46
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_session_page_html_session_page_styles'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_time', models.DateTimeField()),
+                ('end_time', models.DateTimeField()),
+                ('event_count', models.IntegerField()),
+                ('types', models.JSONField()),
+                ('columns', models.BinaryField()),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='core.session')),
+            ],
+            options={
+                'ordering': ['start_time'],
+            },
+        ),
+    ]
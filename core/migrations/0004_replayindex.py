@@ -0,0 +1,25 @@
+# Generated by Django 5.0 on 2026-10-17 00:48
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_eventchunk'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReplayIndex',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_count', models.IntegerField()),
+                ('seek_index', models.JSONField(default=list)),
+                ('keyframes', models.JSONField(default=list)),
+                ('built_at', models.DateTimeField(auto_now=True)),
+                ('session', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='replay_index', to='core.session')),
+            ],
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.0 on 2026-10-17 00:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0004_replayindex"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SnapshotBlob",
+            fields=[
+                (
+                    "hash",
+                    models.CharField(max_length=64, primary_key=True, serialize=False),
+                ),
+                ("data", models.BinaryField(null=True)),
+                ("size", models.IntegerField(default=0)),
+                ("compressed_size", models.IntegerField(default=0)),
+                ("refcount", models.IntegerField(default=0)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="session",
+            name="page_html_blob",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="+",
+                to="core.snapshotblob",
+            ),
+        ),
+        migrations.AddField(
+            model_name="session",
+            name="page_styles_blob",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="+",
+                to="core.snapshotblob",
+            ),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.0 on 2026-10-17 00:50
+
+import hashlib
+import zlib
+
+from django.db import migrations
+
+
+def move_snapshots_to_blobs(apps, schema_editor):
+    Session = apps.get_model("core", "Session")
+    SnapshotBlob = apps.get_model("core", "SnapshotBlob")
+
+    def reference(content):
+        if not content:
+            return None
+        raw = content.encode()
+        blob, created = SnapshotBlob.objects.get_or_create(
+            hash=hashlib.sha256(raw).hexdigest(),
+            defaults={"data": zlib.compress(raw, 6), "size": len(raw)},
+        )
+        if created:
+            blob.compressed_size = len(blob.data)
+        blob.refcount += 1
+        blob.save()
+        return blob
+
+    for session in Session.objects.exclude(page_html=None, page_styles=None).iterator(
+        chunk_size=100
+    ):
+        session.page_html_blob = reference(session.page_html)
+        session.page_styles_blob = reference(session.page_styles)
+        session.save(update_fields=["page_html_blob", "page_styles_blob"])
+
+
+def move_blobs_to_snapshots(apps, schema_editor):
+    Session = apps.get_model("core", "Session")
+
+    def content(blob):
+        return zlib.decompress(blob.data).decode() if blob and blob.data else None
+
+    sessions = Session.objects.exclude(
+        page_html_blob=None, page_styles_blob=None
+    ).select_related("page_html_blob", "page_styles_blob")
+    for session in sessions.iterator(chunk_size=100):
+        session.page_html = content(session.page_html_blob)
+        session.page_styles = content(session.page_styles_blob)
+        session.save(update_fields=["page_html", "page_styles"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0005_snapshot_blobs"),
+    ]
+
+    operations = [
+        migrations.RunPython(move_snapshots_to_blobs, move_blobs_to_snapshots),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.0 on 2026-10-17 00:50
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0006_snapshot_blobs_data"),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name="session",
+            name="page_html",
+        ),
+        migrations.RemoveField(
+            model_name="session",
+            name="page_styles",
+        ),
+    ]
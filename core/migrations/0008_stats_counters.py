@@ -0,0 +1,50 @@
+# Generated by Django 5.0 on 2026-10-17 00:52
+
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def seed_counters(apps, schema_editor):
+    Session = apps.get_model("core", "Session")
+    Event = apps.get_model("core", "Event")
+    EventChunk = apps.get_model("core", "EventChunk")
+    StatsCounter = apps.get_model("core", "StatsCounter")
+
+    chunked = EventChunk.objects.aggregate(count=Sum("event_count"))["count"] or 0
+    StatsCounter.objects.bulk_create(
+        [
+            StatsCounter(name="sessions", value=Session.objects.count()),
+            StatsCounter(
+                name="active_sessions",
+                value=Session.objects.filter(is_active=True).count(),
+            ),
+            StatsCounter(name="events", value=Event.objects.count() + chunked),
+        ]
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0007_snapshot_blobs_remove_inline"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StatsCounter",
+            fields=[
+                (
+                    "name",
+                    models.CharField(max_length=50, primary_key=True, serialize=False),
+                ),
+                ("value", models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="session",
+            index=models.Index(
+                fields=["-start_time", "-id"], name="session_listing_idx"
+            ),
+        ),
+        migrations.RunPython(seed_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.0 on 2026-10-17 00:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0008_stats_counters"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SpoolCheckpoint",
+            fields=[
+                (
+                    "segment",
+                    models.CharField(max_length=64, primary_key=True, serialize=False),
+                ),
+                ("offset", models.BigIntegerField(default=0)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
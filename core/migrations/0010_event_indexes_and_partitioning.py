@@ -0,0 +1,124 @@
+# Generated by Django 5.0 on 2026-10-17 00:59
+
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def create_monthly_partitions(cursor, start, end):
+    """Create the monthly core_event partitions covering ``[start, end)``.
+
+    A frozen copy of ``core.database.create_event_partitions`` as it was when
+    this migration was written.
+    """
+    month = datetime(start.year, start.month, 1, tzinfo=dt_timezone.utc)
+    while month < end:
+        following = datetime(
+            month.year + month.month // 12,
+            month.month % 12 + 1,
+            1,
+            tzinfo=dt_timezone.utc,
+        )
+        name = f"core_event_y{month.year}m{month.month:02d}"
+        cursor.execute("SELECT to_regclass(%s)", [name])
+        if cursor.fetchone()[0] is None:
+            cursor.execute(
+                f"CREATE TABLE {name} PARTITION OF core_event "
+                f"FOR VALUES FROM ('{month.isoformat()}') TO ('{following.isoformat()}')"
+            )
+        month = following
+
+
+def partition_events(apps, schema_editor):
+    """Rebuild core_event as a table range-partitioned by month on PostgreSQL.
+
+    Existing rows are copied into the new table, so on a large install this
+    runs for as long as a full table copy takes. Other databases are left
+    alone.
+    """
+    connection = schema_editor.connection
+    if connection.vendor != "postgresql":
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT indexdef FROM pg_indexes "
+            "WHERE tablename = 'core_event' AND indexname <> 'core_event_pkey'"
+        )
+        index_defs = [row[0] for row in cursor.fetchall()]
+        cursor.execute(
+            "SELECT conname FROM pg_constraint "
+            "WHERE conrelid = 'core_event'::regclass AND contype = 'f'"
+        )
+        fk_name = cursor.fetchone()[0]
+        cursor.execute('SELECT MIN("timestamp") FROM core_event')
+        first = cursor.fetchone()[0] or timezone.now()
+
+        cursor.execute("ALTER TABLE core_event RENAME TO core_event_unpartitioned")
+        # The partition key has to be part of the primary key
+        cursor.execute("""
+            CREATE TABLE core_event (
+                id bigint GENERATED BY DEFAULT AS IDENTITY,
+                type varchar(50) NOT NULL,
+                "timestamp" timestamp with time zone NOT NULL,
+                data jsonb NOT NULL,
+                session_id uuid NOT NULL,
+                CONSTRAINT core_event_partitioned_pkey PRIMARY KEY (id, "timestamp")
+            ) PARTITION BY RANGE ("timestamp")
+            """)
+        cursor.execute(
+            "CREATE TABLE core_event_default PARTITION OF core_event DEFAULT"
+        )
+        create_monthly_partitions(cursor, first, timezone.now() + timedelta(days=93))
+
+        cursor.execute(
+            'INSERT INTO core_event (id, type, "timestamp", data, session_id) '
+            "OVERRIDING SYSTEM VALUE "
+            'SELECT id, type, "timestamp", data, session_id FROM core_event_unpartitioned'
+        )
+        cursor.execute(
+            "SELECT setval(pg_get_serial_sequence('core_event', 'id'), "
+            "COALESCE((SELECT MAX(id) FROM core_event), 0) + 1, false)"
+        )
+        cursor.execute("DROP TABLE core_event_unpartitioned")
+
+        # Restore the constraint and index names Django's migration state knows about
+        cursor.execute(
+            "ALTER TABLE core_event "
+            "RENAME CONSTRAINT core_event_partitioned_pkey TO core_event_pkey"
+        )
+        for index_def in index_defs:
+            cursor.execute(index_def)
+        cursor.execute(
+            f"ALTER TABLE core_event ADD CONSTRAINT {fk_name} FOREIGN KEY (session_id) "
+            "REFERENCES core_session (id) DEFERRABLE INITIALLY DEFERRED"
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0009_spool_checkpoint"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="event",
+            index=models.Index(
+                fields=["session", "timestamp"], name="event_session_time_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="event",
+            index=models.Index(fields=["timestamp"], name="event_time_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="eventchunk",
+            index=models.Index(
+                fields=["session", "start_time"], name="chunk_session_time_idx"
+            ),
+        ),
+        # Reversing leaves the table partitioned, which Django handles like a plain table
+        migrations.RunPython(partition_events, migrations.RunPython.noop),
+    ]
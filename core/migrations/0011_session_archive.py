@@ -0,0 +1,60 @@
+# Generated by Django 5.0 on 2026-10-17 01:14
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0010_event_indexes_and_partitioning"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SessionArchive",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "state",
+                    models.CharField(
+                        choices=[
+                            ("archiving", "Archiving"),
+                            ("archived", "Archived"),
+                            ("restored", "Restored"),
+                        ],
+                        default="archiving",
+                        max_length=10,
+                    ),
+                ),
+                ("path", models.CharField(max_length=255)),
+                ("event_count", models.IntegerField()),
+                ("size", models.BigIntegerField()),
+                ("archived_at", models.DateTimeField(auto_now_add=True)),
+                ("restored_at", models.DateTimeField(blank=True, null=True)),
+                (
+                    "session",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="archive",
+                        to="core.session",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["state", "archived_at"], name="archive_state_idx"
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.0 on 2026-10-17 01:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0011_session_archive"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PageAnalytics",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("page_url", models.URLField(blank=True)),
+                ("window_start", models.DateTimeField()),
+                ("window_seconds", models.IntegerField()),
+                ("bins", models.IntegerField()),
+                ("events", models.BigIntegerField(default=0)),
+                ("sessions", models.IntegerField(default=0)),
+                ("clicks", models.BigIntegerField(default=0)),
+                ("moves", models.BigIntegerField(default=0)),
+                ("rage_clicks", models.IntegerField(default=0)),
+                ("dead_clicks", models.IntegerField(default=0)),
+                ("time_on_page", models.FloatField(default=0)),
+                ("click_heatmap", models.BinaryField()),
+                ("move_heatmap", models.BinaryField()),
+                ("scroll_depth", models.JSONField(default=list)),
+                ("time_on_page_histogram", models.JSONField(default=list)),
+                ("computed_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="pageanalytics",
+            constraint=models.UniqueConstraint(
+                fields=("page_url", "window_start", "window_seconds", "bins"),
+                name="page_analytics_window_unique",
+            ),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.0 on 2026-10-17 01:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0012_page_analytics"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SessionSummary",
+            fields=[
+                (
+                    "session",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="summary",
+                        serialize=False,
+                        to="core.session",
+                    ),
+                ),
+                ("event_count", models.BigIntegerField(default=0)),
+                ("type_counts", models.JSONField(default=dict)),
+                ("first_event", models.DateTimeField(blank=True, null=True)),
+                ("last_event", models.DateTimeField(blank=True, null=True)),
+                ("max_scroll_depth", models.IntegerField(default=0)),
+                ("click_count", models.IntegerField(default=0)),
+                ("error_count", models.IntegerField(default=0)),
+                ("bytes_ingested", models.BigIntegerField(default=0)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
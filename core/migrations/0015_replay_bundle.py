@@ -0,0 +1,44 @@
+# Generated by Django 5.0 on 2026-10-17 01:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0014_search_term"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ReplayBundle",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("path", models.CharField(max_length=255)),
+                ("etag", models.CharField(max_length=64)),
+                ("encoding", models.CharField(max_length=10)),
+                ("size", models.BigIntegerField()),
+                ("event_count", models.IntegerField()),
+                ("start_ms", models.BigIntegerField(null=True)),
+                ("end_ms", models.BigIntegerField(null=True)),
+                ("built_at", models.DateTimeField(auto_now=True)),
+                (
+                    "session",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="replay_bundle",
+                        to="core.session",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.0 on 2026-10-17 01:35
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0015_replay_bundle"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DomSnapshotRef",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "blob",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.PROTECT,
+                        related_name="+",
+                        to="core.snapshotblob",
+                    ),
+                ),
+                (
+                    "session",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="dom_snapshots",
+                        to="core.session",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="domsnapshotref",
+            constraint=models.UniqueConstraint(
+                fields=("session", "blob"), name="dom_snapshot_ref_unique"
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0 on 2026-10-17 02:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0016_dom_snapshot_ref"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="eventchunk",
+            name="type_counts",
+            field=models.JSONField(null=True),
+        ),
+    ]
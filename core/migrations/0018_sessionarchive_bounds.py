@@ -0,0 +1,36 @@
+# Generated by Django 5.0 on 2026-10-17 02:46
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def bound_existing_archives(apps, schema_editor):
+    # Archives made before the bounds were recorded owned every row of their session
+    Event = apps.get_model("core", "Event")
+    EventChunk = apps.get_model("core", "EventChunk")
+    SessionArchive = apps.get_model("core", "SessionArchive")
+    SessionArchive.objects.update(
+        max_event_id=Event.objects.aggregate(id=Max("id"))["id"] or 0,
+        max_chunk_id=EventChunk.objects.aggregate(id=Max("id"))["id"] or 0,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0017_eventchunk_type_counts"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="sessionarchive",
+            name="max_chunk_id",
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="sessionarchive",
+            name="max_event_id",
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(bound_existing_archives, migrations.RunPython.noop),
+    ]
@@ -1,8 +1,32 @@
 from django.db import models
 import uuid
+import zlib
 
 # Create your models here.
 
+class SnapshotBlob(models.Model):
+    """Page HTML or styles stored once per distinct content.
+
+    Keyed by the SHA-256 of the uncompressed content and shared by every
+    session that captured the same page. ``data`` is null while a client has
+    announced the hash but not uploaded the body yet; see core/snapshots.py.
+    """
+    hash = models.CharField(max_length=64, primary_key=True)
+    data = models.BinaryField(null=True)  # zlib-compressed content
+    size = models.IntegerField(default=0)
+    compressed_size = models.IntegerField(default=0)
+    refcount = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @property
+    def content(self):
+        if self.data is None:
+            return None
+        return zlib.decompress(self.data).decode()
+
+    def __str__(self):
+        return f"Snapshot {self.hash[:12]} ({self.size} bytes)"
+
 class Session(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     start_time = models.DateTimeField(auto_now_add=True)
@@ -15,8 +39,16 @@ class Session(models.Model):
     window_width = models.IntegerField()
     window_height = models.IntegerField()
     is_active = models.BooleanField(default=True)
-    page_html = models.TextField(null=True, blank=True)  # Store the page HTML
-    page_styles = models.TextField(null=True, blank=True)  # Store computed styles
+    page_html_blob = models.ForeignKey(SnapshotBlob, null=True, blank=True, on_delete=models.PROTECT, related_name='+')  # Captured page HTML
+    page_styles_blob = models.ForeignKey(SnapshotBlob, null=True, blank=True, on_delete=models.PROTECT, related_name='+')  # Captured computed styles
+
+    @property
+    def page_html(self):
+        return self.page_html_blob.content if self.page_html_blob_id else None
+
+    @property
+    def page_styles(self):
+        return self.page_styles_blob.content if self.page_styles_blob_id else None
 
     @property
     def duration(self):
@@ -27,6 +59,12 @@ class Session(models.Model):
     def __str__(self):
         return f"Session {self.id} - {self.page_title}"
 
+    class Meta:
+        indexes = [
+            # Keyset pagination of the sessions list
+            models.Index(fields=['-start_time', '-id'], name='session_listing_idx'),
+        ]
+
 class Event(models.Model):
     session = models.ForeignKey(Session, on_delete=models.CASCADE, related_name='events')
     type = models.CharField(max_length=50)
@@ -38,3 +76,209 @@ class Event(models.Model):
 
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            # Replay windows and the detail view: one session's events in time order
+            models.Index(fields=['session', 'timestamp'], name='event_session_time_idx'),
+            # Time-range scans: compaction, analytics and retention
+            models.Index(fields=['timestamp'], name='event_time_idx'),
+        ]
+
+class EventChunk(models.Model):
+    """A window of a session's events stored as compressed column arrays.
+
+    Raw Event rows are rolled into chunks by the compact_events command;
+    see core/chunks.py for the column layout and the merged reader.
+    """
+    session = models.ForeignKey(Session, on_delete=models.CASCADE, related_name='chunks')
+    start_time = models.DateTimeField()
+    end_time = models.DateTimeField()
+    event_count = models.IntegerField()
+    types = models.JSONField()  # Event type names, indexed by the type code column
+    type_counts = models.JSONField(null=True)  # Events per entry of types; null for chunks written before it
+    columns = models.BinaryField()  # zlib-compressed column arrays
+
+    def __str__(self):
+        return f"{self.event_count} events from {self.start_time} to {self.end_time}"
+
+    class Meta:
+        ordering = ['start_time']
+        indexes = [
+            models.Index(fields=['session', 'start_time'], name='chunk_session_time_idx'),
+        ]
+
+class DomSnapshotRef(models.Model):
+    """A session's reference on the SnapshotBlob holding one of its DOM snapshot trees.
+
+    Taken once per session and distinct tree however often the tree recurs,
+    so the blob's refcount counts sessions; see core/dom.py.
+    """
+    session = models.ForeignKey(Session, on_delete=models.CASCADE, related_name='dom_snapshots')
+    blob = models.ForeignKey(SnapshotBlob, on_delete=models.PROTECT, related_name='+')
+
+    def __str__(self):
+        return f"DOM snapshot {self.blob_id} of session {self.session_id}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['session', 'blob'], name='dom_snapshot_ref_unique'),
+        ]
+
+class ReplayIndex(models.Model):
+    """Precomputed seek data for a session's replay.
+
+    ``seek_index`` maps timestamps to event offsets and ``keyframes`` hold the
+    cumulative replay state at regular intervals; see core/replay.py.
+    """
+    session = models.OneToOneField(Session, on_delete=models.CASCADE, related_name='replay_index')
+    event_count = models.IntegerField()
+    seek_index = models.JSONField(default=list)  # [[timestamp_ms, offset], ...]
+    keyframes = models.JSONField(default=list)
+    built_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Replay index for session {self.session_id}"
+
+class ReplayBundle(models.Model):
+    """An ended session's snapshot, seek index and events in one precompressed file.
+
+    The file name carries ``etag``, so a rebuilt bundle never replaces the
+    bytes behind a URL a browser may have cached; see core/bundles.py.
+    """
+    session = models.OneToOneField(Session, on_delete=models.CASCADE, related_name='replay_bundle')
+    path = models.CharField(max_length=255)  # Relative to TELEMETRY_REPLAY_BUNDLES['DIR']
+    etag = models.CharField(max_length=64)
+    encoding = models.CharField(max_length=10)  # Content-Encoding of the file
+    size = models.BigIntegerField()  # Compressed bytes
+    event_count = models.IntegerField()
+    start_ms = models.BigIntegerField(null=True)  # First and last event, ms since the epoch
+    end_ms = models.BigIntegerField(null=True)
+    built_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Replay bundle for session {self.session_id}"
+
+class StatsCounter(models.Model):
+    """A named running total maintained at ingest time for the dashboard."""
+    name = models.CharField(max_length=50, primary_key=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name}: {self.value}"
+
+class SpoolCheckpoint(models.Model):
+    """How far ``drain_spool`` has replayed one write-ahead spool segment; see core/spool.py."""
+    segment = models.CharField(max_length=64, primary_key=True)
+    offset = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.segment} @ {self.offset}"
+
+class SessionArchive(models.Model):
+    """A session's events exported to a compressed archive file; see core/retention.py.
+
+    While ``state`` is ``archived`` the events exist only in the file and the
+    Session row stays behind for listings. Opening the replay restores them.
+    """
+    ARCHIVING = 'archiving'
+    ARCHIVED = 'archived'
+    RESTORED = 'restored'
+    STATES = [
+        (ARCHIVING, 'Archiving'),  # File written, events being purged from the hot tables
+        (ARCHIVED, 'Archived'),
+        (RESTORED, 'Restored'),  # Events loaded back from the file
+    ]
+
+    session = models.OneToOneField(Session, on_delete=models.CASCADE, related_name='archive')
+    state = models.CharField(max_length=10, choices=STATES, default=ARCHIVING)
+    path = models.CharField(max_length=255)  # Relative to TELEMETRY_RETENTION['DIR']
+    event_count = models.IntegerField()
+    size = models.BigIntegerField()  # Compressed bytes
+    # Highest Event and EventChunk ids in the file; rows written after it are not purged with it
+    max_event_id = models.BigIntegerField(default=0)
+    max_chunk_id = models.BigIntegerField(default=0)
+    archived_at = models.DateTimeField(auto_now_add=True)
+    restored_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Archive of session {self.session_id} ({self.state})"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['state', 'archived_at'], name='archive_state_idx'),
+        ]
+
+class SessionSummary(models.Model):
+    """Per-session rollup kept up to date as events are stored; see core/summaries.py.
+
+    Listings and the detail view read this row instead of counting events.
+    """
+    session = models.OneToOneField(Session, on_delete=models.CASCADE, primary_key=True, related_name='summary')
+    event_count = models.BigIntegerField(default=0)
+    type_counts = models.JSONField(default=dict)  # {type: events}
+    first_event = models.DateTimeField(null=True, blank=True)
+    last_event = models.DateTimeField(null=True, blank=True)
+    max_scroll_depth = models.IntegerField(default=0)  # Deepest vertical scroll offset in pixels
+    click_count = models.IntegerField(default=0)
+    error_count = models.IntegerField(default=0)
+    bytes_ingested = models.BigIntegerField(default=0)  # Compact JSON size of the stored event data
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @property
+    def duration(self):
+        if self.first_event and self.last_event:
+            return self.last_event - self.first_event
+        return None
+
+    def __str__(self):
+        return f"Summary of session {self.session_id} ({self.event_count} events)"
+
+class SearchTerm(models.Model):
+    """One term of a session's search index; see core/search.py."""
+    session = models.ForeignKey(Session, on_delete=models.CASCADE, related_name='search_terms')
+    field = models.CharField(max_length=20)  # 'url', 'title', 'agent', 'browser' or an event type
+    term = models.CharField(max_length=64)
+
+    def __str__(self):
+        return f"{self.field}:{self.term}"
+
+    class Meta:
+        constraints = [
+            # Also serves term and term+field lookups, exact or by prefix range
+            models.UniqueConstraint(fields=['term', 'field', 'session'], name='search_term_unique'),
+        ]
+        indexes = [
+            # Facets and rebuilds by session
+            models.Index(fields=['session', 'field'], name='search_term_session_idx'),
+        ]
+
+class PageAnalytics(models.Model):
+    """One page's aggregates over one time window; see core/analytics.py.
+
+    ``page_url`` is empty for the all-pages row, which also marks the window
+    as computed.
+    """
+    page_url = models.URLField(blank=True)
+    window_start = models.DateTimeField()
+    window_seconds = models.IntegerField()
+    bins = models.IntegerField()  # Heatmap side length
+    events = models.BigIntegerField(default=0)
+    sessions = models.IntegerField(default=0)
+    clicks = models.BigIntegerField(default=0)
+    moves = models.BigIntegerField(default=0)
+    rage_clicks = models.IntegerField(default=0)
+    dead_clicks = models.IntegerField(default=0)
+    time_on_page = models.FloatField(default=0)  # Seconds, summed over sessions
+    click_heatmap = models.BinaryField()  # zlib-compressed int32[bins][bins]
+    move_heatmap = models.BinaryField()
+    scroll_depth = models.JSONField(default=list)  # Sessions per depth bin
+    time_on_page_histogram = models.JSONField(default=list)  # Sessions per time bin
+    computed_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Analytics for {self.page_url or 'all pages'} at {self.window_start}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['page_url', 'window_start', 'window_seconds', 'bins'], name='page_analytics_window_unique'),
+        ]
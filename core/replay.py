@@ -0,0 +1,121 @@
+"""
+Seek index and keyframes for session replay.
+
+Replaying a long session from the start just to show the right scroll
+position or input values doesn't scale, so the replay state is
+precomputed once per session:
+
+- ``seek_index`` holds ``[timestamp_ms, offset]`` for every SEEK_INTERVAL-th
+  event, so a timestamp maps to an event offset with a binary search.
+- ``keyframes`` hold the cumulative state (cursor, scroll, window size,
+  input values) at a boundary timestamp. A keyframe's state covers every
+  event strictly before its timestamp, so a seek applies the nearest
+  keyframe and replays only the events from its timestamp to the target.
+  A keyframe's ``dom`` names the last DOM snapshot before it (see
+  core/dom.py) by timestamp and offset; with one, the seek replays from
+  that snapshot instead, so the page's DOM is rebuilt too.
+"""
+import copy
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .chunks import iter_session_events, session_event_count
+from .dom import DOM_SNAPSHOT
+from .models import ReplayIndex
+
+REPLAY_INDEX_DEFAULTS = {
+    'SEEK_INTERVAL': 1000,  # Events between seek index entries
+    'KEYFRAME_INTERVAL_MS': 10000,  # Session time between keyframes
+    'ACTIVE_REBUILD_INTERVAL': 10,  # Seconds an active session's index is served before it is rebuilt
+}
+
+
+def get_replay_index_settings():
+    return {**REPLAY_INDEX_DEFAULTS, **getattr(settings, 'TELEMETRY_REPLAY_INDEX', {})}
+
+
+def initial_state(session):
+    return {
+        'cursor': None,
+        'scroll': {'x': 0, 'y': 0},
+        'window': {'width': session.window_width, 'height': session.window_height},
+        'inputs': {},
+    }
+
+
+def apply_event(state, event_type, data):
+    """Fold one event into the cumulative replay state."""
+    if not isinstance(data, dict):
+        return
+    if event_type in ('mousemove', 'click') and 'x' in data and 'y' in data:
+        state['cursor'] = {'x': data['x'], 'y': data['y']}
+    elif event_type == 'scroll':
+        state['scroll'] = {'x': data.get('x', 0), 'y': data.get('y', 0)}
+    elif event_type == 'resize' and 'width' in data and 'height' in data:
+        state['window'] = {'width': data['width'], 'height': data['height']}
+    elif event_type == 'input' and data.get('selector'):
+        state['inputs'][data['selector']] = data.get('value', '')
+
+
+def build_replay_index(session):
+    """Compute and store the seek index and keyframes for a session."""
+    config = get_replay_index_settings()
+    seek_interval = config['SEEK_INTERVAL']
+    keyframe_interval = config['KEYFRAME_INTERVAL_MS']
+
+    seek_index = []
+    keyframes = []
+    state = initial_state(session)
+    start_ms = None
+    next_boundary = None
+    offset = 0
+    last_dom = None
+
+    for event in iter_session_events(session):
+        timestamp = int(event['timestamp'].timestamp() * 1000)
+        if start_ms is None:
+            start_ms = timestamp
+            next_boundary = start_ms
+
+        if timestamp >= next_boundary:
+            # One keyframe per crossing, aligned to the interval grid, so idle gaps don't emit runs of copies
+            boundary = start_ms + (timestamp - start_ms) // keyframe_interval * keyframe_interval
+            keyframes.append({'timestamp': boundary, 'offset': offset, 'dom': last_dom, **copy.deepcopy(state)})
+            next_boundary = boundary + keyframe_interval
+
+        if offset % seek_interval == 0:
+            seek_index.append([timestamp, offset])
+
+        apply_event(state, event['type'], event['data'])
+        if event['type'] == DOM_SNAPSHOT:
+            last_dom = {'timestamp': timestamp, 'offset': offset}
+        offset += 1
+
+    fields = {'event_count': offset, 'seek_index': seek_index, 'keyframes': keyframes}
+    # Written before anything is read (see core/database.py)
+    with transaction.atomic():
+        if not ReplayIndex.objects.filter(session=session).update(built_at=timezone.now(), **fields):
+            ReplayIndex.objects.bulk_create([ReplayIndex(session=session, **fields)], ignore_conflicts=True)
+        return ReplayIndex.objects.get(session=session)
+
+
+def get_replay_index(session):
+    """Return a replay index, rebuilding it when events were added since.
+
+    An active session keeps receiving events, so its index is rebuilt at
+    most every ACTIVE_REBUILD_INTERVAL seconds; in between, viewers get the
+    last one, which only lacks seek entries for the newest events. An ended
+    session's index is rebuilt if events still arrived after it was built.
+    """
+    index = ReplayIndex.objects.filter(session=session).first()
+    if index is not None:
+        if session.is_active:
+            interval = get_replay_index_settings()['ACTIVE_REBUILD_INTERVAL']
+            if timezone.now() - index.built_at < timedelta(seconds=interval):
+                return index
+        if index.event_count == session_event_count(session):
+            return index
+    return build_replay_index(session)
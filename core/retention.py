@@ -0,0 +1,341 @@
+"""
+Session retention: archive old sessions to files, purge them from the hot
+tables, restore them on demand.
+
+``apply_retention`` archives the sessions whose last activity is older than
+the first policy in POLICIES whose MIN_EVENTS they reach. An archive owns the
+rows up to the ids recorded on its SessionArchive; only those are purged, so
+events arriving meanwhile stay. The Session row, snapshots, replay index and
+bundle stay too. Opening a replay without a bundle restores the events on a
+background thread, and restored sessions are archived again after
+RESTORED_TTL_DAYS.
+"""
+import gzip
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DatabaseError, close_old_connections, connection, transaction
+from django.db.models import Case, DateTimeField, F, Max, Q, Sum, Value, When
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from . import stats
+from .backends import get_backend
+from .chunks import iter_session_events
+from .models import Event, EventChunk, Session, SessionArchive
+from .spool import EPOCH
+from .summaries import rebuild_summaries
+
+logger = logging.getLogger(__name__)
+
+RETENTION_DEFAULTS = {
+    'DIR': 'archive',
+    'POLICIES': [
+        {'MIN_EVENTS': 100_000, 'ARCHIVE_AFTER_DAYS': 7},
+        {'ARCHIVE_AFTER_DAYS': 30},
+    ],
+    'RESTORED_TTL_DAYS': 1,  # Purge restored sessions again after this long
+    'DELETE_AFTER_DAYS': None,  # Delete archived sessions entirely this long after archiving
+    'DELETE_BATCH_SIZE': 10000,  # Rows per DELETE statement
+    'RESTORE_ON_OPEN': True,  # Restore archived sessions when their replay is opened
+    'RESTORE_IN_BACKGROUND': True,  # Restore on a thread of their own rather than the request's
+}
+
+ARCHIVE_FORMAT = 'clearsight-archive'
+ARCHIVE_VERSION = 1
+RESTORE_BATCH_SIZE = 5000
+CANDIDATE_PAGE_SIZE = 500
+
+_restorer = None
+_restorer_lock = threading.Lock()
+_restoring = set()  # Sessions with a restore queued or running on _restorer
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def get_retention_settings():
+    return {**RETENTION_DEFAULTS, **getattr(settings, 'TELEMETRY_RETENTION', {})}
+
+
+def archive_path(session):
+    return os.path.join(f'{session.start_time:%Y}', f'{session.start_time:%m}', f'{session.id}.ndjson.gz')
+
+
+def bulk_delete(model, session, batch_size, max_id):
+    """Delete a session's rows of ``model`` up to ``max_id`` in statements of at most ``batch_size`` rows."""
+    table = connection.ops.quote_name(model._meta.db_table)
+    session_id = model._meta.get_field('session').get_db_prep_value(session.pk, connection)
+    deleted = 0
+    while True:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {table} WHERE id IN '
+                f'(SELECT id FROM {table} WHERE session_id = %s AND id <= %s LIMIT %s)',
+                [session_id, max_id, batch_size],
+            )
+            count = cursor.rowcount
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+
+def event_bounds(session):
+    """Return the ``(max_event_id, max_chunk_id)`` of a session's rows so far."""
+    return (
+        Event.objects.filter(session=session).aggregate(id=Max('id'))['id'] or 0,
+        EventChunk.objects.filter(session=session).aggregate(id=Max('id'))['id'] or 0,
+    )
+
+
+def purge_events(session, batch_size, bounds):
+    """Remove a session's raw and compacted events up to ``bounds`` from the database. Returns the number removed."""
+    max_event_id, max_chunk_id = bounds
+    chunked = EventChunk.objects.filter(session=session, id__lte=max_chunk_id).aggregate(count=Sum('event_count'))
+    count = bulk_delete(Event, session, batch_size, max_event_id) + (chunked['count'] or 0)
+    bulk_delete(EventChunk, session, batch_size, max_chunk_id)
+    stats.increment(stats.EVENTS, -count)
+    return count
+
+
+def write_archive(session, directory, bounds):
+    """Write a session's events up to ``bounds`` to its archive file. Returns ``(relative_path, event_count, size)``."""
+    relative = archive_path(session)
+    path = os.path.join(directory, relative)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    header = {
+        'format': ARCHIVE_FORMAT,
+        'version': ARCHIVE_VERSION,
+        'session': {
+            'id': str(session.id),
+            'start_time': session.start_time,
+            'end_time': session.end_time,
+            'page_url': session.page_url,
+            'page_title': session.page_title,
+            'user_agent': session.user_agent,
+            'screen': [session.screen_width, session.screen_height],
+            'window': [session.window_width, session.window_height],
+            'page_html_blob': session.page_html_blob_id,
+            'page_styles_blob': session.page_styles_blob_id,
+        },
+    }
+
+    count = 0
+    temp = f'{path}.tmp'
+    with open(temp, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6) as f:
+        f.write(json.dumps(header, cls=DjangoJSONEncoder).encode() + b'\n')
+        for event in iter_session_events(session, bounds=bounds):
+            timestamp = (event['timestamp'] - EPOCH) // timedelta(microseconds=1)
+            f.write(json.dumps([event['type'], timestamp, event['data']], separators=(',', ':')).encode() + b'\n')
+            count += 1
+        f.close()
+        # The events are deleted next, so the file must be on disk first
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(temp, path)
+    return relative, count, os.path.getsize(path)
+
+
+def read_archive(path, session):
+    """Yield unsaved Event rows from an archive file."""
+    try:
+        with gzip.open(path, 'rb') as f:
+            header = json.loads(f.readline())
+            if header.get('format') != ARCHIVE_FORMAT or header['session']['id'] != str(session.id):
+                raise ArchiveError(f'{path} is not an archive of session {session.id}')
+            for line in f:
+                event_type, timestamp, data = json.loads(line)
+                yield Event(session=session, type=event_type, timestamp=EPOCH + timedelta(microseconds=timestamp), data=data)
+    except (OSError, EOFError, ValueError, KeyError) as e:
+        raise ArchiveError(f'Cannot read archive {path}: {e}') from e
+
+
+def archive_session(session, config=None):
+    """Archive a session's events and purge them from the hot tables. Returns the SessionArchive."""
+    config = config or get_retention_settings()
+    # Rows written after this point are neither in the file nor purged
+    bounds = event_bounds(session)
+    relative, count, size = write_archive(session, str(config['DIR']), bounds)
+
+    fields = {'state': SessionArchive.ARCHIVING, 'path': relative, 'event_count': count, 'size': size,
+              'max_event_id': bounds[0], 'max_chunk_id': bounds[1], 'restored_at': None}
+    # Re-archiving a restored session keeps its archived_at, which DELETE_AFTER_DAYS counts from
+    if not SessionArchive.objects.filter(session=session).update(**fields):
+        SessionArchive.objects.create(session=session, **fields)
+    purge_events(session, config['DELETE_BATCH_SIZE'], bounds)
+    SessionArchive.objects.filter(session=session).update(state=SessionArchive.ARCHIVED)
+    logger.info(f'Archived {count} events of session {session.id} to {relative} ({size} bytes)')
+    return SessionArchive.objects.get(session=session)
+
+
+def restore_session(session, config=None):
+    """Load an archived session's events back into the database. Returns False if not archived or already restored."""
+    config = config or get_retention_settings()
+    backend = get_backend('core.backends.ORMBackend')
+    with transaction.atomic():
+        # Claimed with a write first (see core/database.py); a second restore then finds nothing to claim
+        claimed = SessionArchive.objects.filter(session=session).exclude(state=SessionArchive.RESTORED).update(
+            state=SessionArchive.RESTORED, restored_at=timezone.now(),
+        )
+        if not claimed:
+            return False
+        archive = SessionArchive.objects.get(session=session)
+        # An interrupted archive run may have left some of the file's rows behind
+        purge_events(session, config['DELETE_BATCH_SIZE'], (archive.max_event_id, archive.max_chunk_id))
+        batch = []
+        for event in read_archive(os.path.join(str(config['DIR']), archive.path), session):
+            batch.append(event)
+            if len(batch) >= RESTORE_BATCH_SIZE:
+                backend.write_events(batch)
+                batch = []
+        if batch:
+            backend.write_events(batch)
+    logger.info(f'Restored {archive.event_count} events of session {session.id} from {archive.path}')
+    return True
+
+
+def _run_restore(session):
+    close_old_connections()
+    try:
+        restore_session(session)
+    except (ArchiveError, DatabaseError) as e:
+        logger.error(f'Failed to restore archived session {session.id}: {e}')
+    finally:
+        with _restorer_lock:
+            _restoring.discard(session.pk)
+        close_old_connections()
+
+
+def request_restore(session):
+    """Have an archived session's events restored, if RESTORE_ON_OPEN. Returns True while they are still archived.
+
+    Unless RESTORE_IN_BACKGROUND is off the restore runs on a thread of its
+    own, and callers show the session as being restored until it is done.
+    """
+    global _restorer
+    config = get_retention_settings()
+    if not config['RESTORE_ON_OPEN']:
+        return False
+    if not SessionArchive.objects.filter(session=session).exclude(state=SessionArchive.RESTORED).exists():
+        return False
+    if not config['RESTORE_IN_BACKGROUND']:
+        restore_session(session, config)
+        return False
+    with _restorer_lock:
+        if session.pk not in _restoring:
+            if _restorer is None:
+                _restorer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='clearsight-restore')
+            _restoring.add(session.pk)
+            _restorer.submit(_run_restore, session)
+    return True
+
+
+def purge_session(session, config=None):
+    """Delete a session with its events removed in batches first, so the cascade has little left to do."""
+    config = config or get_retention_settings()
+    purge_events(session, config['DELETE_BATCH_SIZE'], event_bounds(session))
+    session.delete()
+
+
+def remove_archive_file(archive):
+    path = os.path.join(str(get_retention_settings()['DIR']), archive.path)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def archive_candidates(now, config):
+    """Sessions without an archive that are due under their policy, in ``(start_time, id)`` order.
+
+    Judged from the session summaries, so sessions with no events or not yet
+    old enough are passed over without reading their events.
+    """
+    if not config['POLICIES']:
+        return Session.objects.none()
+    due_before = Case(
+        *[When(summary__event_count__gte=policy.get('MIN_EVENTS', 0),
+               then=Value(now - timedelta(days=policy['ARCHIVE_AFTER_DAYS'])))
+          for policy in config['POLICIES']],
+        output_field=DateTimeField(),
+    )
+    return (
+        Session.objects.filter(archive__isnull=True, summary__event_count__gt=0)
+        .annotate(
+            event_count=F('summary__event_count'),
+            last_seen=Greatest(Coalesce('summary__last_event', 'start_time'), Coalesce('end_time', 'start_time')),
+        )
+        .alias(due_before=due_before)
+        .filter(last_seen__lt=F('due_before'))
+        .order_by('start_time', 'id')
+    )
+
+
+def iter_archive_candidates(now, config, page_size=CANDIDATE_PAGE_SIZE):
+    """Yield ``archive_candidates`` a keyset page at a time, so archiving between pages doesn't shift them."""
+    candidates = archive_candidates(now, config)
+    page = list(candidates[:page_size])
+    while page:
+        yield from page
+        if len(page) < page_size:
+            return
+        last = page[-1]
+        page = list(candidates.filter(
+            Q(start_time__gt=last.start_time) | Q(start_time=last.start_time, id__gt=last.id)
+        )[:page_size])
+
+
+def apply_retention(now=None, dry_run=False, limit=None, config=None):
+    """Archive, re-archive, re-purge and delete sessions according to TELEMETRY_RETENTION. Returns counts per action."""
+    config = config or get_retention_settings()
+    now = now or timezone.now()
+    result = {'archived': 0, 'archived_events': 0, 'repurged': 0, 'deleted': 0}
+
+    ages = [timedelta(days=policy['ARCHIVE_AFTER_DAYS']) for policy in config['POLICIES']]
+    if ages and not dry_run:
+        # Sessions from before summaries were kept get one, so archive_candidates can judge them
+        rebuild_summaries(Session.objects.filter(summary__isnull=True, start_time__lt=now - min(ages)))
+
+    for session in iter_archive_candidates(now, config):
+        if limit is not None and result['archived'] >= limit:
+            break
+        result['archived'] += 1
+        result['archived_events'] += session.event_count
+        if dry_run:
+            continue
+        # Nothing has arrived for longer than the retention age; the client is gone
+        if Session.objects.filter(pk=session.pk, is_active=True).update(is_active=False, end_time=session.last_seen):
+            stats.increment(stats.ACTIVE_SESSIONS, -1)
+        archive_session(session, config)
+
+    # Restored sessions nobody has looked at for a while are archived again, taking in anything
+    # that arrived since; runs interrupted mid-purge finish purging what their file holds
+    expired = SessionArchive.objects.filter(
+        Q(state=SessionArchive.RESTORED, restored_at__lt=now - timedelta(days=config['RESTORED_TTL_DAYS']))
+        | Q(state=SessionArchive.ARCHIVING)
+    ).select_related('session')
+    for archive in expired:
+        result['repurged'] += 1
+        if dry_run:
+            continue
+        if archive.state == SessionArchive.RESTORED:
+            archive_session(archive.session, config)
+        else:
+            purge_events(archive.session, config['DELETE_BATCH_SIZE'], (archive.max_event_id, archive.max_chunk_id))
+            SessionArchive.objects.filter(pk=archive.pk).update(state=SessionArchive.ARCHIVED)
+
+    if config['DELETE_AFTER_DAYS'] is not None:
+        cutoff = now - timedelta(days=config['DELETE_AFTER_DAYS'])
+        doomed = SessionArchive.objects.filter(archived_at__lt=cutoff).select_related('session')
+        for archive in doomed:
+            result['deleted'] += 1
+            if not dry_run:
+                purge_session(archive.session, config)
+    return result
@@ -3,4 +3,5 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'^ws/telemetry/$', consumers.TelemetryConsumer.as_asgi()),
+    re_path(r'^ws/sessions/(?P<session_id>[0-9a-f-]{36})/live/$', consumers.LiveSessionConsumer.as_asgi()),
 ]
@@ -0,0 +1,236 @@
+"""
+Ingest-time reduction of high-frequency events.
+
+Browsers emit pointer, scroll and resize events at whatever rate the user
+moves, so without a reduction stage storage and replay cost grow with wall
+clock time rather than with anything worth replaying. ``SessionSampler``
+runs on every flushed batch before it is stored:
+
+1. Runs of consecutive scroll and resize events are thinned to one event per
+   MERGE_INTERVAL_MS; the last event of a run is always kept, so the final
+   position is exact.
+2. Runs of consecutive mousemove events are simplified with
+   Ramer-Douglas-Peucker using the synchronized distance: a point is dropped
+   when the cursor, moving at constant speed between the kept neighbours,
+   would be within PATH_TOLERANCE pixels of it at the same moment. Straight
+   strokes collapse to their endpoints while pauses and turns survive.
+3. Per-type and per-session (``'*'``) token buckets cap what is left of
+   those STREAM_TYPES, in events per second of session time, with BURST
+   seconds of headroom; ``'*'`` caps the three together.
+
+Nothing else is ever dropped. Clicks, inputs, keypresses and errors are
+discrete events a replay or search can't do without, and every DOM
+mutation (core/dom.py) is addressed against the DOM the earlier ones built.
+
+Every received event is still acked; dropped events are simply not stored.
+The matching client policy is sent to telemetry.js on ``session_started`` so
+well-behaved clients don't send what would be dropped anyway.
+
+Samplers live in the process that receives the events: one per WebSocket
+connection, and an LRU of MAX_SESSIONS for the HTTP endpoint. With several
+workers the HTTP rate limits are therefore per worker.
+"""
+import math
+import threading
+from collections import Counter, OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+
+from . import metrics
+
+# The continuous event types the sampler thins and rate limits; all others are kept
+STREAM_TYPES = ('mousemove', 'scroll', 'resize')
+
+SAMPLING_DEFAULTS = {
+    'ENABLED': True,
+    'PATH_TOLERANCE': 2.0,  # Pixels a simplified mouse path may deviate from the recorded one
+    'MERGE_TYPES': ('scroll', 'resize'),
+    'MERGE_INTERVAL_MS': 100,  # At most one event per this interval within a scroll/resize run
+    'RATE_LIMITS': {'mousemove': 20, 'scroll': 10, 'resize': 4, '*': 60},  # Events per second, '*' all STREAM_TYPES
+    'BURST': 2.0,  # Seconds of rate a bucket can save up
+    'MAX_SESSIONS': 10000,  # Samplers kept for HTTP ingest, least recently used evicted
+}
+
+_samplers = OrderedDict()
+_samplers_lock = threading.Lock()
+
+
+def get_sampling_settings():
+    return {**SAMPLING_DEFAULTS, **getattr(settings, 'TELEMETRY_SAMPLING', {})}
+
+
+def client_policy(config=None):
+    """The sampling policy telemetry.js applies before sending, as sent on session_started."""
+    config = config or get_sampling_settings()
+    if not config['ENABLED']:
+        return {'enabled': False}
+    limits = config['RATE_LIMITS']
+    intervals = {}
+    for event_type in STREAM_TYPES:
+        interval = config['MERGE_INTERVAL_MS'] if event_type in config['MERGE_TYPES'] else 0
+        if limits.get(event_type):
+            interval = max(interval, math.ceil(1000 / limits[event_type]))
+        intervals[event_type] = interval
+    return {
+        'enabled': True,
+        'intervals': intervals,
+        'pathTolerance': config['PATH_TOLERANCE'],
+    }
+
+
+def get_sampler(session_id):
+    """Return the shared sampler for a session's HTTP ingest, or None when sampling is off."""
+    config = get_sampling_settings()
+    if not config['ENABLED']:
+        return None
+    key = str(session_id)
+    with _samplers_lock:
+        sampler = _samplers.get(key)
+        if sampler is None:
+            sampler = _samplers[key] = SessionSampler(config)
+            while len(_samplers) > config['MAX_SESSIONS']:
+                _samplers.popitem(last=False)
+        else:
+            _samplers.move_to_end(key)
+        return sampler
+
+
+def _point(event):
+    data = event.data
+    if not isinstance(data, dict):
+        return None
+    x, y = data.get('x'), data.get('y')
+    if isinstance(x, bool) or isinstance(y, bool) or not isinstance(x, (int, float)) or not isinstance(y, (int, float)):
+        return None
+    return x, y
+
+
+def _runs(events, types):
+    """Yield ``(start, end)`` index ranges of consecutive same-type events whose type is in ``types``."""
+    start = 0
+    while start < len(events):
+        end = start + 1
+        if events[start].type in types:
+            while end < len(events) and events[end].type == events[start].type:
+                end += 1
+            yield start, end
+        start = end
+
+
+def merge_runs(events, types, interval):
+    """Thin consecutive runs of ``types`` to one event per ``interval``, keeping each run's last event."""
+    keep = [True] * len(events)
+    for start, end in _runs(events, types):
+        last_kept = events[start].timestamp
+        for i in range(start + 1, end - 1):
+            if events[i].timestamp - last_kept < interval:
+                keep[i] = False
+            else:
+                last_kept = events[i].timestamp
+    return [event for event, kept in zip(events, keep) if kept]
+
+
+def _synchronized_distance(point, first, last):
+    # Distance from point to where the cursor would be at point's time moving linearly first -> last
+    (t, x, y), (t0, x0, y0), (t1, x1, y1) = point, first, last
+    ratio = (t - t0) / (t1 - t0) if t1 != t0 else 0.0
+    return math.hypot(x - (x0 + (x1 - x0) * ratio), y - (y0 + (y1 - y0) * ratio))
+
+
+def simplify_path(points, tolerance):
+    """Ramer-Douglas-Peucker over ``(t, x, y)`` points. Returns the sorted indices to keep."""
+    if len(points) < 3:
+        return list(range(len(points)))
+    keep = {0, len(points) - 1}
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        farthest, distance = None, tolerance
+        for i in range(first + 1, last):
+            d = _synchronized_distance(points[i], points[first], points[last])
+            if d > distance:
+                farthest, distance = i, d
+        if farthest is not None:
+            keep.add(farthest)
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return sorted(keep)
+
+
+def simplify_mouse_paths(events, tolerance):
+    """Simplify each run of consecutive mousemove events; events without numeric x/y are kept."""
+    keep = [True] * len(events)
+    for start, end in _runs(events, ('mousemove',)):
+        indices, points = [], []
+        for i in range(start, end):
+            point = _point(events[i])
+            if point is not None:
+                indices.append(i)
+                points.append(((events[i].timestamp - events[start].timestamp) / timedelta(milliseconds=1), *point))
+        kept = set(simplify_path(points, tolerance))
+        for position, i in enumerate(indices):
+            keep[i] = position in kept
+    return [event for event, kept in zip(events, keep) if kept]
+
+
+class TokenBucket:
+    """Allows ``rate`` events per second of event time, with ``burst`` seconds of headroom."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = max(1.0, rate * burst)
+        self.tokens = self.capacity
+        self.updated = None
+
+    def refill(self, timestamp):
+        if self.updated is not None:
+            # Late batches can carry older timestamps; they don't earn tokens
+            elapsed = max(0.0, (timestamp - self.updated).total_seconds())
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        if self.updated is None or timestamp > self.updated:
+            self.updated = timestamp
+        return self.tokens >= 1
+
+
+class SessionSampler:
+    """Reduces one session's event batches (see the module docstring)."""
+
+    def __init__(self, config=None):
+        config = config or get_sampling_settings()
+        self.tolerance = config['PATH_TOLERANCE']
+        self.merge_types = tuple(config['MERGE_TYPES'])
+        self.merge_interval = timedelta(milliseconds=config['MERGE_INTERVAL_MS'])
+        self.burst = config['BURST']
+        self.limits = {event_type: rate for event_type, rate in config['RATE_LIMITS'].items() if rate}
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def reduce(self, events):
+        """Return the events of a batch, in order, that should be stored."""
+        received = events
+        events = merge_runs(events, self.merge_types, self.merge_interval)
+        events = simplify_mouse_paths(events, self.tolerance)
+        with self._lock:
+            kept = [event for event in events if event.type not in STREAM_TYPES or self._admit(event)]
+        if len(kept) < len(received):
+            dropped = Counter(event.type for event in received)
+            dropped.subtract(event.type for event in kept)
+            for event_type, count in dropped.items():
+                if count:
+                    metrics.EVENTS_DROPPED.inc(count, type=event_type)
+        return kept
+
+    def _bucket(self, key):
+        if key not in self.buckets:
+            self.buckets[key] = TokenBucket(self.limits[key], self.burst)
+        return self.buckets[key]
+
+    def _admit(self, event):
+        buckets = [self._bucket(key) for key in (event.type, '*') if key in self.limits]
+        # Check every bucket before taking from any, so a refused event costs nothing
+        if not all([bucket.refill(event.timestamp) for bucket in buckets]):
+            return False
+        for bucket in buckets:
+            bucket.tokens -= 1
+        return True
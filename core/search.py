@@ -0,0 +1,420 @@
+"""
+Session search: terms and facets over session metadata and event fields.
+
+Each session is indexed as a set of ``(field, term)`` pairs: its page URL,
+title, user agent and browser family when it starts, then the EVENT_FIELDS
+of its events as they are stored (``record_events`` and the spool drain).
+An event field is indexed under its event type, so an error message is
+found with ``error:timeout`` and an input's name with ``input:email``.
+Input values are never indexed.
+
+Queries are whitespace-separated words, all of which must match; a word
+can be scoped to a field (``url:checkout``) and ends in ``*`` for a prefix
+match. Results can be narrowed by browser, page, day and whether the
+session had errors, come back newest first with keyset pagination on
+``(start_time, id)`` like the sessions list, and carry facet counts for
+those same four dimensions over the whole match.
+
+``DatabaseSearchBackend`` keeps the terms in an inverted index table
+(SearchTerm) in the main database, which works the same on SQLite and
+PostgreSQL. ``OpenSearchSearchBackend`` keeps one document per session in
+``<INDEX_PREFIX>-sessions`` instead; its writes are best effort and
+``manage.py rebuild_search_index`` repairs either backend.
+"""
+import logging
+import re
+from itertools import islice
+from datetime import datetime, time as dt_time, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .backends import get_backend, get_opensearch_settings
+from .chunks import iter_session_events
+from .models import SearchTerm, Session, SessionArchive
+
+logger = logging.getLogger(__name__)
+
+SEARCH_DEFAULTS = {
+    'BACKEND': 'core.search.DatabaseSearchBackend',
+    # Event type -> data keys whose text is indexed under that type
+    'EVENT_FIELDS': {
+        'error': ['message', 'source'],
+        'input': ['name'],
+    },
+    'ERROR_TYPES': ('error',),  # Event types that make a session match has_errors
+    'MAX_TERMS': 100,  # Terms taken from a single field value
+    'PAGE_SIZE': 25,
+    'MAX_PAGE_SIZE': 100,
+    'FACET_SIZE': 10,  # Buckets returned per facet
+    'FACET_DAYS': 30,  # Days covered by the date facet
+}
+
+SESSION_FIELDS = ('url', 'title', 'agent', 'browser')
+MAX_TERM_LENGTH = 64
+REBUILD_BATCH_SIZE = 5000
+TOKEN_RE = re.compile(r'\w+')
+QUERY_RE = re.compile(r'(?:(\w+):)?(\S+)')
+
+# First match wins: Edge and Opera also claim to be Chrome, Chrome claims to be Safari
+BROWSERS = (
+    ('edge', re.compile(r'Edg(e|A|iOS)?/')),
+    ('opera', re.compile(r'OPR/|Opera')),
+    ('firefox', re.compile(r'Firefox/|FxiOS/')),
+    ('chrome', re.compile(r'Chrome/|CriOS/')),
+    ('safari', re.compile(r'Safari/')),
+)
+
+
+def get_search_settings():
+    return {**SEARCH_DEFAULTS, **getattr(settings, 'TELEMETRY_SEARCH', {})}
+
+
+def get_search_backend():
+    return get_backend(get_search_settings()['BACKEND'])
+
+
+def browser_family(user_agent):
+    for name, pattern in BROWSERS:
+        if pattern.search(user_agent or ''):
+            return name
+    return 'other'
+
+
+def tokenize(value, limit=None):
+    """Lowercased word terms of ``value``, in order, without duplicates."""
+    terms = dict.fromkeys(
+        token[:MAX_TERM_LENGTH] for token in TOKEN_RE.findall(str(value).lower()) if len(token) > 1
+    )
+    return list(terms)[:limit]
+
+
+def session_terms(session, config):
+    terms = {('browser', browser_family(session.user_agent))}
+    for field, value in (('url', session.page_url), ('title', session.page_title), ('agent', session.user_agent)):
+        terms.update((field, term) for term in tokenize(value, config['MAX_TERMS']))
+    return terms
+
+
+def event_terms(events, config):
+    """Return ``{session_id: {(field, term), ...}}`` and the ids of sessions with error events."""
+    fields = config['EVENT_FIELDS']
+    error_types = tuple(config['ERROR_TYPES'])
+    terms, errors = {}, set()
+    for session_id, event_type, data in events:
+        if event_type in error_types:
+            errors.add(session_id)
+        keys = fields.get(event_type)
+        if not keys or not isinstance(data, dict):
+            continue
+        found = terms.setdefault(session_id, set())
+        for key in keys:
+            value = data.get(key)
+            if isinstance(value, (str, int, float)) and not isinstance(value, bool):
+                found.update((event_type, term) for term in tokenize(value, config['MAX_TERMS']))
+    return {session_id: found for session_id, found in terms.items() if found}, errors
+
+
+def parse_query(query, config=None):
+    """Parse a query string into ``(field or None, term, is_prefix)`` clauses."""
+    config = config or get_search_settings()
+    known = set(SESSION_FIELDS) | set(config['EVENT_FIELDS'])
+    clauses = []
+    for field, text in QUERY_RE.findall(query or ''):
+        field = field.lower()
+        if field and field not in known:
+            # Not a field name, e.g. the scheme of a pasted URL
+            text, field = f'{field}:{text}', ''
+        prefix = text.endswith('*')
+        terms = tokenize(text.rstrip('*'))
+        for i, term in enumerate(terms):
+            clauses.append((field or None, term, prefix and i == len(terms) - 1))
+    return clauses
+
+
+def index_session(session):
+    get_search_backend().index_session(session)
+
+
+def index_events(events):
+    """Index the EVENT_FIELDS of a batch of stored Event rows."""
+    get_search_backend().index_events([(event.session_id, event.type, event.data) for event in events])
+
+
+def rebuild_index(sessions=None):
+    """Re-index sessions from the tables. Returns how many were indexed.
+
+    Sessions whose events are archived are skipped, keeping what was indexed
+    for them while their events were in the database.
+    """
+    backend = get_search_backend()
+    sessions = Session.objects.all() if sessions is None else sessions
+    archived = SessionArchive.objects.exclude(state=SessionArchive.RESTORED).values('session_id')
+    count = 0
+    for session in sessions.exclude(id__in=archived).iterator(chunk_size=500):
+        with transaction.atomic():
+            backend.index_session(session, replace=True)
+            events = ((session.id, event['type'], event['data']) for event in iter_session_events(session))
+            while batch := list(islice(events, REBUILD_BATCH_SIZE)):
+                backend.index_events(batch)
+        count += 1
+    return count
+
+
+class SearchBackend:
+    def index_session(self, session, replace=False):
+        """Index a session's metadata; ``replace`` drops whatever was indexed for it before."""
+        raise NotImplementedError
+
+    def index_events(self, events):
+        """Index ``(session_id, type, data)`` tuples."""
+        raise NotImplementedError
+
+    def remove_session(self, session_id):
+        pass
+
+    def search(self, clauses, filters, cursor=None, limit=25):
+        """Return ``{'ids': [...], 'has_more': bool, 'facets': {...}}`` for one page, newest first.
+
+        ``filters`` may hold ``browser``, ``page``, ``date`` (a date) and
+        ``has_errors`` (a bool); ``cursor`` is the ``(start_time, id)`` of the
+        last session of the previous page.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class DatabaseSearchBackend(SearchBackend):
+    def __init__(self):
+        self.config = get_search_settings()
+
+    def _insert(self, terms_by_session):
+        keys = {
+            (str(session_id), field, term)
+            for session_id, terms in terms_by_session.items()
+            for field, term in terms
+        }
+        if not keys:
+            return
+        # Most batches repeat terms already indexed; the unique constraint drops those
+        SearchTerm.objects.bulk_create(
+            [SearchTerm(session_id=session_id, field=field, term=term) for session_id, field, term in keys],
+            ignore_conflicts=True,
+        )
+
+    def index_session(self, session, replace=False):
+        if replace:
+            SearchTerm.objects.filter(session=session).delete()
+        self._insert({session.id: session_terms(session, self.config)})
+
+    def index_events(self, events):
+        terms, _ = event_terms(events, self.config)
+        if terms:
+            self._insert(terms)
+
+    def _term_filter(self, field, term, prefix):
+        terms = SearchTerm.objects.filter(term__gte=term, term__lt=term + '\uffff') if prefix else SearchTerm.objects.filter(term=term)
+        if field:
+            terms = terms.filter(field=field)
+        return terms.values('session_id')
+
+    def search(self, clauses, filters, cursor=None, limit=25):
+        sessions = Session.objects.order_by()
+        for clause in clauses:
+            sessions = sessions.filter(id__in=self._term_filter(*clause))
+        if filters.get('browser'):
+            sessions = sessions.filter(id__in=self._term_filter('browser', filters['browser'], False))
+        if filters.get('page'):
+            sessions = sessions.filter(page_url=filters['page'])
+        if filters.get('date'):
+            start = datetime.combine(filters['date'], dt_time.min, tzinfo=dt_timezone.utc)
+            sessions = sessions.filter(start_time__gte=start, start_time__lt=start + timedelta(days=1))
+        if filters.get('has_errors') is not None:
+            with_errors = Q(summary__error_count__gt=0)
+            sessions = sessions.filter(with_errors if filters['has_errors'] else ~with_errors)
+
+        page = sessions.order_by('-start_time', '-id')
+        if cursor:
+            start_time, session_id = cursor
+            page = page.filter(Q(start_time__lt=start_time) | Q(start_time=start_time, id__lt=session_id))
+        ids = list(page.values_list('id', flat=True)[:limit + 1])
+        return {'ids': ids[:limit], 'has_more': len(ids) > limit, 'facets': self.facets(sessions)}
+
+    def facets(self, sessions):
+        size = self.config['FACET_SIZE']
+        since = timezone.now() - timedelta(days=self.config['FACET_DAYS'])
+        matching = sessions.values('id')
+        browsers = (
+            SearchTerm.objects.filter(field='browser', session_id__in=matching)
+            .values('term').annotate(count=Count('id')).order_by('-count', 'term')[:size]
+        )
+        pages = sessions.values('page_url').annotate(count=Count('id')).order_by('-count', 'page_url')[:size]
+        days = (
+            sessions.filter(start_time__gte=since).annotate(day=TruncDate('start_time'))
+            .values('day').annotate(count=Count('id')).order_by('-day')
+        )
+        errors = sessions.aggregate(total=Count('id'), with_errors=Count('id', filter=Q(summary__error_count__gt=0)))
+        return {
+            'browser': [[row['term'], row['count']] for row in browsers],
+            'page': [[row['page_url'], row['count']] for row in pages],
+            'date': [[row['day'].isoformat(), row['count']] for row in days],
+            'has_errors': {'true': errors['with_errors'], 'false': errors['total'] - errors['with_errors']},
+        }
+
+
+class OpenSearchSearchBackend(SearchBackend):
+    """One document per session in ``<INDEX_PREFIX>-sessions``; terms are stored as ``field:term`` keywords."""
+
+    # Adds terms not already in the document; a session's terms are a set
+    UPDATE_SCRIPT = (
+        'for (t in params.terms) { if (!ctx._source.terms.contains(t)) { ctx._source.terms.add(t); } } '
+        'for (w in params.words) { if (!ctx._source.words.contains(w)) { ctx._source.words.add(w); } } '
+        'if (params.errors) { ctx._source.has_errors = true; }'
+    )
+
+    def __init__(self, config=None):
+        from opensearchpy import OpenSearch
+
+        self.config = {**get_search_settings(), **(config or {})}
+        opensearch = get_opensearch_settings()
+        self.client = OpenSearch(
+            hosts=opensearch['HOSTS'],
+            http_auth=opensearch['HTTP_AUTH'],
+            timeout=opensearch['TIMEOUT'],
+        )
+        self.index = f"{opensearch['INDEX_PREFIX']}-sessions"
+        self._index_ready = False
+
+    def _ensure_index(self):
+        if self._index_ready:
+            return
+        if not self.client.indices.exists(index=self.index):
+            self.client.indices.create(index=self.index, body={
+                'mappings': {
+                    'properties': {
+                        'session_id': {'type': 'keyword'},
+                        'start_time': {'type': 'date'},
+                        'page_url': {'type': 'keyword'},
+                        'page_title': {'type': 'text'},
+                        'browser': {'type': 'keyword'},
+                        'has_errors': {'type': 'boolean'},
+                        'terms': {'type': 'keyword'},  # field:term
+                        'words': {'type': 'keyword'},  # term, any field
+                    },
+                },
+            }, params={'ignore': 400})
+        self._index_ready = True
+
+    @staticmethod
+    def _split(terms):
+        return sorted(f'{field}:{term}' for field, term in terms), sorted({term for _, term in terms})
+
+    def index_session(self, session, replace=False):
+        try:
+            self._ensure_index()
+            self._index_document(session)
+        except Exception as e:
+            logger.warning(f'Failed to index session {session.id} for search: {e}')
+
+    def _index_document(self, session):
+        terms, words = self._split(session_terms(session, self.config))
+        self.client.index(index=self.index, id=str(session.id), body={
+            'session_id': str(session.id),
+            'start_time': session.start_time.isoformat(),
+            'page_url': session.page_url,
+            'page_title': session.page_title,
+            'browser': browser_family(session.user_agent),
+            'has_errors': False,
+            'terms': terms,
+            'words': words,
+        })
+
+    def index_events(self, events):
+        terms_by_session, errors = event_terms(events, self.config)
+        actions = []
+        for session_id in set(terms_by_session) | errors:
+            terms, words = self._split(terms_by_session.get(session_id, ()))
+            actions.append({'update': {'_index': self.index, '_id': str(session_id), 'retry_on_conflict': 3}})
+            actions.append({'script': {
+                'source': self.UPDATE_SCRIPT,
+                'params': {'terms': terms, 'words': words, 'errors': session_id in errors},
+            }})
+        if not actions:
+            return
+        try:
+            self._ensure_index()
+            response = self.client.bulk(body=actions)
+            if response.get('errors'):
+                logger.warning(f'Some search index updates failed for {len(actions) // 2} sessions')
+        except Exception as e:
+            # Best effort: ingest must not fail over the search index; rebuild_search_index repairs it
+            logger.warning(f'Failed to update the search index for {len(actions) // 2} sessions: {e}')
+
+    def remove_session(self, session_id):
+        try:
+            self.client.delete(index=self.index, id=str(session_id), params={'ignore': 404})
+        except Exception as e:
+            logger.warning(f'Failed to remove session {session_id} from the search index: {e}')
+
+    def _clause(self, field, term, prefix):
+        key, value = ('terms', f'{field}:{term}') if field else ('words', term)
+        return {'prefix' if prefix else 'term': {key: value}}
+
+    def search(self, clauses, filters, cursor=None, limit=25):
+        self._ensure_index()
+        query = [self._clause(*clause) for clause in clauses]
+        if filters.get('browser'):
+            query.append({'term': {'browser': filters['browser']}})
+        if filters.get('page'):
+            query.append({'term': {'page_url': filters['page']}})
+        if filters.get('date'):
+            day = filters['date'].isoformat()
+            query.append({'range': {'start_time': {'gte': day, 'lt': f'{day}||+1d'}}})
+        if filters.get('has_errors') is not None:
+            query.append({'term': {'has_errors': filters['has_errors']}})
+
+        size = self.config['FACET_SIZE']
+        body = {
+            'size': limit + 1,
+            'track_total_hits': False,
+            '_source': False,
+            'query': {'bool': {'filter': query}},
+            'sort': [{'start_time': 'desc'}, {'session_id': 'desc'}],
+            'aggs': {
+                'browser': {'terms': {'field': 'browser', 'size': size}},
+                'page': {'terms': {'field': 'page_url', 'size': size}},
+                'date': {'filter': {'range': {'start_time': {'gte': f"now-{self.config['FACET_DAYS']}d/d"}}},
+                         'aggs': {'days': {'date_histogram': {'field': 'start_time', 'calendar_interval': 'day',
+                                                              'min_doc_count': 1, 'order': {'_key': 'desc'}}}}},
+                'has_errors': {'terms': {'field': 'has_errors'}},
+            },
+        }
+        if cursor:
+            start_time, session_id = cursor
+            body['search_after'] = [int(start_time.timestamp() * 1000), str(session_id)]
+        response = self.client.search(index=self.index, body=body)
+
+        hits = response['hits']['hits']
+        aggregations = response.get('aggregations', {})
+        errors = {bucket['key_as_string']: bucket['doc_count'] for bucket in aggregations.get('has_errors', {}).get('buckets', [])}
+        return {
+            'ids': [hit['_id'] for hit in hits[:limit]],
+            'has_more': len(hits) > limit,
+            'facets': {
+                'browser': [[b['key'], b['doc_count']] for b in aggregations.get('browser', {}).get('buckets', [])],
+                'page': [[b['key'], b['doc_count']] for b in aggregations.get('page', {}).get('buckets', [])],
+                'date': [
+                    [b['key_as_string'][:10], b['doc_count']]
+                    for b in aggregations.get('date', {}).get('days', {}).get('buckets', [])
+                ],
+                'has_errors': {'true': errors.get('true', 0), 'false': errors.get('false', 0)},
+            },
+        }
+
+    def close(self):
+        self.client.close()
@@ -0,0 +1,60 @@
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, pre_delete
+from django.dispatch import receiver
+
+from . import stats
+from .bundles import remove_bundle_file
+from .chunks import session_event_count
+from .database import configure_connection
+from .models import DomSnapshotRef, ReplayBundle, Session, SessionArchive
+from .retention import remove_archive_file
+from .search import get_search_backend
+from .snapshots import release_snapshots
+
+
+@receiver(pre_delete, sender=Session)
+def update_session_counters(sender, instance, **kwargs):
+    # Count before the cascade removes the session's events
+    stats.increment(stats.SESSIONS, -1)
+    stats.increment(stats.EVENTS, -session_event_count(instance))
+    if instance.is_active:
+        stats.increment(stats.ACTIVE_SESSIONS, -1)
+
+
+@receiver(pre_delete, sender=Session)
+def collect_dom_snapshots(sender, instance, **kwargs):
+    # The cascade removes the references; remember which blobs they held
+    instance._dom_snapshot_blobs = list(
+        DomSnapshotRef.objects.filter(session=instance).values_list('blob_id', flat=True))
+
+
+@receiver(post_delete, sender=Session)
+def release_session_snapshots(sender, instance, **kwargs):
+    # Blobs are shared between sessions, so drop this session's references instead of cascading
+    release_snapshots([
+        instance.page_html_blob_id, instance.page_styles_blob_id, *getattr(instance, '_dom_snapshot_blobs', ()),
+    ])
+
+
+@receiver(post_delete, sender=Session)
+def remove_session_from_search(sender, instance, **kwargs):
+    # The database index goes with the cascade; an external one is told once the delete commits
+    session_id = instance.id
+    transaction.on_commit(lambda: get_search_backend().remove_session(session_id))
+
+
+@receiver(post_delete, sender=SessionArchive)
+def delete_archive_file(sender, instance, **kwargs):
+    # Only once the row is really gone; a rolled back delete still needs the file
+    transaction.on_commit(lambda: remove_archive_file(instance))
+
+
+@receiver(post_delete, sender=ReplayBundle)
+def delete_bundle_file(sender, instance, **kwargs):
+    transaction.on_commit(lambda: remove_bundle_file(instance))
+
+
+@receiver(connection_created)
+def tune_connection(sender, connection, **kwargs):
+    configure_connection(connection)
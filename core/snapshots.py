@@ -0,0 +1,110 @@
+"""
+Content-addressed storage for page HTML and style snapshots.
+
+Sessions captured on the same page share one compressed SnapshotBlob per
+distinct content instead of storing megabytes inline on every Session.
+Clients may announce a snapshot by hash alone and upload the body only
+when the server reports it missing. DOM snapshot trees (core/dom.py) are
+stored in the same blobs.
+
+Every transaction here writes before it reads (see core/database.py).
+"""
+import hashlib
+import zlib
+
+from django.db import transaction
+from django.db.models import F, ProtectedError
+
+from .models import DomSnapshotRef, SnapshotBlob
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+def content_hash(content):
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def is_valid_hash(value):
+    return isinstance(value, str) and len(value) == 64 and all(c in '0123456789abcdef' for c in value)
+
+
+def _body(content):
+    """The SnapshotBlob fields holding ``content``."""
+    raw = content.encode()
+    data = zlib.compress(raw, 6)
+    return {'data': data, 'size': len(raw), 'compressed_size': len(data)}
+
+
+def _fill(hash, content):
+    """Store the body of a blob that doesn't have one yet. Returns whether it was stored."""
+    if not SnapshotBlob.objects.filter(hash=hash, data__isnull=True).exists():
+        return False
+    return bool(SnapshotBlob.objects.filter(hash=hash, data__isnull=True).update(**_body(content)))
+
+
+def reference_snapshot(content=None, hash=None):
+    """Take a reference on a snapshot and return its blob.
+
+    Pass the content itself, or only its hash to create a pending blob the
+    client uploads later. Returns None when neither is given.
+    """
+    if content:
+        hash = content_hash(content)
+    elif not hash:
+        return None
+    elif not is_valid_hash(hash):
+        raise SnapshotError(f'Invalid snapshot hash: {hash}')
+
+    with transaction.atomic():
+        SnapshotBlob.objects.bulk_create([SnapshotBlob(hash=hash)], ignore_conflicts=True)
+        # Also takes the row lock on PostgreSQL, so only one reference fills the body
+        SnapshotBlob.objects.filter(hash=hash).update(refcount=F('refcount') + 1)
+        if content:
+            _fill(hash, content)
+        return SnapshotBlob.objects.get(hash=hash)
+
+
+def upload_snapshot(hash, content):
+    """Store the body of a snapshot previously announced by hash."""
+    if not isinstance(content, str):
+        raise SnapshotError('Snapshot content must be a string')
+    if content_hash(content) != hash:
+        raise SnapshotError('Snapshot content does not match its hash')
+
+    # Clients upload only bodies reported missing, so the body is compressed up front
+    SnapshotBlob.objects.filter(hash=hash, data__isnull=True).update(**_body(content))
+    blob = SnapshotBlob.objects.filter(hash=hash).first()
+    if blob is None:
+        # Only bodies for hashes a session references are accepted
+        raise SnapshotError(f'Unknown snapshot: {hash}')
+    return blob
+
+
+def attach_snapshot(session_id, content):
+    """Store ``content`` and reference it from the session once, however often the session attaches it."""
+    hash = content_hash(content)
+    with transaction.atomic():
+        SnapshotBlob.objects.bulk_create([SnapshotBlob(hash=hash)], ignore_conflicts=True)
+        _, created = DomSnapshotRef.objects.get_or_create(session_id=session_id, blob_id=hash)
+        if created:
+            SnapshotBlob.objects.filter(hash=hash).update(refcount=F('refcount') + 1)
+        _fill(hash, content)
+        return SnapshotBlob.objects.get(hash=hash)
+
+
+def release_snapshots(hashes):
+    """Drop one reference per hash and delete blobs nobody uses any more."""
+    hashes = [hash for hash in hashes if hash]
+    for hash in hashes:
+        SnapshotBlob.objects.filter(hash=hash).update(refcount=F('refcount') - 1)
+    try:
+        SnapshotBlob.objects.filter(hash__in=hashes, refcount__lte=0).delete()
+    except ProtectedError:
+        # A new session picked the blob up again in the meantime
+        pass
+
+
+def missing_snapshots(*blobs):
+    return [blob.hash for blob in blobs if blob is not None and blob.data is None]
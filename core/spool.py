@@ -0,0 +1,320 @@
+"""
+Write-ahead spool for ingested events.
+
+With ``TELEMETRY_SPOOL['ENABLED']`` set, flushed batches are appended and
+fsynced to local segment files instead of written to the database, and
+``manage.py drain_spool`` writes them through in bulk. Segments hold
+length-prefixed records::
+
+    length (u32) | crc32 (u32) | payload
+
+The drainer commits its position in each segment (SpoolCheckpoint) with the
+events themselves, so a crash on either side neither loses nor duplicates
+records.
+"""
+import atexit
+import fcntl
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import transaction
+
+from .backends import get_backends
+from .bundles import discard_stale_bundles
+from .dom import store_dom_snapshots
+from .models import Event, Session, SpoolCheckpoint
+from .search import index_events
+from .summaries import update_summaries
+
+logger = logging.getLogger(__name__)
+
+SPOOL_DEFAULTS = {
+    'ENABLED': False,
+    'DIR': 'spool',
+    'SEGMENT_BYTES': 16 * 1024 * 1024,  # Seal the open segment once it reaches this size
+    'FSYNC_DELAY': 0.002,  # Seconds an fsync waits for concurrent appends to join it
+}
+
+RECORD = struct.Struct('<II')
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+class SpoolError(Exception):
+    pass
+
+
+def get_spool_settings():
+    return {**SPOOL_DEFAULTS, **getattr(settings, 'TELEMETRY_SPOOL', {})}
+
+
+def get_spool_writer():
+    """Return this process's writer, or None when the spool is disabled."""
+    global _writer
+    config = get_spool_settings()
+    if not config['ENABLED']:
+        return None
+    with _writer_lock:
+        if _writer is None:
+            _writer = SpoolWriter(config['DIR'], config['SEGMENT_BYTES'], config['FSYNC_DELAY'])
+        return _writer
+
+
+def close_spool_writer():
+    global _writer
+    with _writer_lock:
+        writer, _writer = _writer, None
+    if writer is not None:
+        writer.close()
+
+
+atexit.register(close_spool_writer)
+
+
+def encode_record(events):
+    sessions = {}
+    for event in events:
+        timestamp = (event.timestamp - EPOCH) // timedelta(microseconds=1)
+        sessions.setdefault(str(event.session_id), []).append([event.type, timestamp, event.data])
+    return json.dumps(sessions, separators=(',', ':')).encode()
+
+
+def decode_record(payload):
+    return [
+        Event(session_id=session_id, type=event_type, timestamp=EPOCH + timedelta(microseconds=timestamp), data=data)
+        for session_id, events in json.loads(payload).items()
+        for event_type, timestamp, data in events
+    ]
+
+
+class SpoolWriter:
+    """Appends records to the open segment of one process.
+
+    ``write`` blocks until the record is on disk. A background thread issues
+    the fsyncs, so every append that arrives while one is running is made
+    durable by the next.
+    """
+
+    def __init__(self, directory, segment_bytes, fsync_delay=0.0):
+        self.directory = str(directory)
+        self.segment_bytes = segment_bytes
+        self.fsync_delay = fsync_delay
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.written = 0  # Bytes appended by this writer across all its segments
+        self.synced = 0  # Of those, bytes known to be on disk
+        self._error = None
+        self._lock = threading.Lock()  # Guards appends and the current file
+        self._sync_lock = threading.Lock()  # Held while the current file is fsynced or closed
+        self._durable = threading.Condition()
+        self._dirty = threading.Event()
+        self._file = None
+        self._open_segment()
+        self._syncer = threading.Thread(target=self._sync_loop, name='spool-fsync', daemon=True)
+        self._syncer.start()
+
+    def write(self, payload):
+        record = RECORD.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            if self._file is None:
+                raise SpoolError('Spool writer is closed')
+            self._file.write(record)
+            self.written += len(record)
+            self._segment_size += len(record)
+            position = self.written
+            if self._segment_size >= self.segment_bytes:
+                self._seal()
+                self._open_segment()
+        self._dirty.set()
+
+        with self._durable:
+            while self.synced < position and self._error is None:
+                self._durable.wait()
+            if self._error is not None:
+                raise SpoolError(f'Spool fsync failed: {self._error}')
+
+    def close(self):
+        with self._lock:
+            if self._file is None:
+                return
+            self._seal()
+            self._file = None
+        self._dirty.set()
+        self._syncer.join()
+
+    def _open_segment(self):
+        self.segment = f'{time.time_ns():020d}-{os.getpid()}'
+        self._path = os.path.join(self.directory, f'{self.segment}.open')
+        self._file = open(self._path, 'ab')
+        # Tells the drainer this segment still has a live writer
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._segment_size = 0
+
+    def _seal(self):
+        """Sync, rename to ``.seg`` and close the open segment. Called with ``_lock`` held."""
+        self._file.flush()
+        with self._sync_lock:
+            os.fsync(self._file.fileno())
+            # Rename while the flock is still held so the drainer never sees it as abandoned
+            os.replace(self._path, os.path.join(self.directory, f'{self.segment}.seg'))
+            self._file.close()
+        self._mark_synced(self.written)
+
+    def _sync_loop(self):
+        while True:
+            self._dirty.wait()
+            if self.fsync_delay:
+                time.sleep(self.fsync_delay)
+            self._dirty.clear()
+            with self._lock:
+                file = self._file
+                if file is None:
+                    return
+                position = self.written
+                try:
+                    file.flush()
+                except OSError as e:
+                    self._fail(e)
+                    continue
+            with self._sync_lock:
+                if file.closed:
+                    # Sealed in the meantime, which synced everything up to position
+                    continue
+                try:
+                    os.fsync(file.fileno())
+                except OSError as e:
+                    self._fail(e)
+                    continue
+            self._mark_synced(position)
+
+    def _mark_synced(self, position):
+        with self._durable:
+            self.synced = max(self.synced, position)
+            self._durable.notify_all()
+
+    def _fail(self, error):
+        logger.error(f'Spool fsync failed for {self._path}: {error}')
+        with self._durable:
+            self._error = error
+            self._durable.notify_all()
+
+
+def read_records(path, offset=0):
+    """Yield ``(payload, end_offset)`` for each complete record after ``offset``.
+
+    Stops at the first short or corrupt record: the tail an open segment is
+    still writing, or one torn by a crash.
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            length, crc = RECORD.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                return
+            offset += RECORD.size + length
+            yield payload, offset
+
+
+def _is_abandoned(path):
+    with open(path, 'rb') as f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+
+def list_segments(directory):
+    """Return ``(name, path, sealed)`` for each segment, oldest first.
+
+    Open segments whose writer is gone are sealed on the way.
+    """
+    segments = []
+    for filename in sorted(os.listdir(directory)):
+        name, ext = os.path.splitext(filename)
+        path = os.path.join(directory, filename)
+        try:
+            if ext == '.open' and _is_abandoned(path):
+                sealed_path = os.path.join(directory, f'{name}.seg')
+                os.replace(path, sealed_path)
+                logger.warning(f'Sealed abandoned spool segment {name}')
+                segments.append((name, sealed_path, True))
+                continue
+        except FileNotFoundError:
+            # Sealed by its writer since the listing; picked up as .seg next time
+            continue
+        if ext in ('.open', '.seg'):
+            segments.append((name, path, ext == '.seg'))
+    return segments
+
+
+def drain_spool(directory=None, batch_size=1000):
+    """Replay spooled events into the storage backends. Returns the number written."""
+    directory = str(directory or get_spool_settings()['DIR'])
+    if not os.path.isdir(directory):
+        return 0
+
+    segments = list_segments(directory)
+    # Rows for segments whose file was already removed
+    SpoolCheckpoint.objects.exclude(segment__in=[name for name, _, _ in segments]).delete()
+    checkpoints = dict(SpoolCheckpoint.objects.values_list('segment', 'offset'))
+
+    total = 0
+    for name, path, sealed in segments:
+        offset = committed = checkpoints.get(name, 0)
+        events = []
+        try:
+            for payload, offset in read_records(path, offset):
+                events.extend(decode_record(payload))
+                if len(events) >= batch_size:
+                    total += _commit(name, events, offset)
+                    events, committed = [], offset
+        except FileNotFoundError:
+            # An open segment its writer sealed since the listing; drained as .seg next time
+            continue
+        # A sealed segment is removed below, so its position only matters when there are events
+        if offset != committed and (events or not sealed):
+            total += _commit(name, events, offset)
+
+        if sealed:
+            size = os.path.getsize(path)
+            if offset < size:
+                logger.warning(f'Discarded {size - offset} bytes of torn records at the end of spool segment {name}')
+            # File first: a leftover checkpoint row is harmless, a leftover file would be replayed again
+            os.remove(path)
+            SpoolCheckpoint.objects.filter(segment=name).delete()
+    return total
+
+
+def _commit(segment, events, offset):
+    # Sessions deleted while their events sat in the spool
+    session_ids = {event.session_id for event in events}
+    existing = {str(pk) for pk in Session.objects.filter(id__in=session_ids).values_list('id', flat=True)}
+    events = [event for event in events if event.session_id in existing]
+
+    with transaction.atomic():
+        if events:
+            stored = store_dom_snapshots(events)
+            for backend in get_backends():
+                backend.write_events(stored)
+            update_summaries(events)
+            index_events(events)
+            discard_stale_bundles(existing)
+        # Not update_or_create, which reads first (see core/database.py);
+        # without events this is the transaction's first statement
+        if not SpoolCheckpoint.objects.filter(segment=segment).update(offset=offset):
+            SpoolCheckpoint.objects.bulk_create([SpoolCheckpoint(segment=segment, offset=offset)], ignore_conflicts=True)
+    return len(events)
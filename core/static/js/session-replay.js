@@ -1,3 +1,8 @@
+// Recorded elements never rebuilt during replay: they would run script or load another document
+const BLOCKED_DOM_TAGS = new Set([
+    'script', 'noscript', 'iframe', 'frame', 'frameset', 'object', 'embed', 'applet', 'meta', 'base', 'portal'
+]);
+
 class SessionReplay {
     constructor(sessionData) {
         if (!sessionData) {
@@ -5,19 +10,35 @@ class SessionReplay {
             return;
         }
         
-        console.log('Initializing session replay with data:', {
-            events: sessionData.events?.length || 0,
-            firstEvent: sessionData.events?.[0],
-            lastEvent: sessionData.events?.[sessionData.events?.length - 1]
-        });
+        console.log('Initializing session replay with data:', sessionData);
         
         this.sessionData = sessionData;
-        this.events = sessionData.events || [];
+        // Events are streamed from the server in time windows; this.events only
+        // holds the windows around the playhead, up to this.loadedUntil
+        this.events = [];
         this.currentEventIndex = 0;
+        this.startTimestamp = sessionData.start;
+        this.endTimestamp = sessionData.end;
+        this.windowSize = sessionData.window || 30000;
+        this.currentTime = sessionData.start;
+        this.loadedUntil = sessionData.start;
+        this.loading = null;
+        this.generation = 0;
+        // Keyframes hold cumulative replay state so seeks don't replay from the start
+        this.keyframes = [];
+        this.silentUntil = 0;
         this.isPlaying = false;
         this.playbackSpeed = 1.0;
-        this.startTime = null;
-        this.lastTimestamp = null;
+        this.maxBufferedEvents = 20000;
+        // Recorded DOM nodes by the ids telemetry.js gave them (see core/dom.py)
+        this.domNodes = new Map();
+        this.domRebuilt = false;
+        this.frameReady = false;
+        // Input values are re-applied when a DOM snapshot replaces the elements holding them
+        this.inputValues = {};
+        // Ended sessions come as one cached bundle holding every event
+        this.bundled = Boolean(sessionData.bundle_url);
+        this.live = null;
         
         // Create cursor if it doesn't exist
         this.cursor = document.getElementById('cursor');
@@ -29,13 +50,172 @@ class SessionReplay {
         
         // Initialize DOM elements
         this.initializeElements();
+        this.setupEventListeners();
         
-        // Setup the replay frame and event listeners
+        if (this.bundled) {
+            this.loading = this.loadBundle()
+                .catch(error => {
+                    console.error('Error loading replay bundle, streaming windows instead:', error);
+                    this.bundled = false;
+                    this.events = [];
+                    this.currentEventIndex = 0;
+                    this.currentTime = this.startTimestamp;
+                    this.loadedUntil = this.startTimestamp;
+                })
+                .finally(() => {
+                    this.loading = null;
+                    if (!this.bundled) {
+                        this.loadWindowed();
+                    } else if (!this.isPlaying) {
+                        this.applyDueEvents(this.currentTime, true);
+                    }
+                    this.updateProgress();
+                });
+        } else {
+            this.loadWindowed();
+        }
+        this.updateProgress();
+    }
+    
+    // Fetch the page snapshot, seek index and first window in parallel
+    loadWindowed() {
+        this.loadSnapshot();
+        this.loadIndex();
+        if (this.startTimestamp !== null) {
+            this.loadNextWindow();
+        }
+    }
+    
+    // Stream the bundle: a header line with the snapshot and seek index, then every event.
+    // Playback can start while the rest is still arriving.
+    async loadBundle() {
+        const response = await fetch(this.sessionData.bundle_url);
+        if (!response.ok) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffered = '';
+        let header = null;
+        const addLine = (line) => {
+            if (!line) return;
+            if (header === null) {
+                header = JSON.parse(line);
+                this.sessionData.page_html = header.snapshot.page_html;
+                this.sessionData.page_styles = header.snapshot.page_styles;
+                this.keyframes = header.keyframes || [];
+                this.seekIndex = header.seek_index || [];
+                this.setupReplayFrame();
+                return;
+            }
+            const event = JSON.parse(line);
+            this.events.push(event);
+            this.loadedUntil = event.timestamp;
+        };
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            buffered += decoder.decode(value, { stream: true });
+            const lines = buffered.split('\n');
+            buffered = lines.pop();
+            lines.forEach(addLine);
+        }
+        addLine(buffered);
+        if (header === null) {
+            throw new Error('Empty replay bundle');
+        }
+        this.loadedUntil = this.endTimestamp + 1;
+    }
+    
+    async loadSnapshot() {
+        try {
+            const response = await fetch(this.sessionData.snapshot_url);
+            const snapshot = await response.json();
+            this.sessionData.page_html = snapshot.page_html;
+            this.sessionData.page_styles = snapshot.page_styles;
+        } catch (error) {
+            console.error('Error loading page snapshot:', error);
+        }
         this.setupReplayFrame();
-        this.setupEventListeners();
+    }
+    
+    async loadIndex() {
+        try {
+            const response = await fetch(this.sessionData.index_url);
+            const index = await response.json();
+            this.keyframes = index.keyframes || [];
+            this.seekIndex = index.seek_index || [];
+        } catch (error) {
+            console.error('Error loading replay index:', error);
+        }
+    }
+    
+    // Stream one NDJSON window of events, appending them as lines arrive.
+    // Resolves with the end of the window the server actually returned.
+    async fetchWindow(start, end, generation) {
+        const response = await fetch(`${this.sessionData.events_url}?start=${start}&end=${end}`);
+        if (!response.ok) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
         
-        // Log first few events for debugging
-        console.log('First few events:', this.events.slice(0, 3));
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffered = '';
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            buffered += decoder.decode(value, { stream: true });
+            const lines = buffered.split('\n');
+            buffered = lines.pop();
+            // Drop results from a window requested before the last seek
+            if (generation !== this.generation) return;
+            for (const line of lines) {
+                if (line) this.events.push(JSON.parse(line));
+            }
+        }
+        if (buffered && generation === this.generation) {
+            this.events.push(JSON.parse(buffered));
+        }
+        return parseInt(response.headers.get('X-Window-End'), 10) || end;
+    }
+    
+    loadNextWindow(end = null) {
+        if (this.bundled || this.loading || this.loadedUntil > this.endTimestamp) {
+            return this.loading;
+        }
+        
+        const start = this.loadedUntil;
+        const generation = this.generation;
+        this.loading = this.fetchWindow(start, end || start + this.windowSize, generation)
+            .then(windowEnd => {
+                if (generation === this.generation) {
+                    this.loadedUntil = windowEnd;
+                }
+            })
+            .catch(error => console.error('Error loading replay events:', error))
+            .finally(() => {
+                if (generation === this.generation) {
+                    this.loading = null;
+                }
+            });
+        return this.loading;
+    }
+    
+    // Keep the next window loading while the current one plays
+    prefetch() {
+        if (this.bundled) {
+            return;
+        }
+        if (this.loadedUntil - this.currentTime < this.windowSize / 2) {
+            this.loadNextWindow();
+        }
+        
+        // Forget events that have already been played to bound memory on long sessions
+        if (this.currentEventIndex > this.maxBufferedEvents) {
+            this.events.splice(0, this.currentEventIndex);
+            this.currentEventIndex = 0;
+        }
     }
     
     initializeElements() {
@@ -56,9 +236,74 @@ class SessionReplay {
             this.playbackSpeed = parseFloat(e.target.value);
         });
         this.progressBar.addEventListener('input', (e) => {
+            this.stopLive();
             const progress = e.target.value / 100;
             this.seekToProgress(progress);
         });
+        
+        this.liveBtn = document.getElementById('live');
+        if (this.liveBtn) {
+            this.liveBtn.addEventListener('click', () => {
+                if (this.live) {
+                    this.stopLive();
+                } else {
+                    this.startLive();
+                }
+            });
+        }
+    }
+    
+    // Follow an active session over a WebSocket; the server sends throttled frames we ack
+    startLive() {
+        this.pause();
+        if (this.endTimestamp !== null) {
+            this.seekTo(this.endTimestamp);
+        }
+        
+        const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+        const socket = new WebSocket(`${protocol}//${window.location.host}${this.sessionData.live_url}`);
+        this.live = socket;
+        this.liveBtn.textContent = 'Stop live';
+        
+        socket.onmessage = (message) => {
+            const data = JSON.parse(message.data);
+            if (data.type === 'frame') {
+                for (const event of data.events) {
+                    this.playEvent(event);
+                    if (this.startTimestamp === null) {
+                        this.startTimestamp = event.timestamp;
+                    }
+                    this.endTimestamp = Math.max(this.endTimestamp || event.timestamp, event.timestamp);
+                }
+                // Keep the timeline at the live edge; played events aren't buffered for replay
+                this.currentTime = this.endTimestamp;
+                this.loadedUntil = this.endTimestamp;
+                this.events = [];
+                this.currentEventIndex = 0;
+                this.updateProgress();
+                socket.send(JSON.stringify({ type: 'ack', frame: data.frame }));
+            } else if (data.type === 'session_ended') {
+                this.liveBtn.disabled = true;
+                this.liveBtn.textContent = 'Session ended';
+            }
+        };
+        socket.onclose = () => {
+            if (this.live === socket) {
+                this.live = null;
+                if (!this.liveBtn.disabled) {
+                    this.liveBtn.textContent = 'Watch live';
+                }
+            }
+        };
+    }
+    
+    stopLive() {
+        if (this.live) {
+            const socket = this.live;
+            this.live = null;
+            socket.close();
+            this.liveBtn.textContent = 'Watch live';
+        }
     }
     
     togglePlayPause() {
@@ -70,59 +315,81 @@ class SessionReplay {
     }
     
     play() {
-        if (this.currentEventIndex >= this.events.length) {
-            this.currentEventIndex = 0;
+        if (this.startTimestamp === null) {
+            return;
+        }
+        this.stopLive();
+        if (this.currentTime >= this.endTimestamp) {
+            this.seekTo(this.startTimestamp);
         }
         
         this.isPlaying = true;
         this.playPauseBtn.textContent = 'Pause';
-        this.startTime = Date.now() - (this.currentEventIndex > 0 ? this.events[this.currentEventIndex].timestamp : 0);
-        this.playNextEvent();
+        this.lastFrame = performance.now();
+        this.nextFrame = requestAnimationFrame(() => this.tick());
     }
     
     pause() {
         this.isPlaying = false;
         this.playPauseBtn.textContent = 'Play';
-        if (this.nextEventTimeout) {
-            clearTimeout(this.nextEventTimeout);
+        if (this.nextFrame) {
+            cancelAnimationFrame(this.nextFrame);
         }
     }
     
-    playNextEvent() {
-        if (!this.isPlaying || this.currentEventIndex >= this.events.length) {
-            if (this.currentEventIndex >= this.events.length) {
-                this.pause();
-                this.currentEventIndex = 0;
-                this.updateProgress();
-            }
+    // Advance the playback clock and apply every event that is now due
+    tick() {
+        if (!this.isPlaying) {
             return;
         }
         
-        const currentEvent = this.events[this.currentEventIndex];
-        const nextEvent = this.events[this.currentEventIndex + 1];
+        const now = performance.now();
+        const target = Math.min(
+            this.currentTime + (now - this.lastFrame) * this.playbackSpeed,
+            this.endTimestamp
+        );
+        this.lastFrame = now;
+        
+        // Wait for the next window rather than playing past loaded events
+        if (target >= this.loadedUntil && this.loadedUntil <= this.endTimestamp) {
+            this.loadNextWindow();
+            this.nextFrame = requestAnimationFrame(() => this.tick());
+            return;
+        }
         
-        this.playEvent(currentEvent);
+        this.applyDueEvents(target, false);
+        this.currentTime = target;
+        this.prefetch();
+        this.updateProgress();
         
-        if (nextEvent) {
-            const delay = (nextEvent.timestamp - currentEvent.timestamp) / this.playbackSpeed;
-            this.nextEventTimeout = setTimeout(() => {
-                this.currentEventIndex++;
-                this.playNextEvent();
-            }, delay);
-        } else {
+        if (this.currentTime >= this.endTimestamp) {
+            this.pause();
+            return;
+        }
+        this.nextFrame = requestAnimationFrame(() => this.tick());
+    }
+    
+    // Apply buffered events up to the target time; silent skips animations while seeking
+    applyDueEvents(target, silent) {
+        while (this.currentEventIndex < this.events.length && this.events[this.currentEventIndex].timestamp <= target) {
+            const event = this.events[this.currentEventIndex];
+            // Events a seek skipped over are applied silently even once playback resumes
+            this.playEvent(event, silent || event.timestamp < this.silentUntil);
             this.currentEventIndex++;
-            this.playNextEvent();
         }
-        
-        this.updateProgress();
     }
     
-    playEvent(event) {
+    playEvent(event, silent = false) {
         if (!event || !event.type) {
             console.warn('Invalid event:', event);
             return;
         }
         
+        if (silent) {
+            this.applyEventState(event);
+            return;
+        }
+        
         console.log('Playing event:', {
             type: event.type,
             data: event.data,
@@ -162,14 +429,214 @@ class SessionReplay {
                 }
                 break;
                 
+            case 'input':
+                this.applyEventState(event);
+                break;
+
+            case 'error':
+                console.log('Recorded page error:', event.data && event.data.message);
+                break;
+                
+            case 'dom_snapshot':
+            case 'dom_mutation':
+                this.applyEventState(event);
+                break;
+                
             default:
                 console.log('Unhandled event type:', event.type);
         }
         
-        // Update time display
-        if (event.timestamp) {
-            const elapsed = event.timestamp - this.events[0].timestamp;
-            this.timeDisplay.textContent = this.formatTime(elapsed);
+    }
+    
+    // Apply only the lasting effect of an event (cursor, scroll, input value)
+    applyEventState(event) {
+        const data = event.data || {};
+        switch (event.type) {
+            case 'mousemove':
+            case 'click':
+                if (typeof data.x === 'number' && typeof data.y === 'number') {
+                    this.moveCursor(data.x, data.y);
+                }
+                break;
+            case 'scroll':
+                this.scrollViewport(data.x || 0, data.y || 0);
+                break;
+            case 'input':
+                if (data.selector) {
+                    this.setInputValue(data.selector, data.value);
+                }
+                break;
+            case 'dom_snapshot':
+                this.applyDomSnapshot(data.tree);
+                break;
+            case 'dom_mutation':
+                this.applyDomMutations(data.ops || []);
+                break;
+        }
+    }
+    
+    frameDocument() {
+        const frame = document.getElementById('replay-frame');
+        return frame && (frame.contentDocument || frame.contentWindow.document);
+    }
+    
+    // Replace the frame's document element with a recorded DOM snapshot
+    applyDomSnapshot(tree) {
+        const doc = this.frameDocument();
+        if (!tree || !doc || !this.frameReady) return;
+        this.domNodes = new Map();
+        const root = this.buildDomNode(doc, tree);
+        if (!root) return;
+        doc.replaceChild(root, doc.documentElement);
+        this.domRebuilt = true;
+        this.decorateReplayDocument(doc);
+        for (const [selector, value] of Object.entries(this.inputValues)) {
+            this.setInputValue(selector, value);
+        }
+    }
+    
+    // Apply one animation frame of recorded mutations, in order
+    applyDomMutations(ops) {
+        const doc = this.frameDocument();
+        if (!doc || !this.frameReady) return;
+        for (const op of ops) {
+            switch (op[0]) {
+                case 'remove': {
+                    const node = this.domNodes.get(op[1]);
+                    if (node && node.parentNode) {
+                        node.parentNode.removeChild(node);
+                    }
+                    this.domNodes.delete(op[1]);
+                    break;
+                }
+                case 'add': {
+                    const parent = this.domNodes.get(op[1]);
+                    const node = parent && this.buildDomNode(doc, op[3]);
+                    if (!node) break;
+                    // Insert after the named sibling, or as the first child
+                    const after = op[2] === null ? null : this.domNodes.get(op[2]);
+                    let before = null;
+                    if (op[2] === null) {
+                        before = parent.firstChild;
+                    } else if (after && after.parentNode === parent) {
+                        before = after.nextSibling;
+                    }
+                    parent.insertBefore(node, before);
+                    break;
+                }
+                case 'attr': {
+                    const element = this.domNodes.get(op[1]);
+                    if (element && element.nodeType === Node.ELEMENT_NODE) {
+                        this.setDomAttribute(element, op[2], op[3]);
+                    }
+                    break;
+                }
+                case 'text': {
+                    const node = this.domNodes.get(op[1]);
+                    if (node && node.nodeType === Node.TEXT_NODE) {
+                        node.data = op[2];
+                    }
+                    break;
+                }
+            }
+        }
+    }
+    
+    buildDomNode(doc, node) {
+        if (!node) return null;
+        if ('text' in node) {
+            const text = doc.createTextNode(node.text);
+            this.domNodes.set(node.id, text);
+            return text;
+        }
+        const tag = String(node.tag || '').toLowerCase();
+        // Nothing recorded may run or load another document inside the replay frame
+        if (!tag || BLOCKED_DOM_TAGS.has(tag)) return null;
+        let element;
+        try {
+            element = node.ns ? doc.createElementNS(node.ns, tag) : doc.createElement(tag);
+        } catch (error) {
+            console.warn('Invalid recorded element:', tag);
+            return null;
+        }
+        for (const [name, value] of Object.entries(node.attrs || {})) {
+            this.setDomAttribute(element, name, value);
+        }
+        for (const child of node.children || []) {
+            const built = this.buildDomNode(doc, child);
+            if (built) {
+                element.appendChild(built);
+            }
+        }
+        this.domNodes.set(node.id, element);
+        return element;
+    }
+    
+    setDomAttribute(element, name, value) {
+        // Event handlers, inline documents and script URLs would run in the replay frame
+        name = String(name);
+        if (/^on/i.test(name) || name.toLowerCase() === 'srcdoc') return;
+        if (value === null) {
+            element.removeAttribute(name);
+            return;
+        }
+        // Browsers ignore control characters and whitespace inside a URL scheme
+        if (/^(javascript:|vbscript:|data:text\/html)/i.test(String(value).replace(/[\u0000-\u0020]/g, ''))) return;
+        try {
+            element.setAttribute(name, value);
+        } catch (error) {
+            console.warn('Invalid recorded attribute:', name);
+        }
+    }
+    
+    // Back to the static page snapshot, for seeks to before the first DOM snapshot
+    resetDom() {
+        if (this.domRebuilt) {
+            this.domRebuilt = false;
+            this.domNodes = new Map();
+            this.setupReplayFrame();
+        }
+    }
+    
+    applyKeyframe(keyframe) {
+        if (keyframe.cursor) {
+            this.moveCursor(keyframe.cursor.x, keyframe.cursor.y);
+        }
+        if (keyframe.scroll) {
+            this.scrollViewport(keyframe.scroll.x || 0, keyframe.scroll.y || 0);
+        }
+        this.inputValues = {};
+        for (const [selector, value] of Object.entries(keyframe.inputs || {})) {
+            this.setInputValue(selector, value);
+        }
+    }
+    
+    // Binary search for the last keyframe at or before the target time
+    findKeyframe(targetTime) {
+        let low = 0;
+        let high = this.keyframes.length;
+        while (low < high) {
+            const mid = (low + high) >> 1;
+            if (this.keyframes[mid].timestamp <= targetTime) {
+                low = mid + 1;
+            } else {
+                high = mid;
+            }
+        }
+        return low > 0 ? this.keyframes[low - 1] : null;
+    }
+    
+    setInputValue(selector, value) {
+        this.inputValues[selector] = value;
+        const doc = this.frameDocument();
+        if (!doc) return;
+        try {
+            const element = doc.querySelector(selector);
+            if (element) {
+                element.value = value;
+            }
+        } catch (error) {
+            console.warn('Invalid input selector:', selector);
         }
     }
     
@@ -271,33 +738,8 @@ class SessionReplay {
             doc.write(this.sessionData.page_html || '<!DOCTYPE html><html><body><p>No content available</p></body></html>');
             doc.close();
             
-            // Add the captured styles
-            if (this.sessionData.page_styles) {
-                const styleSheet = doc.createElement('style');
-                styleSheet.textContent = this.sessionData.page_styles;
-                doc.head.appendChild(styleSheet);
-            }
-            
-            // Add replay-specific styles
-            const replayStyles = doc.createElement('style');
-            replayStyles.textContent = `
-                * { cursor: none !important; }
-                a, button, input, textarea, select { pointer-events: none !important; }
-                body { overflow: auto !important; }
-                
-                /* Hide any fixed position elements that might overlap */
-                .fixed, [style*="position: fixed"] {
-                    position: absolute !important;
-                }
-            `;
-            doc.head.appendChild(replayStyles);
-            
-            // Disable all interactive elements
-            const interactiveElements = doc.querySelectorAll('a, button, input, textarea, select');
-            interactiveElements.forEach(el => {
-                el.addEventListener('click', e => e.preventDefault());
-                el.addEventListener('submit', e => e.preventDefault());
-            });
+            this.decorateReplayDocument(doc);
+            this.frameReady = true;
             
             console.log('Replay frame setup complete:', {
                 hasContent: doc.body.innerHTML.length > 0,
@@ -321,29 +763,103 @@ class SessionReplay {
         }
     }
     
-    seekToProgress(progress) {
-        if (!this.events.length) return;
+    // Captured styles and replay-only rules, added to every document the frame shows
+    decorateReplayDocument(doc) {
+        const head = doc.head || doc.documentElement.insertBefore(doc.createElement('head'), doc.documentElement.firstChild);
+        
+        // Add the captured styles
+        if (this.sessionData.page_styles) {
+            const styleSheet = doc.createElement('style');
+            styleSheet.textContent = this.sessionData.page_styles;
+            head.appendChild(styleSheet);
+        }
         
-        const totalDuration = this.events[this.events.length - 1].timestamp - this.events[0].timestamp;
-        const targetTime = this.events[0].timestamp + (totalDuration * progress);
+        // Add replay-specific styles
+        const replayStyles = doc.createElement('style');
+        replayStyles.textContent = `
+            * { cursor: none !important; }
+            a, button, input, textarea, select { pointer-events: none !important; }
+            body { overflow: auto !important; }
+            
+            /* Hide any fixed position elements that might overlap */
+            .fixed, [style*="position: fixed"] {
+                position: absolute !important;
+            }
+        `;
+        head.appendChild(replayStyles);
+        
+        // Disable all interactive elements
+        const interactiveElements = doc.querySelectorAll('a, button, input, textarea, select');
+        interactiveElements.forEach(el => {
+            el.addEventListener('click', e => e.preventDefault());
+            el.addEventListener('submit', e => e.preventDefault());
+        });
+    }
+    
+    seekToProgress(progress) {
+        if (this.startTimestamp === null) return;
         
-        this.currentEventIndex = this.events.findIndex(event => event.timestamp > targetTime);
-        if (this.currentEventIndex === -1) {
-            this.currentEventIndex = this.events.length;
+        const totalDuration = this.endTimestamp - this.startTimestamp;
+        this.seekTo(this.startTimestamp + (totalDuration * progress));
+    }
+    
+    seekTo(targetTime) {
+        if (targetTime >= this.currentTime && targetTime < this.loadedUntil) {
+            // Forward within the buffer: apply the skipped events without animation
+            this.applyDueEvents(targetTime, true);
+        } else if (this.bundled) {
+            // Every event is (or will be) in the buffer, at the offsets the keyframes name
+            const keyframe = this.findKeyframe(targetTime);
+            // From the DOM snapshot before the keyframe when there is one, so the page is rebuilt too
+            this.currentEventIndex = keyframe ? (keyframe.dom || keyframe).offset : 0;
+            if (!keyframe || !keyframe.dom) {
+                this.resetDom();
+            }
+            if (keyframe) {
+                this.applyKeyframe(keyframe);
+            }
+            this.silentUntil = targetTime;
+            this.applyDueEvents(targetTime, true);
+        } else {
+            // Restore state from the nearest keyframe, then stream from its timestamp
+            const keyframe = this.findKeyframe(targetTime);
+            this.generation++;
+            this.loading = null;
+            this.events = [];
+            this.currentEventIndex = 0;
+            // From the DOM snapshot before the keyframe when there is one, so the page is rebuilt too
+            this.loadedUntil = keyframe ? (keyframe.dom || keyframe).timestamp : this.startTimestamp;
+            if (!keyframe || !keyframe.dom) {
+                this.resetDom();
+            }
+            if (keyframe) {
+                this.applyKeyframe(keyframe);
+            }
+            this.silentUntil = targetTime;
+            
+            // Catch up on the events between the keyframe and the target once they arrive
+            const loading = this.loadNextWindow(targetTime + this.windowSize);
+            if (loading) {
+                loading.then(() => {
+                    if (!this.isPlaying) {
+                        this.applyDueEvents(this.currentTime, true);
+                    }
+                });
+            }
         }
         
+        this.currentTime = targetTime;
         this.updateProgress();
     }
     
     updateProgress() {
-        if (!this.events.length) return;
+        if (this.startTimestamp === null) return;
         
-        const currentTime = this.events[this.currentEventIndex]?.timestamp || 0;
-        const totalTime = this.events[this.events.length - 1].timestamp;
-        const progress = ((currentTime - this.events[0].timestamp) / (totalTime - this.events[0].timestamp)) * 100;
+        const elapsed = this.currentTime - this.startTimestamp;
+        const total = this.endTimestamp - this.startTimestamp;
         
-        this.progressBar.value = progress;
-        this.timeDisplay.textContent = `${this.formatTime(currentTime)} / ${this.formatTime(totalTime)}`;
+        this.progressBar.value = total > 0 ? (elapsed / total) * 100 : 0;
+        this.timeDisplay.textContent = `${this.formatTime(elapsed)} / ${this.formatTime(total)}`;
     }
     
     formatTime(ms) {
@@ -1,6 +1,39 @@
+// Event types sent in the packed binary format, keyed to their type codes in core/codec.py
+const PACKED_TYPES = { mousemove: 1, scroll: 2 };
+// Elements left out of DOM recording; replay never runs recorded scripts
+const UNRECORDED_TAGS = new Set(['script', 'noscript']);
+const XHTML_NS = 'http://www.w3.org/1999/xhtml';
+
 class Telemetry {
-    constructor() {
+    constructor(options = {}) {
         this.sessionId = null;
+        // Opt-in compact encoding for pointer and scroll samples
+        this.compact = Boolean(options.compact);
+        // Form values are recorded as asterisks unless the field matches one of these selectors
+        this.unmaskedInputs = options.unmaskedInputs || [];
+        // Events are queued and sent to the server in batch envelopes
+        this.queue = [];
+        this.seq = 0;
+        this.flushInterval = 2000;
+        // Backpressure from the server (see core/admission.py): flushes are held until holdUntil
+        // and the interval is stretched up to maxFlushInterval while slow-down hints keep coming
+        this.baseFlushInterval = this.flushInterval;
+        this.maxFlushInterval = 30000;
+        this.holdUntil = 0;
+        this.maxBatchSize = 100;
+        this.maxQueueSize = 1000;
+        // Minimum milliseconds between samples per type; replaced by the server's policy on session start
+        this.intervals = { mousemove: 50, scroll: 100, resize: 100 };
+        // Incremental DOM recording (see core/dom.py): nodes get ids, and changes are sent
+        // as one dom_mutation event per animation frame with a full dom_snapshot now and then
+        this.recordDom = options.recordDom !== false && 'MutationObserver' in window;
+        this.domSnapshotInterval = options.domSnapshotInterval || 60000;
+        this.maxMutationOps = 2000;  // A frame with more changes than this is sent as a snapshot
+        this.nodeIds = new WeakMap();
+        this.nextNodeId = 1;
+        this.pendingMutations = [];
+        this.mutationFrame = null;
+        this.domChanged = false;
         this.data = {
             pageUrl: window.location.href,
             pageTitle: document.title,
@@ -13,7 +46,6 @@ class Telemetry {
                 width: window.innerWidth,
                 height: window.innerHeight
             },
-            events: [],
             startTime: Date.now()
         };
 
@@ -27,10 +59,55 @@ class Telemetry {
             });
             
             // Send initial data
-            this.sendData('session_start', this.data);
+            this.startSession();
         }, 1000);
     }
 
+    async startSession() {
+        const start = { ...this.data };
+        const snapshots = {};
+
+        // Announce snapshots by hash so the server can skip bodies it already stores
+        if (window.crypto && crypto.subtle) {
+            for (const [field, hashField] of [['pageHtml', 'pageHtmlHash'], ['pageStyles', 'pageStylesHash']]) {
+                if (start[field]) {
+                    const hash = await this.sha256(start[field]);
+                    snapshots[hash] = start[field];
+                    start[hashField] = hash;
+                    delete start[field];
+                }
+            }
+        }
+
+        const result = await this.sendData('session_start', start);
+        for (const hash of (result && result.missing_snapshots) || []) {
+            this.uploadSnapshot(hash, snapshots[hash]);
+        }
+    }
+
+    async uploadSnapshot(hash, content) {
+        try {
+            const response = await fetch('/api/snapshots/', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                    'X-CSRFToken': this.getCSRFToken()
+                },
+                body: JSON.stringify({ hash, content })
+            });
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
+            }
+        } catch (error) {
+            console.error('Error uploading snapshot:', error);
+        }
+    }
+
+    async sha256(text) {
+        const digest = await crypto.subtle.digest('SHA-256', new TextEncoder().encode(text));
+        return Array.from(new Uint8Array(digest), byte => byte.toString(16).padStart(2, '0')).join('');
+    }
+
     async sendData(type, data) {
         try {
             const requestData = {
@@ -68,9 +145,18 @@ class Telemetry {
             if (type === 'session_start' && result.session_id) {
                 this.sessionId = result.session_id;
                 console.log('Session ID received:', this.sessionId);
+                // Sample at the rates the server keeps, so events it would drop aren't sent
+                if (result.sampling && result.sampling.enabled) {
+                    Object.assign(this.intervals, result.sampling.intervals);
+                }
                 // Setup event listeners only after we have a session ID
                 this.setupEventListeners();
+                this.startFlushing();
+                if (this.recordDom) {
+                    this.startDomRecording();
+                }
             }
+            return result;
         } catch (error) {
             console.error('Error sending data:', error);
         }
@@ -101,7 +187,7 @@ class Telemetry {
                 y: e.clientY,
                 timestamp: Date.now()
             });
-        }, 50));  // Reduced throttle time for smoother tracking
+        }, this.intervals.mousemove));
 
         // Mouse clicks
         document.addEventListener('click', (e) => {
@@ -132,13 +218,47 @@ class Telemetry {
                 y: scrollY,
                 timestamp: Date.now()
             });
-        }, 100));
+        }, this.intervals.scroll));
+
+        // Form field values, addressed by a selector that survives script removal in the snapshot
+        document.addEventListener('input', (e) => {
+            const target = e.target;
+            if (!target || !('value' in target)) return;
+            this.recordEvent('input', {
+                selector: this.getSelector(target),
+                name: target.name || '',
+                value: this.maskValue(target, target.value),
+                timestamp: Date.now()
+            });
+        });
 
         // Page visibility
         document.addEventListener('visibilitychange', () => {
             this.recordEvent('visibility', {
                 state: document.visibilityState
             });
+            // The page may never become visible again, so hand the queue to the browser
+            if (document.visibilityState === 'hidden') {
+                this.flushEvents(true);
+            }
+        });
+
+        window.addEventListener('pagehide', () => this.flushEvents(true));
+
+        // Uncaught errors and unhandled promise rejections
+        window.addEventListener('error', (e) => {
+            this.recordEvent('error', {
+                message: String(e.message || ''),
+                source: e.filename || '',
+                line: e.lineno || 0,
+                column: e.colno || 0
+            });
+        });
+        window.addEventListener('unhandledrejection', (e) => {
+            this.recordEvent('error', {
+                message: String(e.reason && e.reason.message || e.reason || ''),
+                source: 'unhandledrejection'
+            });
         });
 
         // Window resize
@@ -147,20 +267,372 @@ class Telemetry {
                 width: window.innerWidth,
                 height: window.innerHeight
             });
-        }, 100));
+        }, this.intervals.resize));
     }
 
     recordEvent(type, data = {}) {
         const event = {
             type,
             timestamp: Date.now(),
+            seq: ++this.seq,
             data
         };
 
-        this.data.events.push(event);
-        
-        // Send event
-        this.sendData('event', event);
+        // Queue event for the next batch
+        this.queue.push(event);
+        if (this.queue.length >= this.maxBatchSize) {
+            this.flushEvents();
+        }
+    }
+
+    startFlushing() {
+        this.flushTimer = setInterval(() => this.flushEvents(), this.flushInterval);
+    }
+
+    setFlushInterval(interval) {
+        if (interval === this.flushInterval) return;
+        this.flushInterval = interval;
+        clearInterval(this.flushTimer);
+        this.startFlushing();
+    }
+
+    slowDown(delay) {
+        this.holdUntil = Math.max(this.holdUntil, Date.now() + delay);
+        this.setFlushInterval(Math.min(this.maxFlushInterval, this.flushInterval * 2));
+    }
+
+    speedUp() {
+        this.setFlushInterval(Math.max(this.baseFlushInterval, Math.floor(this.flushInterval / 2)));
+    }
+
+    async flushEvents(useBeacon = false) {
+        // DOM changes still waiting for their animation frame go out with this flush
+        if (this.mutationFrame !== null) {
+            cancelAnimationFrame(this.mutationFrame);
+            this.flushMutations();
+        }
+        if (!this.sessionId || this.queue.length === 0) {
+            return;
+        }
+        // The server asked us to back off; a page that is going away still gets its beacon out
+        if (!useBeacon && Date.now() < this.holdUntil) {
+            this.queue = this.queue.slice(-this.maxQueueSize);
+            return;
+        }
+
+        const url = `/api/telemetry/?session_id=${encodeURIComponent(this.sessionId)}`;
+        let events = this.queue.splice(0, this.queue.length);
+
+        // Pointer and scroll samples go out as a compact binary frame when enabled.
+        // Beacons can't carry the CSRF header, so they always use the JSON envelope.
+        if (this.compact && !useBeacon) {
+            const pointer = events.filter(event => PACKED_TYPES[event.type]);
+            events = events.filter(event => !PACKED_TYPES[event.type]);
+            if (pointer.length > 0) {
+                this.postEvents(
+                    pointer,
+                    url,
+                    'application/octet-stream',
+                    this.encodePacked(pointer, Date.now())
+                );
+            }
+            if (events.length === 0) {
+                return;
+            }
+        }
+
+        const batch = {
+            type: 'batch',
+            session_id: this.sessionId,
+            sentAt: Date.now(),
+            events
+        };
+
+        if (useBeacon && navigator.sendBeacon) {
+            // Beacons can't carry headers, so the CSRF token travels as a form field
+            const form = new FormData();
+            form.append('csrfmiddlewaretoken', this.getCSRFToken() || '');
+            form.append('payload', JSON.stringify(batch));
+            if (navigator.sendBeacon(url, form)) {
+                return;
+            }
+        }
+
+        await this.postEvents(events, url, 'application/json', JSON.stringify(batch), useBeacon);
+    }
+
+    async postEvents(events, url, contentType, body, keepalive = false) {
+        try {
+            const response = await fetch(url, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': contentType,
+                    'X-CSRFToken': this.getCSRFToken()
+                },
+                body,
+                keepalive
+            });
+
+            if (response.status >= 500) {
+                throw new Error(`HTTP error! status: ${response.status}`);
+            }
+            const delay = Number(response.headers.get('X-Slow-Down'));
+            if (delay > 0) {
+                this.slowDown(delay);
+            } else {
+                this.speedUp();
+            }
+            if (response.status === 429) {
+                // Rate limited: the batch wasn't recorded, so it goes out again once the hold is over
+                this.queue = events.concat(this.queue).slice(-this.maxQueueSize);
+                return;
+            }
+            if (!response.ok) {
+                // The server rejected the batch itself; resending it won't help
+                console.error('Batch rejected:', await response.json());
+            }
+        } catch (error) {
+            console.error('Error sending batch:', error);
+            // Put the events back for the next flush, dropping the oldest if the queue is full
+            this.queue = events.concat(this.queue).slice(-this.maxQueueSize);
+        }
+    }
+
+    // Encode pointer samples in the packed format decoded by core/codec.py:
+    // a frame header, then per-type blocks of delta-encoded integer columns.
+    encodePacked(events, sentAt) {
+        const blocks = [];
+        let block = null;
+        for (const event of events) {
+            const sample = {
+                code: PACKED_TYPES[event.type],
+                t: Math.round(event.timestamp),
+                x: Math.round(event.data.x || 0),
+                y: Math.round(event.data.y || 0)
+            };
+            const last = block && block[block.length - 1];
+            const fits = last && last.code === sample.code && block.length < 0xFFFF
+                && sample.t - last.t >= 0 && sample.t - last.t <= 0xFFFF
+                && Math.abs(sample.x - last.x) <= 0x7FFF && Math.abs(sample.y - last.y) <= 0x7FFF;
+            if (!fits) {
+                block = [];
+                blocks.push(block);
+            }
+            block.push(sample);
+        }
+
+        const size = 11 + blocks.reduce((total, b) => total + 19 + (b.length - 1) * 6, 0);
+        const view = new DataView(new ArrayBuffer(size));
+        view.setUint8(0, 0x43);  // 'C'
+        view.setUint8(1, 0x53);  // 'S'
+        view.setUint8(2, 1);  // Format version
+        view.setBigUint64(3, BigInt(sentAt), true);
+
+        let offset = 11;
+        for (const b of blocks) {
+            view.setUint8(offset, b[0].code);
+            view.setUint16(offset + 1, b.length, true);
+            view.setBigUint64(offset + 3, BigInt(b[0].t), true);
+            view.setInt32(offset + 11, b[0].x, true);
+            view.setInt32(offset + 15, b[0].y, true);
+            offset += 19;
+
+            // Columns are stored one after another: all dt, then all dx, then all dy
+            const n = b.length - 1;
+            for (let i = 1; i <= n; i++) {
+                view.setUint16(offset + (i - 1) * 2, b[i].t - b[i - 1].t, true);
+                view.setInt16(offset + (n + i - 1) * 2, b[i].x - b[i - 1].x, true);
+                view.setInt16(offset + (2 * n + i - 1) * 2, b[i].y - b[i - 1].y, true);
+            }
+            offset += n * 6;
+        }
+        return view.buffer;
+    }
+
+    startDomRecording() {
+        this.recordDomSnapshot();
+        this.observer = new MutationObserver(records => {
+            for (const record of records) {
+                this.pendingMutations.push(record);
+            }
+            if (this.mutationFrame === null) {
+                this.mutationFrame = requestAnimationFrame(() => this.flushMutations());
+            }
+        });
+        this.observer.observe(document.documentElement, {
+            childList: true,
+            attributes: true,
+            characterData: true,
+            subtree: true
+        });
+        // Periodic snapshots are the replay's seek points; an unchanged page needs none
+        this.domSnapshotTimer = setInterval(() => {
+            if (this.domChanged) {
+                this.recordDomSnapshot();
+            }
+        }, this.domSnapshotInterval);
+    }
+
+    recordDomSnapshot() {
+        // The snapshot already shows whatever is pending
+        if (this.observer) {
+            this.observer.takeRecords();
+        }
+        this.pendingMutations = [];
+        if (this.mutationFrame !== null) {
+            cancelAnimationFrame(this.mutationFrame);
+            this.mutationFrame = null;
+        }
+        this.domChanged = false;
+        this.recordEvent('dom_snapshot', { tree: this.serializeNode(document.documentElement) });
+    }
+
+    nodeId(node) {
+        let id = this.nodeIds.get(node);
+        if (id === undefined) {
+            id = this.nextNodeId++;
+            this.nodeIds.set(node, id);
+        }
+        return id;
+    }
+
+    attributeValue(element, name) {
+        const value = element.getAttribute(name);
+        if (value !== null && name === 'value' && element instanceof HTMLInputElement) {
+            return this.maskValue(element, value);
+        }
+        return value;
+    }
+
+    // Passwords are never recorded; other values only for fields in unmaskedInputs
+    maskValue(element, value) {
+        if (element.type === 'password') {
+            return '';
+        }
+        if (this.unmaskedInputs.some((selector) => element.matches(selector))) {
+            return value;
+        }
+        return '*'.repeat(value.length);
+    }
+
+    // Serialize a node and its subtree, giving new nodes ids; null for nodes that aren't recorded
+    serializeNode(node, serialized = null) {
+        if (node.nodeType === Node.TEXT_NODE) {
+            if (serialized) serialized.add(node);
+            return { id: this.nodeId(node), text: node.data };
+        }
+        if (node.nodeType !== Node.ELEMENT_NODE) {
+            return null;
+        }
+        const tag = node.tagName.toLowerCase();
+        if (UNRECORDED_TAGS.has(tag)) {
+            return null;
+        }
+        if (serialized) serialized.add(node);
+        const result = { id: this.nodeId(node), tag, attrs: {}, children: [] };
+        if (node.namespaceURI && node.namespaceURI !== XHTML_NS) {
+            result.ns = node.namespaceURI;
+        }
+        for (const attr of node.attributes) {
+            result.attrs[attr.name] = this.attributeValue(node, attr.name);
+        }
+        for (const child of node.childNodes) {
+            const item = this.serializeNode(child, serialized);
+            if (item) result.children.push(item);
+        }
+        return result;
+    }
+
+    // Turn one frame's mutation records into id-addressed ops against the replayed DOM:
+    // removals first, then added subtrees in document order, then attribute and text changes
+    flushMutations() {
+        this.mutationFrame = null;
+        const records = this.pendingMutations.concat(this.observer ? this.observer.takeRecords() : []);
+        this.pendingMutations = [];
+        if (records.length === 0) {
+            return;
+        }
+
+        const ops = [];
+        const removed = new Set();
+        const added = new Set();
+        for (const record of records) {
+            if (record.type !== 'childList') continue;
+            for (const node of record.removedNodes) {
+                const id = this.nodeIds.get(node);
+                if (id !== undefined && !removed.has(id)) {
+                    removed.add(id);
+                    ops.push(['remove', id]);
+                }
+            }
+            for (const node of record.addedNodes) {
+                added.add(node);
+            }
+        }
+
+        // Only the topmost added nodes still in the page; their subtrees cover the rest
+        const roots = [];
+        for (const node of added) {
+            if (!node.isConnected || !this.nodeIds.has(node.parentNode)) continue;
+            let ancestor = node.parentNode;
+            while (ancestor && !added.has(ancestor)) {
+                ancestor = ancestor.parentNode;
+            }
+            if (!ancestor) roots.push(node);
+        }
+        roots.sort((a, b) => (a.compareDocumentPosition(b) & Node.DOCUMENT_POSITION_FOLLOWING ? -1 : 1));
+
+        const serialized = new Set();
+        for (const node of roots) {
+            // Earlier siblings are either already replayed or added just before this one
+            let after = node.previousSibling;
+            while (after && !this.nodeIds.has(after)) {
+                after = after.previousSibling;
+            }
+            const item = this.serializeNode(node, serialized);
+            if (item) {
+                ops.push(['add', this.nodeIds.get(node.parentNode), after ? this.nodeIds.get(after) : null, item]);
+            }
+        }
+
+        // Latest value per attribute and text node; freshly serialized nodes already carry it
+        const changes = new Map();
+        for (const record of records) {
+            const node = record.target;
+            if (record.type === 'childList' || serialized.has(node) || !node.isConnected || !this.nodeIds.has(node)) continue;
+            const id = this.nodeIds.get(node);
+            if (record.type === 'attributes') {
+                changes.set(`a${id}:${record.attributeName}`, ['attr', id, record.attributeName, this.attributeValue(node, record.attributeName)]);
+            } else if (record.type === 'characterData') {
+                changes.set(`t${id}`, ['text', id, node.data]);
+            }
+        }
+        ops.push(...changes.values());
+
+        if (ops.length > this.maxMutationOps) {
+            this.recordDomSnapshot();
+        } else if (ops.length > 0) {
+            this.domChanged = true;
+            this.recordEvent('dom_mutation', { ops });
+        }
+    }
+
+    // Build a CSS selector for an element using ids and :nth-of-type steps
+    getSelector(element) {
+        const steps = [];
+        while (element && element.nodeType === Node.ELEMENT_NODE && element !== document.documentElement) {
+            if (element.id) {
+                steps.unshift(`#${CSS.escape(element.id)}`);
+                break;
+            }
+            let index = 1;
+            for (let sibling = element.previousElementSibling; sibling; sibling = sibling.previousElementSibling) {
+                if (sibling.tagName === element.tagName) index++;
+            }
+            steps.unshift(`${element.tagName.toLowerCase()}:nth-of-type(${index})`);
+            element = element.parentElement;
+        }
+        return steps.join(' > ');
     }
 
     // Utility function to throttle event frequency
@@ -191,6 +663,8 @@ class Telemetry {
             for (const input of inputs) {
                 if (input.type === 'password' || input.type === 'hidden') {
                     input.value = '';
+                } else if (input.hasAttribute('value')) {
+                    input.setAttribute('value', this.maskValue(input, input.getAttribute('value')));
                 }
             }
             
@@ -262,5 +736,5 @@ class Telemetry {
 
 // Initialize telemetry when the page loads
 window.addEventListener('load', () => {
-    window.telemetry = new Telemetry();
+    window.telemetry = new Telemetry(window.clearsightConfig || {});
 });
@@ -0,0 +1,74 @@
+"""
+Running totals for the dashboard.
+
+Counting sessions and events with ``count()`` on every dashboard hit
+scans tables that grow to millions of rows, so the ingest paths keep
+StatsCounter rows up to date instead. ``rebuild_stats`` recomputes them
+from the tables if they ever drift.
+
+Every ingest transaction increments the events counter, so a single row
+would serialize all of them on its row lock. Each counter is therefore
+split over SHARDS rows (``events``, ``events#1``, ...): an increment
+updates one picked at random, and reading a counter sums them.
+"""
+import random
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from .chunks import total_event_count
+from .models import Session, StatsCounter
+
+SESSIONS = 'sessions'
+ACTIVE_SESSIONS = 'active_sessions'
+EVENTS = 'events'
+
+COUNTERS = (SESSIONS, ACTIVE_SESSIONS, EVENTS)
+
+STATS_DEFAULTS = {
+    'SHARDS': 16,  # Rows per counter; more lets more concurrent transactions increment without waiting
+}
+
+
+def get_stats_settings():
+    return {**STATS_DEFAULTS, **getattr(settings, 'TELEMETRY_STATS', {})}
+
+
+def shard_name(name, shard):
+    # Shard 0 keeps the counter's plain name, so single-row counters remain valid
+    return f'{name}#{shard}' if shard else name
+
+
+def increment(name, amount=1):
+    if not amount:
+        return
+    name = shard_name(name, random.randrange(get_stats_settings()['SHARDS']))
+    if not StatsCounter.objects.filter(name=name).update(value=F('value') + amount):
+        # First use of this shard: create it, tolerating a concurrent create
+        StatsCounter.objects.bulk_create([StatsCounter(name=name, value=0)], ignore_conflicts=True)
+        StatsCounter.objects.filter(name=name).update(value=F('value') + amount)
+
+
+def get_counters():
+    values = {name: 0 for name in COUNTERS}
+    # Shards are read whatever SHARDS is now, so lowering it loses nothing
+    for name, value in StatsCounter.objects.values_list('name', 'value'):
+        counter = name.partition('#')[0]
+        if counter in values:
+            values[counter] += value
+    return values
+
+
+def rebuild_counters():
+    """Recompute every counter from the tables."""
+    values = {
+        SESSIONS: Session.objects.count(),
+        ACTIVE_SESSIONS: Session.objects.filter(is_active=True).count(),
+        EVENTS: total_event_count(),
+    }
+    for name, value in values.items():
+        with transaction.atomic():
+            StatsCounter.objects.filter(name__startswith=f'{name}#').delete()
+            StatsCounter.objects.update_or_create(name=name, defaults={'value': value})
+    return values
@@ -0,0 +1,237 @@
+"""
+Per-session summary rollups and the idle session sweeper.
+
+Every batch written to the database (``record_events`` and the spool
+drain) also updates the SessionSummary of each session in it: one UPDATE
+with column arithmetic per session and batch, then the per-type counts are
+merged while that UPDATE holds the row lock, so concurrent batches of one
+session can't lose each other's counts. Listings and the detail view read
+the summary instead of counting or scanning events.
+
+The summary keeps counting archived events (see core/retention.py), so a
+session's totals don't drop when its events leave the hot tables.
+
+Sessions recorded over HTTP, and WebSocket sessions whose tab was closed
+without a clean disconnect, never get ``end_session``. ``sweep_sessions``
+(run by ``manage.py sweep_sessions``) closes active sessions whose last
+event is older than IDLE_TIMEOUT, using that event's time as the end time.
+
+Closing a session only marks it ended; its replay index and bundle
+(core/replay.py, core/bundles.py) are built afterwards by
+``finalize_session`` on a single background thread per process, since they
+read every event of the session. Until they exist, or if building them
+fails, the replay builds them on first use.
+"""
+import json
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce, Greatest, Least
+from django.utils import timezone
+
+from . import stats
+from .bundles import build_bundle, get_bundle_settings
+from .chunks import iter_session_events
+from .live import publish_session_ended
+from .models import Session, SessionArchive, SessionSummary
+from .replay import build_replay_index
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_DEFAULTS = {
+    'IDLE_TIMEOUT': 1800,  # Seconds without events before an active session is swept
+    'ERROR_TYPES': ('error',),  # Event types counted as errors
+    'FINALIZE_IN_BACKGROUND': True,  # Build ended sessions' replay index and bundle off the closing thread
+}
+
+_finalizer = None
+_finalizer_lock = threading.Lock()
+
+
+def get_summary_settings():
+    return {**SUMMARY_DEFAULTS, **getattr(settings, 'TELEMETRY_SUMMARY', {})}
+
+
+def _scroll_depth(data):
+    y = data.get('y') if isinstance(data, dict) else None
+    if isinstance(y, bool) or not isinstance(y, (int, float)):
+        return 0
+    return max(0, int(y))
+
+
+def summarize(events, error_types):
+    """Roll ``(session_id, type, timestamp, data)`` tuples up into ``{session_id: rollup}``."""
+    rollups = {}
+    for session_id, event_type, timestamp, data in events:
+        rollup = rollups.get(session_id)
+        if rollup is None:
+            rollup = rollups[session_id] = {
+                'events': 0, 'types': Counter(), 'first': timestamp, 'last': timestamp,
+                'scroll': 0, 'clicks': 0, 'errors': 0, 'bytes': 0,
+            }
+        rollup['events'] += 1
+        rollup['types'][event_type] += 1
+        rollup['first'] = min(rollup['first'], timestamp)
+        rollup['last'] = max(rollup['last'], timestamp)
+        if event_type == 'scroll':
+            rollup['scroll'] = max(rollup['scroll'], _scroll_depth(data))
+        elif event_type == 'click':
+            rollup['clicks'] += 1
+        if event_type in error_types:
+            rollup['errors'] += 1
+        rollup['bytes'] += len(json.dumps(data, separators=(',', ':')))
+    return rollups
+
+
+def _apply_rollup(session_id, rollup):
+    first, last = Value(rollup['first']), Value(rollup['last'])
+    updates = {
+        'event_count': F('event_count') + rollup['events'],
+        'click_count': F('click_count') + rollup['clicks'],
+        'error_count': F('error_count') + rollup['errors'],
+        'bytes_ingested': F('bytes_ingested') + rollup['bytes'],
+        'max_scroll_depth': Greatest('max_scroll_depth', Value(rollup['scroll'])),
+        # SQLite's two-argument MIN/MAX are NULL if either side is
+        'first_event': Least(Coalesce('first_event', first), first),
+        'last_event': Greatest(Coalesce('last_event', last), last),
+        'updated_at': Value(timezone.now()),
+    }
+    summaries = SessionSummary.objects.filter(session_id=session_id)
+    if not summaries.update(**updates):
+        # First batch of this session: create the row, tolerating a concurrent create
+        SessionSummary.objects.bulk_create([SessionSummary(session_id=session_id)], ignore_conflicts=True)
+        summaries.update(**updates)
+    # The update above holds the row lock until commit, so this read-modify-write is safe
+    type_counts = Counter(summaries.values_list('type_counts', flat=True).first() or {})
+    type_counts.update(rollup['types'])
+    summaries.update(type_counts=dict(type_counts))
+
+
+def update_summaries(events, config=None):
+    """Add a batch of stored Event rows to their sessions' summaries."""
+    config = config or get_summary_settings()
+    rollups = summarize(
+        ((event.session_id, event.type, event.timestamp, event.data) for event in events),
+        tuple(config['ERROR_TYPES']),
+    )
+    # Callers already run in a transaction with the event writes; no savepoint needed
+    with transaction.atomic(savepoint=False):
+        # A fixed order keeps two multi-session batches from locking rows in opposite orders
+        for session_id in sorted(rollups, key=str):
+            _apply_rollup(session_id, rollups[session_id])
+
+
+def rebuild_summary(session, config=None):
+    """Recompute one session's summary from its stored events."""
+    config = config or get_summary_settings()
+    events = ((session.id, event['type'], event['timestamp'], event['data']) for event in iter_session_events(session))
+    rollup = summarize(events, tuple(config['ERROR_TYPES'])).get(session.id)
+    defaults = {
+        'event_count': 0, 'type_counts': {}, 'first_event': None, 'last_event': None,
+        'max_scroll_depth': 0, 'click_count': 0, 'error_count': 0, 'bytes_ingested': 0,
+    }
+    if rollup is not None:
+        defaults.update({
+            'event_count': rollup['events'],
+            'type_counts': dict(rollup['types']),
+            'first_event': rollup['first'],
+            'last_event': rollup['last'],
+            'max_scroll_depth': rollup['scroll'],
+            'click_count': rollup['clicks'],
+            'error_count': rollup['errors'],
+            'bytes_ingested': rollup['bytes'],
+        })
+    SessionSummary.objects.update_or_create(session=session, defaults=defaults)
+
+
+def rebuild_summaries(sessions=None):
+    """Recompute summaries from the tables. Sessions whose events are archived keep the summary they have."""
+    sessions = Session.objects.all() if sessions is None else sessions
+    archived = SessionArchive.objects.exclude(state=SessionArchive.RESTORED).values('session_id')
+    config = get_summary_settings()
+    count = 0
+    for session in sessions.exclude(id__in=archived).only('id').iterator(chunk_size=500):
+        rebuild_summary(session, config)
+        count += 1
+    return count
+
+
+def finalize_session(session):
+    """Build an ended session's replay index and bundle. Failures leave both to be built on first replay."""
+    try:
+        # Precompute seek data now that the session's events are final
+        build_replay_index(session)
+        config = get_bundle_settings()
+        if config['BUILD_ON_CLOSE']:
+            build_bundle(session, config)
+    except (DatabaseError, OSError, ValueError) as e:
+        logger.error(f'Failed to build replay index or bundle of session {session.id}: {e}')
+
+
+def _run_finalize(session):
+    # Like the database writer's jobs: drop connections that errored or outlived CONN_MAX_AGE
+    close_old_connections()
+    try:
+        finalize_session(session)
+    finally:
+        close_old_connections()
+
+
+def _get_finalizer():
+    global _finalizer
+    with _finalizer_lock:
+        if _finalizer is None:
+            _finalizer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='clearsight-finalize')
+        return _finalizer
+
+
+def close_session(session, end_time=None):
+    """Mark a session ended and have its replay index and bundle built. Returns False if it had already ended.
+
+    The index and bundle take seconds for a long session, so unless
+    FINALIZE_IN_BACKGROUND is off they are built on a thread of their own
+    rather than holding up the caller (the telemetry consumer's database
+    writer, or the sweeper).
+    """
+    end_time = end_time or timezone.now()
+    closed = Session.objects.filter(pk=session.pk, is_active=True).update(is_active=False, end_time=end_time)
+    session.is_active = False
+    if closed:
+        session.end_time = end_time
+        stats.increment(stats.ACTIVE_SESSIONS, -1)
+    if get_summary_settings()['FINALIZE_IN_BACKGROUND']:
+        _get_finalizer().submit(_run_finalize, session)
+    else:
+        finalize_session(session)
+    return bool(closed)
+
+
+def sweep_sessions(now=None, idle_timeout=None, limit=None):
+    """Close active sessions without events for ``idle_timeout`` seconds. Returns how many were closed."""
+    config = get_summary_settings()
+    now = now or timezone.now()
+    idle_timeout = config['IDLE_TIMEOUT'] if idle_timeout is None else idle_timeout
+    stale = (
+        Session.objects.filter(is_active=True)
+        .annotate(last_seen=Coalesce('summary__last_event', 'start_time'))
+        .filter(last_seen__lt=now - timedelta(seconds=idle_timeout))
+        .order_by('last_seen')
+    )
+    if limit is not None:
+        stale = stale[:limit]
+
+    closed = 0
+    # Materialized first: closing writes to the rows the query reads
+    for session in list(stale):
+        if close_session(session, session.last_seen):
+            closed += 1
+            async_to_sync(publish_session_ended)(session.id)
+            logger.info(f'Closed idle session {session.id}, last event at {session.last_seen}')
+    return closed
@@ -1,3 +1,1359 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.db import OperationalError, connection, transaction
+from django.http import JsonResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import admission, analytics, metrics, retention, routing, stats
+from .admission import Admission, admission_control, get_admission_settings
+from .backends import ORMBackend, OpenSearchBackend
+from .bundles import build_bundle, bundle_path, get_bundle_settings, iter_decompressed
+from .chunks import compact_session, encode_chunk, session_event_count, session_events
+from .codec import DecodeError, decode_packed, encode_packed
+from .consumers import LiveSessionConsumer, TelemetryConsumer
+from .dom import DOM_SNAPSHOT
+from .ingest import BatchError, EventBuffer, create_session, parse_batch, record_events
+from .layers import SQLiteChannelLayer
+from .live import FrameCoalescer, session_group
+from .models import (
+    DomSnapshotRef, Event, EventChunk, PageAnalytics, ReplayBundle, ReplayIndex, Session, SessionArchive,
+    SearchTerm, SessionSummary, SnapshotBlob, SpoolCheckpoint, StatsCounter,
+)
+from .replay import get_replay_index
+from .retention import (
+    apply_retention, archive_session, get_retention_settings, iter_archive_candidates, restore_session, write_archive,
+)
+from .sampling import SessionSampler, get_sampling_settings
+from .search import browser_family, get_search_backend, parse_query
+from .snapshots import reference_snapshot, upload_snapshot
+from .spool import SpoolWriter, drain_spool, encode_record, list_segments
+from .summaries import _get_finalizer, close_session, rebuild_summary, sweep_sessions
+from .transfer import export_telemetry, import_telemetry
+from .writer import DatabaseWriter
+
+
+def run_threads(target, count):
+    """Run ``target(i)`` on ``count`` threads at once. Returns the exceptions raised."""
+    barrier = threading.Barrier(count)
+    errors = []
+
+    def run(i):
+        try:
+            barrier.wait()
+            target(i)
+        except Exception as exc:
+            errors.append(exc)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def record_clicks(session, count, start=None):
+    start = start or timezone.now()
+    record_events([
+        Event(session_id=str(session.id), type='click', timestamp=start + timedelta(seconds=i), data={'x': i, 'y': i})
+        for i in range(count)
+    ])
+
+
+def temp_dir(test):
+    directory = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, directory)
+    return directory
+
+
+def event_rows(session):
+    return [(event['type'], event['timestamp'], event['data']) for event in session_events(session)]
+
+
+class EventBufferTests(SimpleTestCase):
+    def setUp(self):
+        write = mock.patch('core.ingest.write_events', new_callable=mock.AsyncMock)
+        self.write_events = write.start()
+        self.addCleanup(write.stop)
+        self.flushed = []
+
+    async def on_flush(self, batch, stored):
+        self.flushed.append([seq for seq, _ in batch])
+
+    def buffer(self, max_events=3, max_age=60):
+        return EventBuffer(Session(), max_events=max_events, max_age=max_age, on_flush=self.on_flush)
+
+    async def test_flushes_at_size_limit(self):
+        buffer = self.buffer()
+        for seq in range(1, 8):
+            await buffer.add({'type': 'click', 'data': {'x': seq}}, seq)
+        self.assertEqual(self.flushed, [[1, 2, 3], [4, 5, 6]])
+        self.assertEqual(self.write_events.await_count, 2)
+        self.assertEqual(len(buffer), 1)
+
+        await buffer.close()
+        self.assertEqual(self.flushed[-1], [7])
+
+    async def test_flushes_at_age_limit(self):
+        buffer = self.buffer(max_events=100, max_age=0.05)
+        await buffer.add({'type': 'click', 'data': {}}, 1)
+        await buffer.add({'type': 'click', 'data': {}}, 2)
+        self.assertEqual(self.flushed, [])
+        await asyncio.sleep(0.2)
+        self.assertEqual(self.flushed, [[1, 2]])
+        self.assertEqual(len(self.write_events.await_args.args[0]), 2)
+
+    async def test_failed_write_not_acked(self):
+        self.write_events.side_effect = OperationalError('database is locked')
+        errors = []
+
+        async def on_error(error):
+            errors.append(error)
+
+        buffer = EventBuffer(Session(), max_events=1, max_age=60, on_flush=self.on_flush, on_error=on_error)
+        with self.assertLogs('core.ingest', 'ERROR'):
+            await buffer.add({'type': 'click', 'data': {}}, 1)
+        self.assertEqual(self.flushed, [])
+        self.assertEqual(len(errors), 1)
+
+
+class AckTests(SimpleTestCase):
+    def acks(self, ack_mode):
+        consumer = TelemetryConsumer()
+        consumer.ack_mode = ack_mode
+        consumer.send = mock.AsyncMock()
+        asyncio.run(consumer.send_acks([(4, 'click'), (5, 'scroll'), (7, 'click')]))
+        return [json.loads(call.args[0]) for call in consumer.send.await_args_list]
+
+    def test_one_ack_per_event(self):
+        self.assertEqual(self.acks('event'), [
+            {'type': 'event_recorded', 'event_type': 'click', 'seq': 4},
+            {'type': 'event_recorded', 'event_type': 'scroll', 'seq': 5},
+            {'type': 'event_recorded', 'event_type': 'click', 'seq': 7},
+        ])
+
+    def test_cumulative_ack(self):
+        self.assertEqual(self.acks('cumulative'), [{'type': 'events_recorded', 'seq': 7, 'count': 3}])
+
+
+class BatchTests(TestCase):
+    def setUp(self):
+        self.session = create_session({'pageUrl': 'https://example.com/'})[0]
+
+    def batch(self, events, **envelope):
+        return {'type': 'batch', 'session_id': str(self.session.id), 'events': events, **envelope}
+
+    def test_parse_batch_anchors_times_to_server_clock(self):
+        received_at = timezone.now()
+        parsed = parse_batch(self.batch([
+            {'type': 'click', 'timestamp': 1_000, 'seq': 7, 'data': {'x': 1}},
+            {'type': 'scroll', 'timestamp': 1_500, 'data': {'y': 2}},
+        ], sentAt=2_000), received_at)
+        self.assertEqual([(seq, event['type']) for seq, event, _ in parsed], [(7, 'click'), (1, 'scroll')])
+        self.assertEqual([timestamp for _, _, timestamp in parsed],
+                         [received_at - timedelta(seconds=1), received_at - timedelta(milliseconds=500)])
+
+    def test_parse_batch_rejects_malformed_envelopes(self):
+        for bad in (
+            self.batch([]),
+            self.batch('click'),
+            self.batch(['click']),
+            self.batch([{'type': 'unknown'}]),
+            self.batch([{'type': 'click', 'data': [1, 2]}]),
+        ):
+            with self.assertRaises(BatchError):
+                parse_batch(bad)
+        with override_settings(TELEMETRY_BATCH={'MAX_EVENTS': 2}), self.assertRaises(BatchError):
+            parse_batch(self.batch([{'type': 'click'}] * 3))
+
+    def test_batch_endpoint(self):
+        response = self.client.post('/api/telemetry/', self.batch([
+            {'type': 'click', 'timestamp': 1_000 + i, 'seq': i + 1, 'data': {'x': i, 'y': i}} for i in range(3)
+        ], sentAt=2_000), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'status': 'success', 'accepted': 3, 'stored': 3, 'seq': 3})
+        self.assertEqual(Event.objects.filter(session=self.session, type='click').count(), 3)
+
+        with self.assertLogs('core.views', 'WARNING'):
+            response = self.client.post('/api/telemetry/', self.batch([{'type': 'unknown'}]),
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+            response = self.client.post('/api/telemetry/', {**self.batch([{'type': 'click'}]), 'session_id': str(uuid.uuid4())},
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 404)
+
+
+class CodecTests(SimpleTestCase):
+    # The HTTP endpoint's rate limit looks up the posting session
+    databases = {'default'}
+
+    def pointer_events(self):
+        events = [
+            {'type': 'mousemove', 'timestamp': 1_700_000_000_000 + i * 16, 'data': {'x': i * 3, 'y': 500 - i}}
+            for i in range(20)
+        ]
+        # A jump too large for the delta columns, then a type change
+        events.append({'type': 'mousemove', 'timestamp': events[-1]['timestamp'] + 100_000, 'data': {'x': 40_000, 'y': 0}})
+        events.append({'type': 'scroll', 'timestamp': events[-1]['timestamp'] + 5, 'data': {'x': 0, 'y': 1200}})
+        return events
+
+    def test_round_trip(self):
+        events = self.pointer_events()
+        sent_at, decoded = decode_packed(encode_packed(events, 1_700_000_001_000))
+        self.assertEqual(sent_at, 1_700_000_001_000)
+        self.assertEqual(
+            [(event['type'], event['timestamp'], event['data']['x'], event['data']['y']) for event in decoded],
+            [(event['type'], event['timestamp'], event['data']['x'], event['data']['y']) for event in events],
+        )
+
+    def test_malformed_frames(self):
+        frame = encode_packed(self.pointer_events(), 0)
+        for bad in (b'', b'XX' + frame[2:], frame[:-3], frame[:2] + b'\x09' + frame[3:]):
+            with self.assertRaises(DecodeError):
+                decode_packed(bad)
+
+    def test_sample_times_far_from_frame_time(self):
+        for timestamp in (2 ** 62, 1_700_000_000_000 + 2 * 24 * 60 * 60 * 1000, 1_600_000_000_000):
+            frame = encode_packed([{'type': 'mousemove', 'timestamp': timestamp, 'data': {'x': 0, 'y': 0}}],
+                                  1_700_000_000_000)
+            with self.assertRaises(DecodeError):
+                decode_packed(frame)
+
+    def test_bad_frame_answered_with_error(self):
+        frame = encode_packed([{'type': 'mousemove', 'timestamp': 2 ** 62, 'data': {'x': 0, 'y': 0}}], 0)
+
+        consumer = TelemetryConsumer()
+        consumer.session, consumer.buffer = Session(), mock.AsyncMock()
+        consumer.slotted, consumer.admission, consumer.max_frame_bytes = True, None, None
+        consumer.send = mock.AsyncMock()
+        asyncio.run(consumer.receive(bytes_data=frame))
+        self.assertEqual(json.loads(consumer.send.await_args.args[0])['type'], 'error')
+        consumer.buffer.add.assert_not_awaited()
+
+        with self.assertLogs('core.views', 'WARNING'):
+            response = self.client.post(f'/api/telemetry/?session_id={uuid.uuid4()}', frame,
+                                        content_type='application/octet-stream')
+        self.assertEqual(response.status_code, 400)
+
+
+class ChunkTests(TestCase):
+    def test_compacted_events_read_back_unchanged(self):
+        session = create_session({'pageUrl': 'https://example.com/'})[0]
+        start = timezone.now() - timedelta(minutes=5)
+        record_events([
+            Event(session_id=str(session.id), type='mousemove', timestamp=start + timedelta(milliseconds=i * 40),
+                  data={'x': i, 'y': -i})
+            for i in range(3000)
+        ] + [
+            Event(session_id=str(session.id), type='input', timestamp=start + timedelta(seconds=200),
+                  data={'selector': '#email', 'value': 'a@example.com'}),
+            Event(session_id=str(session.id), type='error', timestamp=start + timedelta(seconds=201), data='boom'),
+        ])
+        before = event_rows(session)
+
+        self.assertEqual(compact_session(session, timezone.now()), 3002)
+        self.assertFalse(Event.objects.filter(session=session).exists())
+        self.assertTrue(EventChunk.objects.filter(session=session).exists())
+        self.assertEqual(event_rows(session), before)
+        self.assertEqual(session_event_count(session), 3002)
+
+    def test_one_chunk_per_window(self):
+        session = create_session({'pageUrl': 'https://example.com/'})[0]
+        record_clicks(session, 180, start=session.start_time)
+        self.assertEqual(compact_session(session, timezone.now() + timedelta(hours=1)), 180)
+        self.assertEqual(list(EventChunk.objects.filter(session=session).values_list('event_count', flat=True)),
+                         [60, 60, 60])
+
+    def test_event_written_during_compaction_kept(self):
+        session = create_session({'pageUrl': 'https://example.com/'})[0]
+        record_clicks(session, 10, start=session.start_time)
+        late = []
+
+        def encode(session, events):
+            if not late:
+                # Committed by another connection after the window was read
+                late.append(Event.objects.create(session=session, type='click', timestamp=events[0].timestamp,
+                                                 data={'x': -1, 'y': -1}))
+            return encode_chunk(session, events)
+
+        with mock.patch('core.chunks.encode_chunk', encode):
+            self.assertEqual(compact_session(session, timezone.now() + timedelta(hours=1)), 11)
+        self.assertEqual(session_event_count(session), 11)
+        self.assertIn(('click', late[0].timestamp, {'x': -1, 'y': -1}), event_rows(session))
+
+
+class ReplayEventsTests(TestCase):
+    def setUp(self):
+        self.session = create_session({'pageUrl': 'https://example.com/'})[0]
+        self.start = self.session.start_time.replace(microsecond=0)
+        record_clicks(self.session, 10, start=self.start)
+        self.url = f'/sessions/{self.session.id}/replay/events/'
+        self.start_ms = int(self.start.timestamp() * 1000)
+
+    def window(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        events = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        return response, events
+
+    def test_window_of_events(self):
+        response, events = self.window(start=self.start_ms + 2000, end=self.start_ms + 5000)
+        self.assertEqual([event['data']['x'] for event in events], [2, 3, 4])
+        self.assertEqual(events[0], {'type': 'click', 'timestamp': self.start_ms + 2000, 'data': {'x': 2, 'y': 2}})
+        self.assertEqual(response['X-Window-End'], str(self.start_ms + 5000))
+
+    def test_window_clamped(self):
+        with mock.patch('core.views.REPLAY_MAX_WINDOW_MS', 3000):
+            response, events = self.window(start=self.start_ms, end=self.start_ms + 60_000)
+        self.assertEqual(len(events), 3)
+        self.assertEqual(response['X-Window-End'], str(self.start_ms + 3000))
+
+    def test_bad_window(self):
+        for params in ({}, {'start': 'soon'}, {'start': 10 ** 18}, {'start': 0, 'end': -10 ** 18}):
+            self.assertEqual(self.client.get(self.url, params).status_code, 400)
+
+
+class SpoolTests(TestCase):
+    def setUp(self):
+        self.directory = temp_dir(self)
+        self.session = create_session({'pageUrl': 'https://example.com/'})[0]
+
+    def spool(self, batches, segment_bytes=1024 * 1024):
+        writer = SpoolWriter(self.directory, segment_bytes)
+        start = timezone.now()
+        for batch in range(batches):
+            writer.write(encode_record([
+                Event(session_id=str(self.session.id), type='click', timestamp=start + timedelta(seconds=batch, milliseconds=i),
+                      data={'x': i, 'y': batch})
+                for i in range(10)
+            ]))
+        writer.close()
+
+    def test_drain_writes_spooled_events_once(self):
+        self.spool(5, segment_bytes=500)
+        self.assertGreater(len(os.listdir(self.directory)), 1)
+
+        self.assertEqual(drain_spool(self.directory), 50)
+        self.assertEqual(Event.objects.filter(session=self.session).count(), 50)
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertFalse(SpoolCheckpoint.objects.exists())
+        self.assertEqual(drain_spool(self.directory), 0)
+
+    def test_torn_tail_discarded(self):
+        self.spool(3)
+        [segment] = os.listdir(self.directory)
+        with open(os.path.join(self.directory, segment), 'ab') as f:
+            f.write(b'\x40\x00\x00\x00torn')
+
+        with self.assertLogs('core.spool', 'WARNING'):
+            self.assertEqual(drain_spool(self.directory), 30)
+        self.assertEqual(Event.objects.filter(session=self.session).count(), 30)
+
+    def test_events_of_deleted_sessions_skipped(self):
+        self.spool(2)
+        self.session.delete()
+        with mock.patch('core.spool.SpoolCheckpoint.objects.update_or_create') as update_or_create:
+            self.assertEqual(drain_spool(self.directory), 0)
+        update_or_create.assert_not_called()
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_segment_sealed_while_listed(self):
+        writer = SpoolWriter(self.directory, 1024 * 1024)
+        self.addCleanup(writer.close)
+        [open_segment] = os.listdir(self.directory)
+
+        # The writer seals its segment between the listing and the lock check
+        with mock.patch('core.spool._is_abandoned', side_effect=lambda path: (writer.close(), open(path))):
+            self.assertEqual(list_segments(self.directory), [])
+        self.assertEqual([name for name, _, sealed in list_segments(self.directory) if sealed],
+                         [open_segment.removesuffix('.open')])
+
+
+class SnapshotTests(TestCase):
+    def test_identical_snapshots_share_a_blob(self):
+        first = reference_snapshot('<html>same</html>')
+        second = reference_snapshot('<html>same</html>')
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual(SnapshotBlob.objects.get(pk=first.pk).refcount, 2)
+        self.assertEqual(second.content, '<html>same</html>')
+
+    def test_hash_only_reference_waits_for_upload(self):
+        content = '<html>later</html>'
+        blob = reference_snapshot(content)
+        hash = blob.hash
+        blob.delete()
+
+        blob = reference_snapshot(hash=hash)
+        self.assertIsNone(blob.data)
+        upload_snapshot(hash, content)
+        self.assertEqual(SnapshotBlob.objects.get(hash=hash).content, content)
+
+
+class SessionListTests(TestCase):
+    def setUp(self):
+        start = timezone.now() - timedelta(hours=1)
+        # Two pairs share a start time, so pages have to break ties on id
+        offsets = [0, 1, 1, 2, 3, 3, 4]
+        self.sessions = [create_session({'pageUrl': f'https://example.com/{i}'})[0] for i in range(len(offsets))]
+        for session, offset in zip(self.sessions, offsets):
+            Session.objects.filter(pk=session.pk).update(start_time=start + timedelta(minutes=offset))
+        self.expected = list(Session.objects.order_by('-start_time', '-id').values_list('id', flat=True))
+
+    @mock.patch('core.views.SESSIONS_PAGE_SIZE', 2)
+    def test_pages_cover_every_session_once(self):
+        seen, cursor, pages = [], None, 0
+        while True:
+            response = self.client.get('/sessions/', {'before': cursor} if cursor else {})
+            self.assertEqual(response.status_code, 200)
+            seen += [session.id for session in response.context['sessions']]
+            pages += 1
+            cursor = response.context['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(seen, self.expected)
+        self.assertEqual(pages, 4)
+
+    def test_listing_counts_events(self):
+        record_clicks(self.sessions[0], 3)
+        response = self.client.get('/sessions/')
+        counts = {session.id: session.event_count for session in response.context['sessions']}
+        self.assertEqual(counts[self.sessions[0].id], 3)
+        self.assertEqual(counts[self.sessions[1].id], 0)
+
+    def test_bad_cursor(self):
+        self.assertEqual(self.client.get('/sessions/', {'before': 'not a cursor'}).status_code, 400)
+
+
+class EventStatsTests(TestCase):
+    def setUp(self):
+        self.session = create_session({'pageUrl': 'https://example.com/'})[0]
+        self.start = self.session.start_time.replace(second=0, microsecond=0) - timedelta(hours=2)
+        Session.objects.filter(pk=self.session.pk).update(start_time=self.start)
+        self.session.refresh_from_db()
+        record_events([
+            Event(session_id=str(self.session.id), type='mousemove' if i % 3 else 'click',
+                  timestamp=self.start + timedelta(seconds=i * 7), data={'x': i, 'y': i})
+            for i in range(600)
+        ])
+
+    def expected(self, start, end, interval):
+        types, buckets = {}, {}
+        for event_type, timestamp, _ in event_rows(self.session):
+            if start <= timestamp < end:
+                types[event_type] = types.get(event_type, 0) + 1
+                bucket = int(timestamp.timestamp()) // interval * interval * 1000
+                buckets[bucket] = buckets.get(bucket, 0) + 1
+        return {'total': sum(types.values()), 'types': types, 'histogram': sorted(buckets.items())}
+
+    def assertStats(self, start, end, interval):
+        result = ORMBackend().event_stats(start, end, interval)
+        expected = self.expected(start, end, interval)
+        self.assertEqual(result['total'], expected['total'])
+        self.assertEqual(result['types'], expected['types'])
+        self.assertEqual(result['histogram'], expected['histogram'])
+
+    def test_raw_events(self):
+        self.assertStats(self.start + timedelta(minutes=3, seconds=30), self.start + timedelta(minutes=50), 300)
+
+    def test_chunks_and_raw_events(self):
+        compact_session(self.session, self.start + timedelta(minutes=40))
+        # A chunk from before chunks kept their type counts
+        EventChunk.objects.filter(pk=EventChunk.objects.first().pk).update(type_counts=None)
+        for interval in (60, 300, 3600):
+            self.assertStats(self.start + timedelta(minutes=3, seconds=30), self.start + timedelta(minutes=50), interval)
+            self.assertStats(self.start - timedelta(hours=1), self.start + timedelta(hours=2), interval)
+
+    def test_chunk_type_counts(self):
+        compact_session(self.session, self.start + timedelta(minutes=1))
+        chunk = EventChunk.objects.get()
+        self.assertEqual(dict(zip(chunk.types, chunk.type_counts)), {'click': 3, 'mousemove': 6})
+
+
+class StatsTests(TestCase):
+    def test_sharded_increments_sum(self):
+        for _ in range(50):
+            stats.increment(stats.EVENTS, 2)
+        stats.increment(stats.SESSIONS)
+        self.assertGreater(StatsCounter.objects.filter(name__startswith=stats.EVENTS).count(), 1)
+        counters = stats.get_counters()
+        self.assertEqual(counters[stats.EVENTS], 100)
+        self.assertEqual(counters[stats.SESSIONS], 1)
+
+    def test_rebuild_collapses_shards(self):
+        for _ in range(20):
+            stats.increment(stats.EVENTS, 5)
+        session = create_session({'pageUrl': 'https://example.com/'})[0]
+        record_clicks(session, 3)
+
+        self.assertEqual(stats.rebuild_counters()[stats.EVENTS], 3)
+        self.assertEqual(list(StatsCounter.objects.filter(name__startswith=stats.EVENTS).values_list('name', 'value')),
+                         [(stats.EVENTS, 3)])
+        self.assertEqual(stats.get_counters(), {stats.SESSIONS: 1, stats.ACTIVE_SESSIONS: 1, stats.EVENTS: 3})
+
+
+class ReplayIndexTests(TestCase):
+    def setUp(self):
+        self.session = create_session({'pageUrl': 'https://example.com/'})[0]
+        record_clicks(self.session, 5)
+
+    def test_active_index_reused_within_interval(self):
+        self.assertEqual(get_replay_index(self.session).event_count, 5)
+        record_clicks(self.session, 5, start=timezone.now() + timedelta(minutes=1))
+        with mock.patch('core.replay.build_replay_index') as build:
+            self.assertEqual(get_replay_index(self.session).event_count, 5)
+        build.assert_not_called()
+
+    @override_settings(TELEMETRY_REPLAY_INDEX={'ACTIVE_REBUILD_INTERVAL': 0})
+    def test_active_index_rebuilt_after_interval(self):
+        get_replay_index(self.session)
+        record_clicks(self.session, 5, start=timezone.now() + timedelta(minutes=1))
+        self.assertEqual(get_replay_index(self.session).event_count, 10)
+
+    def test_ended_index_reused_until_events_change(self):
+        self.session.is_active = False
+        get_replay_index(self.session)
+        with mock.patch('core.replay.build_replay_index') as build:
+            self.assertEqual(get_replay_index(self.session).event_count, 5)
+        build.assert_not_called()
+
+        # A batch posted after the close
+        record_clicks(self.session, 5, start=timezone.now() + timedelta(minutes=1))
+        self.assertEqual(get_replay_index(self.session).event_count, 10)
+
+
+class SamplerTests(TestCase):
+    def setUp(self):
+        self.start = timezone.now()
+
+    def events(self, event_type, count, step_ms=1, **data):
+        return [
+            Event(type=event_type, timestamp=self.start + timedelta(milliseconds=i * step_ms), data={'x': i, 'y': i, **data})
+            for i in range(count)
+        ]
+
+    def sampler(self, **config):
+        return SessionSampler({**get_sampling_settings(), **config})
+
+    def test_stream_events_rate_limited(self):
+        kept = self.sampler(PATH_TOLERANCE=0).reduce(self.events('mousemove', 200, y=0))
+        # mousemove: 20 a second with 2 seconds of burst, all within a fifth of a second
+        self.assertLess(len(kept), 50)
+
+    def test_discrete_events_never_dropped(self):
+        sampler = self.sampler(RATE_LIMITS={'mousemove': 20, '*': 10})
+        events = self.events('mousemove', 100) + self.events('click', 100) + self.events('keypress', 50)
+        kept = sampler.reduce(events)
+        self.assertEqual(sum(1 for event in kept if event.type == 'click'), 100)
+        self.assertEqual(sum(1 for event in kept if event.type == 'keypress'), 50)
+        self.assertLessEqual(sum(1 for event in kept if event.type == 'mousemove'), 20)
+
+    def test_straight_mouse_path_collapses(self):
+        kept = self.sampler(RATE_LIMITS={}).reduce(self.events('mousemove', 50, step_ms=16))
+        self.assertEqual([event.data['x'] for event in kept], [0, 49])
+
+    def test_scroll_runs_merged(self):
+        kept = self.sampler(RATE_LIMITS={}).reduce(self.events('scroll', 100, step_ms=10))
+        self.assertLess(len(kept), 15)
+        self.assertEqual(kept[-1].data['y'], 99)
+
+
+class ConcurrentSnapshotTests(TransactionTestCase):
+    def test_concurrent_session_starts(self):
+        data = {'pageUrl': 'https://example.com/', 'pageHtml': '<html>shared</html>'}
+        errors = run_threads(lambda i: create_session(data), 8)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(Session.objects.count(), 8)
+        blob = SnapshotBlob.objects.get()
+        self.assertEqual(blob.refcount, 8)
+        self.assertEqual(blob.content, '<html>shared</html>')
+
+    def test_concurrent_dom_snapshots(self):
+        sessions = [create_session({'pageUrl': 'https://example.com/'})[0] for i in range(8)]
+        tree = {'id': 1, 'tag': 'html', 'attrs': {}, 'children': []}
+
+        def record(i):
+            record_events([Event(
+                session_id=str(sessions[i].id), type=DOM_SNAPSHOT, timestamp=timezone.now(), data={'tree': tree}
+            )])
+
+        errors = run_threads(record, 8)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(Event.objects.filter(type=DOM_SNAPSHOT).count(), 8)
+        self.assertEqual(DomSnapshotRef.objects.count(), 8)
+        self.assertEqual(SnapshotBlob.objects.get().refcount, 8)
+
+
+class ConcurrentCompactionTests(TransactionTestCase):
+    def test_compaction_alongside_ingest(self):
+        session = create_session({'pageUrl': 'https://example.com/'})[0]
+        record_clicks(session, 600, start=session.start_time)
+
+        def run(i):
+            if i == 0:
+                compact_session(session, timezone.now() + timedelta(hours=1), window=timedelta(seconds=10))
+            else:
+                for batch in range(10):
+                    record_clicks(session, 5, start=session.start_time + timedelta(seconds=batch))
+
+        self.assertEqual(run_threads(run, 4), [])
+        self.assertEqual(session_event_count(session), 750)
+
+
+class CloseSessionTests(TransactionTestCase):
+    def setUp(self):
+        self.bundle_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.bundle_dir)
+        bundles = override_settings(TELEMETRY_REPLAY_BUNDLES={'DIR': self.bundle_dir})
+        bundles.enable()
+        self.addCleanup(bundles.disable)
+        self.session = create_session({'pageUrl': 'https://example.com/', 'pageHtml': '<html></html>'})[0]
+        record_clicks(self.session, 5)
+
+    def test_index_and_bundle_built_in_background(self):
+        self.assertTrue(close_session(self.session))
+        # The finalizer has a single thread, so this runs after the close's build
+        _get_finalizer().submit(lambda: None).result(timeout=30)
+
+        self.assertEqual(ReplayIndex.objects.get(session=self.session).event_count, 5)
+        self.assertEqual(ReplayBundle.objects.get(session=self.session).event_count, 5)
+        self.assertFalse(Session.objects.get(pk=self.session.pk).is_active)
+
+    def test_close_leaves_builds_to_finalizer(self):
+        threads = []
+        with mock.patch('core.summaries.finalize_session', lambda session: threads.append(threading.current_thread())):
+            close_session(self.session)
+            _get_finalizer().submit(lambda: None).result(timeout=30)
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+        self.assertTrue(threads[0].name.startswith('clearsight-finalize'))
+
+    @override_settings(TELEMETRY_SUMMARY={'FINALIZE_IN_BACKGROUND': False})
+    def test_build_failure_still_closes(self):
+        with mock.patch('core.summaries.build_bundle', side_effect=OperationalError('database is locked')):
+            self.assertTrue(close_session(self.session))
+        self.assertFalse(Session.objects.get(pk=self.session.pk).is_active)
+        self.assertFalse(ReplayBundle.objects.exists())
+
+
+class MetricsTests(SimpleTestCase):
+    def setUp(self):
+        # Label values of our own, so counts from other tests don't show up in ours
+        self.label = uuid.uuid4().hex
+
+    def sample(self, text, line_start):
+        [line] = [line for line in text.splitlines() if line.startswith(line_start)]
+        return line.rsplit(' ', 1)[1]
+
+    def test_exposition(self):
+        metrics.WRITE_SECONDS.observe(0.003, sink=self.label)
+        metrics.WRITE_SECONDS.observe(2, sink=self.label)
+        metrics.EVENTS_RECEIVED.inc(3, type=f'{self.label}"quoted"')
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        text = response.content.decode()
+        self.assertIn('# TYPE clearsight_ingest_write_seconds histogram', text)
+        name = f'clearsight_ingest_write_seconds_bucket{{sink="{self.label}"'
+        self.assertEqual(self.sample(text, f'{name},le="0.001"}}'), '0')
+        self.assertEqual(self.sample(text, f'{name},le="0.005"}}'), '1')
+        self.assertEqual(self.sample(text, f'{name},le="2.5"}}'), '2')
+        self.assertEqual(self.sample(text, f'{name},le="+Inf"}}'), '2')
+        self.assertEqual(self.sample(text, f'clearsight_ingest_write_seconds_sum{{sink="{self.label}"}}'), '2.003')
+        self.assertEqual(self.sample(text, f'clearsight_ingest_write_seconds_count{{sink="{self.label}"}}'), '2')
+        self.assertEqual(self.sample(text, f'clearsight_events_received_total{{type="{self.label}\\"quoted\\""}}'), '3')
+
+    def test_multiprocess_totals(self):
+        directory = temp_dir(self)
+        metrics.BYTES_RECEIVED.inc(100, transport=self.label)
+        metrics.CONNECTIONS.inc(consumer=self.label)
+        # A worker that has since exited
+        with open(os.path.join(directory, '1.json'), 'w') as f:
+            json.dump({'pid': 1, 'metrics': {
+                'clearsight_ingest_bytes_total': [[[self.label], 50]],
+                'clearsight_websocket_connections': [[[self.label], 7]],
+            }}, f)
+
+        with override_settings(TELEMETRY_METRICS={'MULTIPROCESS_DIR': directory}), \
+                mock.patch('core.metrics._pid_alive', lambda pid: pid == os.getpid()):
+            text = self.client.get('/metrics').content.decode()
+        self.assertEqual(self.sample(text, f'clearsight_ingest_bytes_total{{transport="{self.label}"}}'), '150')
+        # Gauges of dead processes are left out
+        self.assertEqual(self.sample(text, f'clearsight_websocket_connections{{consumer="{self.label}"}}'), '1')
+        self.assertTrue(os.path.exists(os.path.join(directory, f'{os.getpid()}.json')))
+
+    @override_settings(TELEMETRY_METRICS={'ENABLED': False})
+    def test_disabled(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+
+class StandInOpenSearch(ThreadingHTTPServer):
+    """Answers index template and _bulk requests like an OpenSearch node, or with 503 while ``down``."""
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StandInOpenSearchHandler)
+        self.down = False
+        self.bulks = []  # Document ids of each _bulk request received, answered or not
+        self.indexed = set()
+        self.requested = threading.Event()
+
+
+class StandInOpenSearchHandler(BaseHTTPRequestHandler):
+    def do_PUT(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.reply(200, {'acknowledged': True})
+
+    def do_POST(self):
+        lines = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode().splitlines()
+        ids = [json.loads(line)['index']['_id'] for line in lines[::2]]
+        self.server.bulks.append(ids)
+        self.server.requested.set()
+        if self.server.down:
+            self.reply(503, {'error': 'unavailable'})
+            return
+        self.server.indexed.update(ids)
+        self.reply(200, {'errors': False, 'items': [{'index': {'_id': id, 'status': 201}} for id in ids]})
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class OpenSearchBackendTests(SimpleTestCase):
+    # Writes are enqueued on commit, which looks at the connection's transaction state
+    databases = {'default'}
+
+    def setUp(self):
+        self.server = StandInOpenSearch()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def backend(self, **config):
+        backend = OpenSearchBackend({
+            'HOSTS': [f'http://127.0.0.1:{self.server.server_port}'],
+            'BULK_SIZE': 10,
+            'FLUSH_INTERVAL': 0.05,
+            'MAX_RETRIES': 1,
+            'RETRY_BACKOFF': 0.01,
+            **config,
+        })
+        self.addCleanup(backend.close, 0)
+        return backend
+
+    def events(self, count):
+        now = timezone.now()
+        return [Event(session_id=uuid.uuid4(), type='click', timestamp=now, data={'x': i}) for i in range(count)]
+
+    def test_events_indexed_in_bulks(self):
+        backend = self.backend()
+        backend.write_events(self.events(25))
+        self.assertTrue(backend.flush(5))
+        self.assertEqual(len(self.server.indexed), 25)
+        self.assertTrue(all(len(ids) <= 10 for ids in self.server.bulks))
+
+    def test_rolled_back_events_not_indexed(self):
+        backend = self.backend()
+        with self.assertRaises(OperationalError), transaction.atomic():
+            backend.write_events(self.events(5))
+            raise OperationalError('database is locked')
+        with transaction.atomic():
+            backend.write_events(self.events(3))
+            self.assertEqual(len(backend.spool), 0)
+        self.assertTrue(backend.flush(5))
+        self.assertEqual(len(self.server.indexed), 3)
+
+    def test_full_bulk_doesnt_cut_backoff_short(self):
+        self.server.down = True
+        backend = self.backend(RETRY_BACKOFF_MAX=1.0)
+        backend.write_events(self.events(10))
+        self.assertTrue(self.server.requested.wait(5))
+        time.sleep(0.1)
+
+        # Two more full bulks while the sender backs off
+        backend.write_events(self.events(20))
+        time.sleep(0.3)
+        self.assertEqual(len(self.server.bulks), 1)
+
+        self.server.down = False
+        self.assertTrue(backend.flush(5))
+        self.assertEqual(len(self.server.indexed), 30)
+
+
+class SQLiteChannelLayerTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'channels.sqlite3')
+
+    def test_group_send_reaches_other_layer(self):
+        async def exchange():
+            # Two layers on one file stand in for two worker processes
+            receiver, sender = SQLiteChannelLayer(self.path), SQLiteChannelLayer(self.path)
+            try:
+                channel = await receiver.new_channel()
+                await receiver.group_add('session-1', channel)
+                await sender.group_send('session-1', {'type': 'session.ended'})
+                return await asyncio.wait_for(receiver.receive(channel), 5)
+            finally:
+                await receiver.close()
+                await sender.close()
+
+        self.assertEqual(asyncio.run(exchange()), {'type': 'session.ended'})
+
+
+def live_event(event_type, timestamp, **data):
+    return {'type': event_type, 'timestamp': timestamp, 'data': data}
+
+
+class FrameCoalescerTests(SimpleTestCase):
+    def test_pointer_events_reduced_to_latest(self):
+        coalescer = FrameCoalescer(max_pending=10)
+        coalescer.add([live_event('mousemove', i, x=i) for i in range(5)] + [live_event('click', 2, x=2)])
+        coalescer.add([live_event('scroll', 6, y=100)])
+        frame = coalescer.take()
+        self.assertEqual([(event['type'], event['timestamp']) for event in frame['events']],
+                         [('click', 2), ('mousemove', 4), ('scroll', 6)])
+        self.assertEqual((frame['coalesced'], frame['dropped']), (4, 0))
+        self.assertFalse(coalescer)
+
+    def test_oldest_discrete_events_dropped(self):
+        coalescer = FrameCoalescer(max_pending=3)
+        coalescer.add([live_event('click', i) for i in range(5)])
+        frame = coalescer.take()
+        self.assertEqual([event['timestamp'] for event in frame['events']], [2, 3, 4])
+        self.assertEqual(frame['dropped'], 2)
+        self.assertEqual(coalescer.take()['dropped'], 0)
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    TELEMETRY_LIVE={'MAX_UNACKED': 1},
+)
+class LiveSessionConsumerTests(SimpleTestCase):
+    async def connect(self, session):
+        self.session_id = str(session.id)
+        communicator = WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns),
+                                             f'/ws/sessions/{self.session_id}/live/?fps=60')
+        with mock.patch.object(LiveSessionConsumer, 'get_session', mock.AsyncMock(return_value=session)):
+            connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual((await communicator.receive_json_from())['type'], 'live_started')
+        return communicator
+
+    async def publish(self, events):
+        await get_channel_layer().group_send(session_group(self.session_id), {'type': 'session.events', 'events': events})
+
+    async def test_unacked_frames_hold_back_sending(self):
+        communicator = await self.connect(Session(is_active=True))
+        await self.publish([live_event('mousemove', 1, x=1), live_event('click', 2)])
+        frame = await communicator.receive_json_from()
+        self.assertEqual((frame['frame'], len(frame['events'])), (1, 2))
+
+        # Frame 1 is unacked, so these coalesce instead of going out
+        for i in range(3, 8):
+            await self.publish([live_event('mousemove', i, x=i)])
+        self.assertTrue(await communicator.receive_nothing(0.2))
+
+        await communicator.send_json_to({'type': 'ack', 'frame': 1})
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame['frame'], 2)
+        self.assertEqual(frame['events'], [live_event('mousemove', 7, x=7)])
+        self.assertEqual(frame['coalesced'], 4)
+        await communicator.disconnect()
+
+    async def test_session_end_closes_viewer(self):
+        communicator = await self.connect(Session(is_active=True))
+        await get_channel_layer().group_send(session_group(self.session_id), {'type': 'session.ended'})
+        self.assertEqual(await communicator.receive_json_from(), {'type': 'session_ended'})
+        self.assertEqual((await communicator.receive_output())['type'], 'websocket.close')
+
+    async def test_unknown_session_refused(self):
+        communicator = WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns),
+                                             f'/ws/sessions/{uuid.uuid4()}/live/')
+        with mock.patch.object(LiveSessionConsumer, 'get_session', mock.AsyncMock(return_value=None)):
+            connected, code = await communicator.connect()
+        self.assertEqual((connected, code), (False, 4404))
+
+
+class TelemetryAdmissionTests(SimpleTestCase):
+    @override_settings(TELEMETRY_ADMISSION={'MAX_SESSIONS': 0})
+    async def test_frame_on_refused_connection(self):
+        communicator = WebsocketCommunicator(TelemetryConsumer.as_asgi(), '/ws/telemetry/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        # Sent before the client has seen the close
+        await communicator.send_to(text_data=json.dumps({'type': 'session_start'}))
+        self.assertEqual(await communicator.receive_output(), {'type': 'websocket.close', 'code': 1013})
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+
+class RetentionTests(TestCase):
+    def setUp(self):
+        self.config = {**get_retention_settings(), 'DIR': temp_dir(self)}
+        self.session = self.old_session()
+        record_clicks(self.session, 20, start=self.session.start_time)
+        self.events = event_rows(self.session)
+
+    def old_session(self):
+        session = create_session({'pageUrl': 'https://example.com/'})[0]
+        Session.objects.filter(pk=session.pk).update(start_time=timezone.now() - timedelta(days=40))
+        session.refresh_from_db()
+        return session
+
+    def test_archive_and_restore(self):
+        archive = archive_session(self.session, self.config)
+        self.assertEqual(archive.state, SessionArchive.ARCHIVED)
+        self.assertEqual(archive.event_count, 20)
+        self.assertEqual(session_event_count(self.session), 0)
+        self.assertTrue(os.path.exists(os.path.join(self.config['DIR'], archive.path)))
+
+        self.assertTrue(restore_session(self.session, self.config))
+        self.assertEqual(event_rows(self.session), self.events)
+        self.assertFalse(restore_session(self.session, self.config))
+
+    def test_apply_retention_by_age(self):
+        self.assertEqual(apply_retention(now=timezone.now() - timedelta(days=20), config=self.config)['archived'], 0)
+        result = apply_retention(config=self.config)
+        self.assertEqual((result['archived'], result['archived_events']), (1, 20))
+        self.assertFalse(Session.objects.get(pk=self.session.pk).is_active)
+        self.assertEqual(session_event_count(self.session), 0)
+
+    def test_candidates_paged_without_empty_sessions(self):
+        empty = self.old_session()
+        others = [self.old_session() for _ in range(4)]
+        for session in others:
+            record_clicks(session, 1, start=session.start_time)
+        candidates = list(iter_archive_candidates(timezone.now(), self.config, page_size=2))
+        expected = sorted([self.session, *others], key=lambda session: (session.start_time, session.id))
+        self.assertEqual(candidates, expected)
+        self.assertNotIn(empty, candidates)
+
+        apply_retention(config=self.config)
+        self.assertEqual(list(iter_archive_candidates(timezone.now(), self.config)), [])
+
+    def test_events_written_during_archiving_survive(self):
+        def write_then_record(session, directory, bounds):
+            written = write_archive(session, directory, bounds)
+            record_clicks(session, 1, start=session.start_time + timedelta(minutes=5))
+            return written
+
+        with mock.patch('core.retention.write_archive', side_effect=write_then_record):
+            archive = archive_session(self.session, self.config)
+        self.assertEqual((archive.event_count, session_event_count(self.session)), (20, 1))
+
+        restore_session(self.session, self.config)
+        self.assertEqual(session_event_count(self.session), 21)
+
+    def test_restored_sessions_archived_again_with_new_events(self):
+        archive_session(self.session, self.config)
+        restore_session(self.session, self.config)
+        record_clicks(self.session, 1, start=self.session.start_time + timedelta(minutes=5))
+
+        result = apply_retention(now=timezone.now() + timedelta(days=2), config=self.config)
+        self.assertEqual(result['repurged'], 1)
+        self.assertEqual(SessionArchive.objects.get(session=self.session).event_count, 21)
+        self.assertEqual(session_event_count(self.session), 0)
+
+    def test_replay_restores_in_background(self):
+        archive_session(self.session, self.config)
+        events_url = reverse('session_replay_events', args=[self.session.id])
+        with override_settings(TELEMETRY_RETENTION={'DIR': self.config['DIR']}), \
+                mock.patch('core.retention._run_restore') as run_restore:
+            self.addCleanup(retention._restoring.discard, self.session.pk)
+            response = self.client.get(events_url, {'start': 0})
+            self.assertEqual(response.status_code, 503)
+            self.assertIn('Retry-After', response)
+            self.assertContains(self.client.get(reverse('session_detail', args=[self.session.id])), 'being restored')
+            retention._restorer.submit(lambda: None).result()
+        run_restore.assert_called_once_with(self.session)
+        self.assertEqual(session_event_count(self.session), 0)
+
+    def test_replay_restores_inline_when_configured(self):
+        archive_session(self.session, self.config)
+        with override_settings(TELEMETRY_RETENTION={'DIR': self.config['DIR'], 'RESTORE_IN_BACKGROUND': False}):
+            response = self.client.get(reverse('session_replay_index', args=[self.session.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['event_count'], 20)
+        self.assertEqual(event_rows(self.session), self.events)
+
+
+class AnalyticsTests(TestCase):
+    def setUp(self):
+        self.config = analytics.get_analytics_settings()
+        self.start = analytics.window_start(timezone.now() - timedelta(hours=3), self.config['WINDOW_SECONDS'])
+        self.end = self.start + timedelta(seconds=self.config['WINDOW_SECONDS'])
+        self.page = create_session({'pageUrl': '/a', 'windowSize': {'width': 1000, 'height': 800}})[0]
+        other = create_session({'pageUrl': '/b', 'windowSize': {'width': 1000, 'height': 800}})[0]
+
+        def at(seconds):
+            return self.start + timedelta(seconds=seconds)
+
+        record_events([
+            # Three quick clicks on one spot, then a scroll in reaction: a rage click, none dead
+            Event(session=self.page, type='click', timestamp=at(1), data={'x': 100, 'y': 100}),
+            Event(session=self.page, type='click', timestamp=at(1.2), data={'x': 105, 'y': 100}),
+            Event(session=self.page, type='click', timestamp=at(1.4), data={'x': 110, 'y': 100}),
+            Event(session=self.page, type='scroll', timestamp=at(1.5), data={'x': 0, 'y': 400}),
+            # Nothing follows: a dead click
+            Event(session=self.page, type='click', timestamp=at(10), data={'x': 500, 'y': 400}),
+            Event(session=other, type='mousemove', timestamp=at(5), data={'x': 10, 'y': 10}),
+            # After the window
+            Event(session=self.page, type='click', timestamp=self.end + timedelta(seconds=5), data={'x': 1, 'y': 1}),
+        ])
+
+    def assert_page_a(self, aggregate):
+        self.assertEqual(
+            [aggregate[key] for key in ('events', 'sessions', 'clicks', 'moves', 'rage_clicks', 'dead_clicks')],
+            [5, 1, 4, 0, 1, 1],
+        )
+        self.assertEqual(aggregate['time_on_page'], 9.0)
+        heatmap = aggregate['click_heatmap']
+        self.assertEqual((heatmap[8, 6], heatmap[8, 7], heatmap[32, 32], heatmap.sum()), (2, 1, 1, 4))
+        # Deepest scroll plus window height: 1200 pixels, in the third 500-pixel bin
+        self.assertEqual(aggregate['scroll_depth'].nonzero()[0].tolist(), [2])
+        self.assertEqual(aggregate['time_on_page_histogram'].tolist(), [1, 0, 0, 0, 0, 0, 0])
+
+    def test_compute_window(self):
+        pages = analytics.compute_window(self.start, self.end, self.config)
+        self.assertEqual(sorted(pages), ['/a', '/b'])
+        self.assert_page_a(pages['/a'])
+        self.assertEqual((pages['/b']['moves'], pages['/b']['move_heatmap'][0, 0]), (1, 1))
+
+    def test_compacted_events_give_same_numbers(self):
+        compact_session(self.page, timezone.now())
+        self.assertFalse(Event.objects.filter(session=self.page).exists())
+        self.assert_page_a(analytics.compute_window(self.start, self.end, self.config)['/a'])
+
+    def test_stored_windows_match_computed(self):
+        self.assert_page_a(analytics.page_analytics('/a', self.start, self.end, self.config))
+        self.assertEqual(PageAnalytics.objects.filter(window_start=self.start).count(), 3)
+
+        # Read back from the stored rows, not recomputed
+        Event.objects.all().delete()
+        self.assert_page_a(analytics.page_analytics('/a', self.start, self.end, self.config))
+        total = analytics.page_analytics(None, self.start, self.end, self.config)
+        self.assertEqual((total['events'], total['sessions'], total['moves']), (6, 2, 1))
+
+
+@override_settings(TELEMETRY_SUMMARY={'FINALIZE_IN_BACKGROUND': False})
+class SummaryTests(TestCase):
+    SUMMARY_FIELDS = ('event_count', 'type_counts', 'first_event', 'last_event', 'max_scroll_depth',
+                      'click_count', 'error_count', 'bytes_ingested')
+
+    def setUp(self):
+        self.session = create_session({'pageUrl': 'https://example.com/'})[0]
+        publish = mock.patch('core.summaries.publish_session_ended', new_callable=mock.AsyncMock)
+        self.publish_session_ended = publish.start()
+        self.addCleanup(publish.stop)
+
+    def summary(self, session):
+        summary = SessionSummary.objects.get(session=session)
+        return {field: getattr(summary, field) for field in self.SUMMARY_FIELDS}
+
+    def test_batches_add_up(self):
+        start = timezone.now() - timedelta(minutes=5)
+        record_clicks(self.session, 3, start=start)
+        record_events([
+            Event(session=self.session, type=event_type, timestamp=start + timedelta(seconds=offset), data=data)
+            for event_type, offset, data in [
+                ('scroll', -1, {'x': 0, 'y': 900}),
+                ('scroll', 9, {'x': 0, 'y': 'deep'}),
+                ('error', 10, {'message': 'boom'}),
+            ]
+        ])
+        summary = self.summary(self.session)
+        counts = ('event_count', 'type_counts', 'max_scroll_depth', 'click_count', 'error_count')
+        self.assertEqual([summary[field] for field in counts], [6, {'click': 3, 'scroll': 2, 'error': 1}, 900, 3, 1])
+        self.assertEqual((summary['first_event'], summary['last_event']),
+                         (start - timedelta(seconds=1), start + timedelta(seconds=10)))
+
+        rebuild_summary(self.session)
+        self.assertEqual(self.summary(self.session), summary)
+
+    def test_sweep_closes_idle_sessions(self):
+        now = timezone.now()
+        record_clicks(self.session, 2, start=now - timedelta(hours=1))
+        busy = create_session({'pageUrl': 'https://example.com/'})[0]
+        record_clicks(busy, 1, start=now - timedelta(minutes=1))
+        silent = create_session({'pageUrl': 'https://example.com/'})[0]
+        Session.objects.filter(pk=silent.pk).update(start_time=now - timedelta(hours=2))
+        active = stats.get_counters()[stats.ACTIVE_SESSIONS]
+
+        self.assertEqual(sweep_sessions(now=now, idle_timeout=1800), 2)
+        ended = {session.id: session.end_time for session in Session.objects.filter(is_active=False)}
+        self.assertEqual(ended, {
+            self.session.id: now - timedelta(hours=1) + timedelta(seconds=1),
+            silent.id: now - timedelta(hours=2),
+        })
+        self.assertEqual(stats.get_counters()[stats.ACTIVE_SESSIONS], active - 2)
+        self.assertEqual({call.args[0] for call in self.publish_session_ended.await_args_list}, set(ended))
+        self.assertTrue(ReplayIndex.objects.filter(session=self.session).exists())
+
+        self.assertEqual(sweep_sessions(now=now, idle_timeout=1800), 0)
+        self.assertEqual(sweep_sessions(now=now, idle_timeout=30), 1)
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        firefox = 'Mozilla/5.0 (X11; Linux x86_64; rv:120.0) Gecko/20100101 Firefox/120.0'
+        chrome = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36'
+        self.checkout = create_session({'pageUrl': 'https://shop.example.com/checkout', 'userAgent': firefox})[0]
+        self.home = create_session({'pageUrl': 'https://shop.example.com/', 'userAgent': chrome})[0]
+        record_events([
+            Event(session_id=str(self.checkout.id), type='error', timestamp=timezone.now(),
+                  data={'message': 'Payment gateway timeout'}),
+            Event(session_id=str(self.home.id), type='input', timestamp=timezone.now(),
+                  data={'name': 'email', 'value': 'secret@example.com'}),
+        ])
+
+    def search(self, query, **filters):
+        return get_search_backend().search(parse_query(query), filters)
+
+    def test_browser_family(self):
+        self.assertEqual(browser_family(self.checkout.user_agent), 'firefox')
+        self.assertEqual(browser_family(self.home.user_agent), 'chrome')
+        self.assertEqual(browser_family(''), 'other')
+
+    def test_terms_fields_and_prefixes(self):
+        self.assertEqual(self.search('error:timeout')['ids'], [self.checkout.id])
+        self.assertEqual(self.search('url:check*')['ids'], [self.checkout.id])
+        self.assertEqual(self.search('input:email')['ids'], [self.home.id])
+        self.assertEqual(set(self.search('shop')['ids']), {self.checkout.id, self.home.id})
+        # Input values are never indexed
+        self.assertEqual(self.search('secret')['ids'], [])
+
+    def test_filters_and_facets(self):
+        result = self.search('shop', browser='chrome')
+        self.assertEqual(result['ids'], [self.home.id])
+        result = self.search('shop', has_errors=True)
+        self.assertEqual(result['ids'], [self.checkout.id])
+        self.assertEqual(result['facets']['has_errors'], {'true': 1, 'false': 0})
+
+    def test_terms_indexed_again_after_removal(self):
+        def record_error():
+            # Committed callbacks run, as they would outside a test transaction
+            with self.captureOnCommitCallbacks(execute=True):
+                record_events([Event(session_id=str(self.checkout.id), type='error', timestamp=timezone.now(),
+                                     data={'message': 'Payment gateway timeout'})])
+
+        record_error()
+        # As another process's rebuild_search_index would, between two batches of this one
+        SearchTerm.objects.filter(session=self.checkout, field='error').delete()
+        record_error()
+        self.assertEqual(self.search('error:timeout')['ids'], [self.checkout.id])
+
+
+class BundleTests(TestCase):
+    def setUp(self):
+        directory = temp_dir(self)
+        bundles = override_settings(TELEMETRY_REPLAY_BUNDLES={'DIR': directory})
+        bundles.enable()
+        self.addCleanup(bundles.disable)
+        self.session = create_session({'pageUrl': 'https://example.com/', 'pageHtml': '<html>page</html>'})[0]
+        record_clicks(self.session, 12)
+        Session.objects.filter(pk=self.session.pk).update(is_active=False)
+        self.session.is_active = False
+
+    def test_bundle_holds_snapshot_index_and_events(self):
+        bundle = build_bundle(self.session)
+        self.assertEqual(bundle.event_count, 12)
+        lines = b''.join(iter_decompressed(bundle_path(bundle), bundle.encoding)).splitlines()
+        header = json.loads(lines[0])
+        self.assertEqual(header['snapshot']['page_html'], '<html>page</html>')
+        self.assertEqual(len(header['seek_index']), 1)
+        self.assertEqual([json.loads(line)['data']['x'] for line in lines[1:]], list(range(12)))
+        with open(bundle_path(bundle), 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()).count(b'\n'), 13)
+
+    def test_identical_builds_share_etag(self):
+        first = build_bundle(self.session)
+        self.assertEqual(build_bundle(self.session).etag, first.etag)
+
+    def test_no_bundle_for_large_or_active_sessions(self):
+        self.assertIsNone(build_bundle(self.session, {**get_bundle_settings(), 'MAX_EVENTS': 10}))
+        self.session.is_active = True
+        self.assertIsNone(build_bundle(self.session))
+        self.assertFalse(ReplayBundle.objects.exists())
+
+    def test_events_posted_after_end_discard_bundle(self):
+        build_bundle(self.session)
+        response = self.client.post('/api/telemetry/', {
+            'type': 'batch', 'session_id': str(self.session.id),
+            'events': [{'type': 'click', 'timestamp': 1_000, 'data': {'x': 12, 'y': 12}}],
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(ReplayBundle.objects.filter(session=self.session).exists())
+        self.assertFalse(ReplayIndex.objects.filter(session=self.session).exists())
+        self.assertEqual(build_bundle(self.session).event_count, 13)
+
+
+class DatabaseWriterTests(SimpleTestCase):
+    async def run_writer(self, test, concurrency=1, queue_size=2):
+        writer = DatabaseWriter(asyncio.get_running_loop(), concurrency, queue_size)
+        try:
+            await test(writer)
+        finally:
+            for worker in writer.workers:
+                worker.cancel()
+
+    async def test_jobs_run_in_order_and_queue_is_bounded(self):
+        release = threading.Event()
+        ran = []
+
+        def job(n):
+            if n == 0:
+                release.wait(5)
+            ran.append(n)
+            return n
+
+        async def test(writer):
+            tasks = [asyncio.create_task(writer.run(job, n)) for n in range(5)]
+            await asyncio.sleep(0.05)
+            # Job 0 is running and two are queued; the last two wait for room
+            self.assertEqual(writer.queue.qsize(), 2)
+            self.assertEqual(sum(task.done() for task in tasks), 0)
+            release.set()
+            self.assertEqual(await asyncio.gather(*tasks), list(range(5)))
+            self.assertEqual(ran, list(range(5)))
+
+        await self.run_writer(test)
+
+    async def test_failures_raised_and_cancelled_jobs_skipped(self):
+        release = threading.Event()
+        ran = []
+
+        def fail():
+            raise ValueError('bad batch')
+
+        async def test(writer):
+            with self.assertRaisesMessage(ValueError, 'bad batch'):
+                await writer.run(fail)
+            blocker = asyncio.create_task(writer.run(release.wait, 5))
+            queued = asyncio.create_task(writer.run(ran.append, 'queued'))
+            await asyncio.sleep(0.05)
+            queued.cancel()
+            release.set()
+            await blocker
+            self.assertEqual(await writer.run(ran.append, 'next'), None)
+            self.assertEqual(ran, ['next'])
+
+        await self.run_writer(test, queue_size=10)
+
+
+class AdmissionTests(TestCase):
+    def setUp(self):
+        self.addCleanup(admission._clients.clear)
+        self.view = admission_control(lambda request: JsonResponse({'status': 'success'}))
+        self.factory = RequestFactory()
+
+    def config(self, **overrides):
+        return {**get_admission_settings(), **overrides}
+
+    def test_bucket_refuses_beyond_burst(self):
+        admission = Admission(self.config(RATE=2, BURST=1.5, SLOW_DOWN_AT=0.5, SLOW_DOWN_MS=250))
+        results = [admission.admit() for _ in range(4)]
+        self.assertEqual(results[0], (True, None))
+        # Below half the bucket: still admitted, but asked to slow down
+        self.assertEqual(results[1], (True, 250))
+        self.assertTrue(results[2][0])
+        admitted, delay = results[3]
+        self.assertFalse(admitted)
+        self.assertGreaterEqual(delay, 250)
+
+    def post(self, session_id=None, **headers):
+        path = f'/api/telemetry/?session_id={session_id}' if session_id else '/api/telemetry/'
+        return self.view(self.factory.post(path, data='{}', content_type='application/json', headers=headers))
+
+    def test_http_limits(self):
+        view, factory = self.view, self.factory
+        session_id = create_session({'pageUrl': 'https://example.com/'})[0].id
+
+        limits = override_settings(TELEMETRY_ADMISSION={'MAX_BODY_BYTES': 10})
+        with limits, self.assertLogs('core.admission', 'WARNING'):
+            response = view(factory.post(f'/api/telemetry/?session_id={session_id}', data='x' * 11,
+                                         content_type='application/json'))
+        self.assertEqual(response.status_code, 413)
+
+        with override_settings(TELEMETRY_ADMISSION={'RATE': 1, 'BURST': 1.0}):
+            responses = [view(factory.post(f'/api/telemetry/?session_id={session_id}', data='{}',
+                                           content_type='application/json')) for _ in range(2)]
+        self.assertEqual(responses[0].status_code, 200)
+        self.assertEqual(responses[1].status_code, 429)
+        self.assertIn('Retry-After', responses[1])
+
+    @override_settings(TELEMETRY_ADMISSION={'RATE': 1, 'BURST': 1.0})
+    def test_only_existing_sessions_get_their_own_bucket(self):
+        sessions = [create_session({'pageUrl': 'https://example.com/'})[0].id for _ in range(2)]
+        self.assertEqual([self.post(session_id).status_code for session_id in sessions], [200, 200])
+        made_up = [self.post(uuid.uuid4()).status_code, self.post('not-a-uuid').status_code, self.post().status_code]
+        self.assertEqual(made_up, [200, 429, 429])
+
+    @override_settings(TELEMETRY_ADMISSION={'RATE': 1, 'BURST': 1.0, 'CLIENT_ADDRESS_HEADER': 'X-Forwarded-For'})
+    def test_client_address_from_trusted_header(self):
+        statuses = [self.post(X_Forwarded_For=f'{spoofed}, 10.0.0.1').status_code for spoofed in ('1.1.1.1', '2.2.2.2')]
+        self.assertEqual(statuses, [200, 429])
+        self.assertEqual(self.post(X_Forwarded_For='10.0.0.2').status_code, 200)
+
+    @override_settings(TELEMETRY_ADMISSION={'RATE': 1, 'BURST': 1.0})
+    def test_forwarded_header_ignored_unless_configured(self):
+        self.assertEqual(self.post(X_Forwarded_For='10.0.0.1').status_code, 200)
+        self.assertEqual(self.post(X_Forwarded_For='10.0.0.2').status_code, 429)
+
+
+class TransferTests(TestCase):
+    def setUp(self):
+        self.directory = temp_dir(self)
+        self.session = create_session({'pageUrl': 'https://example.com/', 'pageHtml': '<html>exported</html>'})[0]
+        record_clicks(self.session, 30)
+        self.events = event_rows(self.session)
+        self.start = self.session.start_time - timedelta(hours=1)
+        self.end = timezone.now() + timedelta(hours=1)
+
+    def round_trip(self, formats):
+        manifest = export_telemetry(self.directory, self.start, self.end, formats=formats)
+        self.assertEqual(sum(entry['sessions'] for entry in manifest['partitions']), 1)
+        Session.objects.all().delete()
+        self.assertEqual(import_telemetry(self.directory), (1, 30))
+        session = Session.objects.get(pk=self.session.pk)
+        self.assertEqual(event_rows(session), self.events)
+        self.assertEqual(session.page_html, '<html>exported</html>')
+
+    def test_ndjson_round_trip(self):
+        self.round_trip(('ndjson',))
+
+    def test_columnar_round_trip(self):
+        self.round_trip(('columnar',))
+
+    def test_import_skips_existing_sessions(self):
+        export_telemetry(self.directory, self.start, self.end)
+        self.assertEqual(import_telemetry(self.directory), (0, 0))
@@ -0,0 +1,361 @@
+"""
+Bulk export and import of sessions for offline analysis or moving between
+environments.
+
+``export_telemetry`` takes the sessions that started in ``[start, end)``
+with all their events, split into partitions of PARTITION_HOURS of session
+start time. Partitions are written by a process pool, each worker streaming
+its rows with ``iterator(chunk_size=...)`` (server-side cursors on
+PostgreSQL), so memory stays flat however much is exported. An export
+directory holds::
+
+    manifest.json                      written last, listing the partitions
+    <partition>/sessions.ndjson.gz     one session per line
+    <partition>/snapshots.ndjson.gz    {"hash", "content"} of the page snapshots they use
+    <partition>/events.ndjson.gz       {"session", "type", "timestamp_us", "data"} per line
+    <partition>/events-<n>.npz         the same events as column arrays, ROW_GROUP_SIZE a file
+
+``timestamp_us`` counts microseconds since the Unix epoch, as in archives
+(core/retention.py). Events come grouped by session, raw rows first and
+then compacted chunks (core/chunks.py), each run in time order. DOM
+snapshot events carry their tree inline, so an export needs no blob store
+to be read.
+
+The columnar files are NumPy ``.npz`` archives laid out like Parquet row
+groups: ``session`` (u32, index into ``sessions``), ``type`` (u16, index
+into ``types``), ``timestamp_us`` (i64), ``x``/``y`` (i32) with ``has_xy``,
+and each event's whole data as JSON in ``payload`` sliced by
+``offsets[i]:offsets[i + 1]``. They load with ``numpy.load`` alone.
+
+``import_telemetry`` reads an export back partition by partition, skipping
+sessions that already exist: sessions first, then their snapshot bodies,
+then events through ``record_events`` in transactions of BATCH_SIZE rows,
+so summaries, the search index and every storage backend are filled as by
+live ingest. Import workers only help on PostgreSQL; on SQLite one process
+at a time can write.
+"""
+import gzip
+import json
+import logging
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from itertools import islice
+
+import django
+import numpy as np
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import stats
+from .chunks import INT32, decode_chunk
+from .dom import expand_dom_snapshots
+from .ingest import record_events
+from .models import Event, EventChunk, Session, SessionSummary, SnapshotBlob
+from .search import index_session
+from .snapshots import SnapshotError, reference_snapshot, upload_snapshot
+from .spool import EPOCH
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMAT = 'clearsight-export'
+EXPORT_VERSION = 1
+FORMATS = ('ndjson', 'columnar')
+PARTITION_HOURS = 24
+CHUNK_SIZE = 5000  # Rows fetched per round trip while exporting
+ROW_GROUP_SIZE = 100_000  # Events per columnar file
+BATCH_SIZE = 5000  # Events per import transaction
+
+SESSION_FIELDS = (
+    'id', 'start_time', 'end_time', 'page_url', 'page_title', 'user_agent',
+    'screen_width', 'screen_height', 'window_width', 'window_height', 'is_active',
+)
+
+
+class TransferError(Exception):
+    pass
+
+
+def _micros(value):
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def _is_int32(value):
+    return isinstance(value, int) and not isinstance(value, bool) and INT32[0] <= value <= INT32[1]
+
+
+def _dumps(value):
+    return json.dumps(value, cls=DjangoJSONEncoder, separators=(',', ':')).encode() + b'\n'
+
+
+def partitions(start, end, hours=PARTITION_HOURS):
+    """Split ``[start, end)`` into ``(name, start, end)`` slices of ``hours``."""
+    step = timedelta(hours=hours)
+    while start < end:
+        yield f'{start:%Y%m%dT%H%M}', start, min(start + step, end)
+        start += step
+
+
+def _init_worker():
+    # Under spawn the worker starts without Django; under fork it must not reuse the parent's connections
+    django.setup()
+    connections.close_all()
+
+
+def _run(func, tasks, workers):
+    """Yield ``func(*task)`` for every task, across ``workers`` processes when there is more than one."""
+    if workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield func(*task)
+        return
+    # Forked workers would otherwise share the parent's database sockets
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        yield from pool.map(func, *zip(*tasks))
+
+
+class ColumnWriter:
+    """Writes events as ``.npz`` row groups of at most ROW_GROUP_SIZE (see the module docstring)."""
+
+    def __init__(self, directory, row_group_size=ROW_GROUP_SIZE):
+        self.directory = directory
+        self.row_group_size = row_group_size
+        self.files = []
+        self._reset()
+
+    def _reset(self):
+        self.sessions, self.types = {}, {}
+        self.session, self.type = array('I'), array('H')
+        self.timestamp, self.x, self.y, self.has_xy = array('q'), array('i'), array('i'), array('B')
+        self.offsets = array('Q', [0])
+        self.payload = bytearray()
+
+    def add(self, session_id, event_type, timestamp_us, data):
+        self.session.append(self.sessions.setdefault(session_id, len(self.sessions)))
+        self.type.append(self.types.setdefault(event_type, len(self.types)))
+        self.timestamp.append(timestamp_us)
+        xy = isinstance(data, dict) and _is_int32(data.get('x')) and _is_int32(data.get('y'))
+        self.x.append(data['x'] if xy else 0)
+        self.y.append(data['y'] if xy else 0)
+        self.has_xy.append(1 if xy else 0)
+        self.payload += json.dumps(data, separators=(',', ':')).encode()
+        self.offsets.append(len(self.payload))
+        if len(self.session) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.session:
+            return
+        name = f'events-{len(self.files):05d}.npz'
+        np.savez_compressed(
+            os.path.join(self.directory, name),
+            sessions=np.array(list(self.sessions), dtype='U36'),
+            types=np.array(list(self.types)),
+            session=np.frombuffer(self.session, dtype=np.uint32),
+            type=np.frombuffer(self.type, dtype=np.uint16),
+            timestamp_us=np.frombuffer(self.timestamp, dtype=np.int64),
+            x=np.frombuffer(self.x, dtype=np.int32),
+            y=np.frombuffer(self.y, dtype=np.int32),
+            has_xy=np.frombuffer(self.has_xy, dtype=np.uint8).astype(bool),
+            offsets=np.frombuffer(self.offsets, dtype=np.uint64),
+            payload=np.frombuffer(bytes(self.payload), dtype=np.uint8),
+        )
+        self.files.append(name)
+        self._reset()
+
+
+def read_columns(path):
+    """Yield ``(session_id, type, timestamp_us, data)`` from a columnar events file."""
+    with np.load(path) as columns:
+        sessions, types = columns['sessions'].tolist(), columns['types'].tolist()
+        offsets, payload = columns['offsets'].tolist(), columns['payload'].tobytes()
+        for i, (session, event_type, timestamp) in enumerate(zip(
+                columns['session'].tolist(), columns['type'].tolist(), columns['timestamp_us'].tolist())):
+            yield sessions[session], types[event_type], timestamp, json.loads(payload[offsets[i]:offsets[i + 1]])
+
+
+def _partition_events(sessions):
+    """Yield the partition's events as dicts, raw rows streamed first and then decoded chunks."""
+    raw = (
+        Event.objects.filter(session__in=sessions)
+        .order_by('session_id', 'timestamp', 'id')
+        .values('session_id', 'type', 'timestamp', 'data')
+    )
+    yield from raw.iterator(chunk_size=CHUNK_SIZE)
+    chunks = EventChunk.objects.filter(session__in=sessions).order_by('session_id', 'start_time')
+    for chunk in chunks.iterator(chunk_size=max(1, CHUNK_SIZE // 100)):
+        yield from decode_chunk(chunk)
+
+
+def export_partition(directory, name, start, end, formats):
+    """Write one partition's files. Returns its manifest entry, or None when no session started in it."""
+    sessions = Session.objects.filter(start_time__gte=start, start_time__lt=end)
+    if not sessions.exists():
+        return None
+    path = os.path.join(directory, name)
+    os.makedirs(path, exist_ok=True)
+
+    session_count = 0
+    with gzip.open(os.path.join(path, 'sessions.ndjson.gz'), 'wb', compresslevel=6) as f:
+        rows = sessions.order_by('start_time', 'id').values(*SESSION_FIELDS, 'page_html_blob_id', 'page_styles_blob_id')
+        for row in rows.iterator(chunk_size=CHUNK_SIZE):
+            # DjangoJSONEncoder would cut the times to milliseconds
+            for field in ('start_time', 'end_time'):
+                row[field] = row[field] and row[field].isoformat()
+            row['page_html_hash'] = row.pop('page_html_blob_id')
+            row['page_styles_hash'] = row.pop('page_styles_blob_id')
+            f.write(_dumps(row))
+            session_count += 1
+
+    with gzip.open(os.path.join(path, 'snapshots.ndjson.gz'), 'wb', compresslevel=6) as f:
+        used = Q(hash__in=sessions.values('page_html_blob_id')) | Q(hash__in=sessions.values('page_styles_blob_id'))
+        blobs = SnapshotBlob.objects.filter(used, data__isnull=False)
+        for blob in blobs.order_by('hash').iterator(chunk_size=10):
+            f.write(_dumps({'hash': blob.hash, 'content': blob.content}))
+
+    event_count = 0
+    ndjson = gzip.open(os.path.join(path, 'events.ndjson.gz'), 'wb', compresslevel=6) if 'ndjson' in formats else None
+    columns = ColumnWriter(path) if 'columnar' in formats else None
+    try:
+        for event in expand_dom_snapshots(_partition_events(sessions)):
+            session_id, timestamp = str(event['session_id']), _micros(event['timestamp'])
+            if ndjson is not None:
+                ndjson.write(_dumps({'session': session_id, 'type': event['type'], 'timestamp_us': timestamp,
+                                     'data': event['data']}))
+            if columns is not None:
+                columns.add(session_id, event['type'], timestamp, event['data'])
+            event_count += 1
+    finally:
+        if ndjson is not None:
+            ndjson.close()
+    if columns is not None:
+        columns.flush()
+
+    logger.info(f'Exported partition {name}: {session_count} sessions, {event_count} events')
+    return {
+        'name': name,
+        'start': start,
+        'end': end,
+        'sessions': session_count,
+        'events': event_count,
+        'columnar': columns.files if columns is not None else [],
+    }
+
+
+def export_telemetry(directory, start, end, workers=1, formats=FORMATS, partition_hours=PARTITION_HOURS):
+    """Export the sessions started in ``[start, end)`` to ``directory``. Returns the manifest."""
+    unknown = set(formats) - set(FORMATS)
+    if unknown or not formats:
+        raise TransferError(f'Unknown export formats: {", ".join(sorted(unknown)) or "none given"}')
+    os.makedirs(directory, exist_ok=True)
+    tasks = [(directory, name, first, last, tuple(formats)) for name, first, last in partitions(start, end, partition_hours)]
+    entries = [entry for entry in _run(export_partition, tasks, workers) if entry is not None]
+    manifest = {
+        'format': EXPORT_FORMAT,
+        'version': EXPORT_VERSION,
+        'exported_at': timezone.now(),
+        'start': start,
+        'end': end,
+        'formats': list(formats),
+        'partitions': entries,
+    }
+    # Written last: a directory without a manifest is an unfinished export
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, cls=DjangoJSONEncoder, indent=2)
+    return manifest
+
+
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, 'manifest.json')) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        raise TransferError(f'Cannot read the manifest of {directory}: {e}') from e
+    if manifest.get('format') != EXPORT_FORMAT or manifest.get('version') != EXPORT_VERSION:
+        raise TransferError(f'{directory} is not a clearsight export this version can read')
+    return manifest
+
+
+def _iter_lines(path):
+    with gzip.open(path, 'rb') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def _import_sessions(rows):
+    """Create the sessions of ``rows`` that don't exist yet. Returns the ids created."""
+    existing = {str(pk) for pk in Session.objects.filter(id__in=[row['id'] for row in rows]).values_list('id', flat=True)}
+    created = []
+    with transaction.atomic():
+        for row in rows:
+            if row['id'] in existing:
+                continue
+            session = Session(
+                **{field: row[field] for field in SESSION_FIELDS if field not in ('start_time', 'end_time')},
+                end_time=parse_datetime(row['end_time']) if row['end_time'] else None,
+                page_html_blob=reference_snapshot(hash=row['page_html_hash']),
+                page_styles_blob=reference_snapshot(hash=row['page_styles_hash']),
+            )
+            session.start_time = parse_datetime(row['start_time'])
+            created.append(session)
+        start_times = [session.start_time for session in created]
+        Session.objects.bulk_create(created)
+        # auto_now_add stamped the import time on the way in; put the recorded start back
+        for session, start_time in zip(created, start_times):
+            session.start_time = start_time
+        Session.objects.bulk_update(created, ['start_time'])
+        SessionSummary.objects.bulk_create([SessionSummary(session=session) for session in created])
+        for session in created:
+            index_session(session)
+        stats.increment(stats.SESSIONS, len(created))
+        stats.increment(stats.ACTIVE_SESSIONS, sum(session.is_active for session in created))
+    return {str(session.id) for session in created}
+
+
+def import_partition(directory, entry, formats):
+    """Load one partition of an export. Returns ``(sessions, events)`` imported."""
+    path = os.path.join(directory, entry['name'])
+    imported = set()
+    rows = _iter_lines(os.path.join(path, 'sessions.ndjson.gz'))
+    while batch := list(islice(rows, BATCH_SIZE)):
+        imported |= _import_sessions(batch)
+    if not imported:
+        return 0, 0
+
+    for snapshot in _iter_lines(os.path.join(path, 'snapshots.ndjson.gz')):
+        try:
+            upload_snapshot(snapshot['hash'], snapshot['content'])
+        except SnapshotError as e:
+            logger.warning(f"Skipped snapshot {snapshot['hash']} of partition {entry['name']}: {e}")
+
+    if 'ndjson' in formats:
+        events = ((row['session'], row['type'], row['timestamp_us'], row['data'])
+                  for row in _iter_lines(os.path.join(path, 'events.ndjson.gz')))
+    else:
+        events = (event for name in entry['columnar'] for event in read_columns(os.path.join(path, name)))
+    events = (
+        Event(session_id=session_id, type=event_type, timestamp=EPOCH + timedelta(microseconds=timestamp), data=data)
+        for session_id, event_type, timestamp, data in events
+        if session_id in imported
+    )
+    count = 0
+    while batch := list(islice(events, BATCH_SIZE)):
+        record_events(batch)
+        count += len(batch)
+    logger.info(f"Imported partition {entry['name']}: {len(imported)} sessions, {count} events")
+    return len(imported), count
+
+
+def import_telemetry(directory, workers=1):
+    """Import an export written by ``export_telemetry``. Returns ``(sessions, events)`` imported."""
+    manifest = read_manifest(directory)
+    tasks = [(directory, entry, tuple(manifest['formats'])) for entry in manifest['partitions']]
+    sessions = events = 0
+    for imported_sessions, imported_events in _run(import_partition, tasks, workers):
+        sessions += imported_sessions
+        events += imported_events
+    return sessions, events
@@ -6,6 +6,15 @@ urlpatterns = [
     path('sessions/', views.sessions_list, name='sessions_list'),
     path('sessions/<uuid:session_id>/', views.session_detail, name='session_detail'),
     path('sessions/<uuid:session_id>/replay/', views.session_replay, name='session_replay'),
+    path('sessions/<uuid:session_id>/replay/snapshot/', views.session_replay_snapshot, name='session_replay_snapshot'),
+    path('sessions/<uuid:session_id>/replay/events/', views.session_replay_events, name='session_replay_events'),
+    path('sessions/<uuid:session_id>/replay/index/', views.session_replay_index, name='session_replay_index'),
+    path('sessions/<uuid:session_id>/replay/bundle/<str:etag>/', views.session_replay_bundle, name='session_replay_bundle'),
     path('test/', views.test_page, name='test_page'),
     path('api/telemetry/', views.telemetry, name='telemetry'),
+    path('api/snapshots/', views.snapshot_upload, name='snapshot_upload'),
+    path('api/analytics/events/', views.analytics_events, name='analytics_events'),
+    path('api/analytics/pages/', views.analytics_pages, name='analytics_pages'),
+    path('api/search/sessions/', views.search_sessions, name='search_sessions'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
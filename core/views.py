@@ -1,16 +1,59 @@
 from django.shortcuts import render, get_object_or_404
 from django.utils import timezone
-from .models import Session, Event
+from datetime import datetime, timedelta, timezone as dt_timezone
+from .models import ReplayBundle, Session, SessionSummary
+from . import analytics, metrics, stats
+import base64
 import json
+import re
+import time
+from itertools import islice
 from uuid import UUID
 from django.core.serializers.json import DjangoJSONEncoder
 import logging
-from django.http import JsonResponse
-from django.views.decorators.csrf import csrf_protect
+from django.db import DatabaseError
+from django.db.models import F, Q
+from django.db.models.functions import Coalesce
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
+from django.core.exceptions import RequestDataTooBig
+from django.urls import reverse
+from django.views.decorators.csrf import csrf_protect, ensure_csrf_cookie
 from django.views.decorators.http import require_http_methods
+from .admission import admission_control
+from .backends import get_analytics_backend
+from .bundles import bundle_path, get_replay_bundle, iter_decompressed
+from .chunks import iter_session_events, session_event_count, session_events, session_time_range
+from .codec import DecodeError
+from .dom import expand_dom_snapshots
+from .live import publish_events_sync
+from .replay import get_replay_index
+from .retention import ArchiveError, request_restore
+from .sampling import client_policy, get_sampler
+from .search import get_search_backend, get_search_settings, parse_query
+from .ingest import EVENT_TYPES, BatchError, build_event, create_session, parse_batch, parse_packed, store_events
+from .snapshots import SnapshotError, upload_snapshot
 
 logger = logging.getLogger(__name__)
 
+SESSIONS_PAGE_SIZE = 50
+# Events listed on the session detail page; the summary covers the rest
+DETAIL_EVENTS_LIMIT = 1000
+# Columns the session listings render; snapshots and the rest stay unloaded
+LISTING_FIELDS = ('id', 'start_time', 'end_time', 'is_active', 'page_url', 'page_title')
+
+# Replay events are fetched in time windows of this many milliseconds
+REPLAY_WINDOW_MS = 30_000
+REPLAY_MAX_WINDOW_MS = 300_000
+# Seconds clients wait before asking again for a session being restored from its archive
+RESTORE_RETRY_AFTER = 5
+# A single byte range of a replay bundle: bytes=first-[last] or bytes=-suffix
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# Most histogram buckets one analytics request may ask for
+ANALYTICS_MAX_BUCKETS = 10_000
+# Longest range page analytics may cover
+PAGE_ANALYTICS_MAX_HOURS = 24 * 90
+
 # Create your views here.
 
 class UUIDEncoder(json.JSONEncoder):
@@ -19,101 +62,411 @@ class UUIDEncoder(json.JSONEncoder):
             return str(obj)
         return super().default(obj)
 
+def with_event_counts(sessions):
+    """Annotate event counts from the session summaries (see core/summaries.py), archived events included."""
+    return sessions.annotate(event_count=Coalesce('summary__event_count', 0))
+
+def encode_cursor(session):
+    value = f'{session.start_time.isoformat()}|{session.id}'
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+def decode_cursor(cursor):
+    start_time, session_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return datetime.fromisoformat(start_time), UUID(session_id)
+
 def dashboard(request):
+    counters = stats.get_counters()
+    recent_sessions = with_event_counts(Session.objects.only(*LISTING_FIELDS)).order_by('-start_time', '-id')[:10]
     context = {
-        'active_sessions': Session.objects.filter(is_active=True).count(),
-        'total_sessions': Session.objects.count(),
-        'total_events': Event.objects.count(),
-        'recent_sessions': Session.objects.order_by('-start_time')[:10]
+        'active_sessions': counters[stats.ACTIVE_SESSIONS],
+        'total_sessions': counters[stats.SESSIONS],
+        'total_events': counters[stats.EVENTS],
+        'recent_sessions': recent_sessions
     }
     return render(request, 'core/dashboard.html', context)
 
+def restore_archived(session):
+    # Archived sessions are loaded back into the database when someone looks at them; True until they are
+    try:
+        return request_restore(session)
+    except ArchiveError as e:
+        logger.error(f'Failed to restore archived session {session.id}: {e}')
+        return False
+
+def restoring_response():
+    response = JsonResponse({'status': 'restoring', 'message': 'Session is being restored from its archive'},
+                            status=503)
+    response['Retry-After'] = str(RESTORE_RETRY_AFTER)
+    return response
+
 def session_detail(request, session_id):
     session = Session.objects.get(id=session_id)
-    events = session.events.all()
-    
+    restoring = restore_archived(session)
+    summary = SessionSummary.objects.filter(session=session).first()
+    # Read window by window so a long session stops loading once the limit is reached
+    events = list(islice(iter_session_events(session), DETAIL_EVENTS_LIMIT))
+
     context = {
         'session': session,
+        'summary': summary,
         'events': events,
+        'restoring': restoring,
+        'retry_after': RESTORE_RETRY_AFTER,
+        'more_events': summary.event_count - len(events) if summary and summary.event_count > len(events) else 0,
     }
     return render(request, 'core/session_detail.html', context)
 
 def sessions_list(request):
-    sessions = Session.objects.order_by('-start_time')
+    # Keyset pagination on (start_time, id) so deep pages cost the same as the first
+    sessions = with_event_counts(Session.objects.only(*LISTING_FIELDS)).order_by('-start_time', '-id')
+    cursor = request.GET.get('before')
+    if cursor:
+        try:
+            start_time, session_id = decode_cursor(cursor)
+        except (ValueError, UnicodeDecodeError):
+            return HttpResponseBadRequest('Invalid cursor')
+        sessions = sessions.filter(Q(start_time__lt=start_time) | Q(start_time=start_time, id__lt=session_id))
+
+    page = list(sessions[:SESSIONS_PAGE_SIZE + 1])
+    next_cursor = encode_cursor(page[SESSIONS_PAGE_SIZE - 1]) if len(page) > SESSIONS_PAGE_SIZE else None
     context = {
-        'sessions': sessions,
+        'sessions': page[:SESSIONS_PAGE_SIZE],
+        'next_cursor': next_cursor,
+        'is_first_page': not cursor,
     }
     return render(request, 'core/sessions_list.html', context)
 
 def session_replay(request, session_id):
     try:
-        session = get_object_or_404(Session, id=session_id)
-        events = list(session.events.order_by('timestamp').values())
-        
-        # Convert timestamps to milliseconds since epoch
-        for event in events:
-            event['timestamp'] = int(event['timestamp'].timestamp() * 1000)
-            event['session_id'] = str(event['session_id'])  # Convert UUID to string
-        
-        # Prepare session data for the template
+        session = get_object_or_404(
+            Session.objects.annotate(
+                html_size=F('page_html_blob__size'),
+                styles_size=F('page_styles_blob__size')
+            ),
+            id=session_id
+        )
+        # Ended sessions replay from their bundle, which outlives archiving; no restore needed
+        bundle = get_replay_bundle(session, build=False)
+        restoring = bundle is None and restore_archived(session)
+        if bundle is None and not restoring:
+            try:
+                bundle = get_replay_bundle(session)
+            except (DatabaseError, OSError) as e:
+                logger.error(f'Failed to build replay bundle of session {session.id}: {e}')
+        if bundle is not None:
+            start, end, event_count = bundle.start_ms, bundle.end_ms, bundle.event_count
+        else:
+            first, last = session_time_range(session)
+            start, end = (to_millis(first), to_millis(last)) if first else (None, None)
+            event_count = session_event_count(session)
+
+        # Only timeline metadata is inlined; the snapshot and events are fetched by session-replay.js
         session_data = {
             'id': str(session.id),
-            'page_html': session.page_html or '<html><body><p>No content captured</p></body></html>',
-            'page_styles': session.page_styles or '',
-            'events': events
+            'snapshot_url': reverse('session_replay_snapshot', args=[session.id]),
+            'events_url': reverse('session_replay_events', args=[session.id]),
+            'index_url': reverse('session_replay_index', args=[session.id]),
+            'bundle_url': reverse('session_replay_bundle', args=[session.id, bundle.etag]) if bundle else None,
+            'start': start,
+            'end': end,
+            'window': REPLAY_WINDOW_MS,
+            'is_active': session.is_active,
+            'live_url': f'/ws/sessions/{session.id}/live/',
         }
-        
-        # Log debug information
-        logger.debug(f"Session replay data prepared: {len(events)} events, HTML size: {len(session_data['page_html'])} bytes")
-        
+
         context = {
             'session': session,
+            'event_count': event_count,
+            'restoring': restoring,
+            'retry_after': RESTORE_RETRY_AFTER,
             'session_data_json': json.dumps(session_data, cls=DjangoJSONEncoder),
         }
-        
+
         return render(request, 'core/session_replay.html', context)
-        
+
     except Exception as e:
         logger.error(f"Error preparing session replay: {e}")
         raise  # Re-raise the exception to show the error page
 
+def session_replay_snapshot(request, session_id):
+    session = get_object_or_404(Session.objects.select_related('page_html_blob', 'page_styles_blob'), id=session_id)
+    return JsonResponse({
+        'page_html': session.page_html or '<html><body><p>No content captured</p></body></html>',
+        'page_styles': session.page_styles or '',
+    })
+
+def session_replay_index(request, session_id):
+    session = get_object_or_404(Session, id=session_id)
+    if restore_archived(session):
+        return restoring_response()
+    index = get_replay_index(session)
+    return JsonResponse({
+        'event_count': index.event_count,
+        'seek_index': index.seek_index,
+        'keyframes': index.keyframes,
+    })
+
+def parse_range(header, size):
+    """Return ``(first, last)`` for a single ``bytes=`` range, None to ignore it, or False if unsatisfiable."""
+    match = RANGE_RE.match(header)
+    if not match:
+        return None
+    first, last = match.groups()
+    if first:
+        first = int(first)
+        last = min(int(last), size - 1) if last else size - 1
+    elif last:
+        # Suffix range: the final ``last`` bytes
+        first, last = max(size - int(last), 0), size - 1
+    else:
+        return None
+    if first > last or first >= size:
+        return False
+    return first, last
+
+def session_replay_bundle(request, session_id, etag):
+    """Serve an ended session's precompressed replay bundle (see core/bundles.py).
+
+    The URL names the bundle's ETag, so responses are immutable and cached
+    for a year. Clients that don't accept the bundle's encoding get it
+    decompressed, without range support. 404 once the bundle is rebuilt or
+    for active sessions, which replay from the tables.
+    """
+    bundle = ReplayBundle.objects.filter(session_id=session_id, session__is_active=False).first()
+    if bundle is None or bundle.etag != etag:
+        raise Http404('No such replay bundle')
+    path = bundle_path(bundle)
+    quoted = f'"{bundle.etag}"'
+
+    def with_cache_headers(response):
+        response['ETag'] = quoted
+        response['Cache-Control'] = 'public, max-age=31536000, immutable'
+        response['Vary'] = 'Accept-Encoding'
+        return response
+
+    if_none_match = request.headers.get('If-None-Match', '')
+    if if_none_match.strip() == '*' or quoted in [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]:
+        return with_cache_headers(HttpResponse(status=304))
+
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        raise Http404('No such replay bundle')
+
+    if not re.search(rf'\b{bundle.encoding}\b', request.headers.get('Accept-Encoding', '')):
+        f.close()
+        response = StreamingHttpResponse(iter_decompressed(path, bundle.encoding), content_type='application/x-ndjson')
+        return with_cache_headers(response)
+
+    byte_range = None
+    if request.headers.get('Range') and request.headers.get('If-Range', quoted) == quoted:
+        byte_range = parse_range(request.headers['Range'], bundle.size)
+    if byte_range is False:
+        f.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{bundle.size}'
+        return response
+
+    if byte_range is None:
+        response = FileResponse(f, content_type='application/x-ndjson')
+    else:
+        first, last = byte_range
+        with f:
+            f.seek(first)
+            response = HttpResponse(f.read(last - first + 1), status=206, content_type='application/x-ndjson')
+        response['Content-Range'] = f'bytes {first}-{last}/{bundle.size}'
+    response['Content-Encoding'] = bundle.encoding
+    response['Accept-Ranges'] = 'bytes'
+    return with_cache_headers(response)
+
+def session_replay_events(request, session_id):
+    """Stream one time window of a session's events as NDJSON.
+
+    ``start`` and ``end`` are milliseconds since the epoch; the window is
+    clamped to REPLAY_MAX_WINDOW_MS so a single request stays bounded.
+    """
+    session = get_object_or_404(Session.objects.only('id'), id=session_id)
+    if restore_archived(session):
+        return restoring_response()
+    try:
+        start = int(request.GET['start'])
+        end = min(int(request.GET.get('end', start + REPLAY_WINDOW_MS)), start + REPLAY_MAX_WINDOW_MS)
+        window = from_millis(start), from_millis(end)
+    except (KeyError, ValueError, OverflowError, OSError):
+        # OverflowError and OSError: integers outside the range datetime can represent
+        return JsonResponse({'status': 'error', 'message': 'start and end must be integer milliseconds'}, status=400)
+
+    def lines():
+        for event in expand_dom_snapshots(session_events(session, *window)):
+            yield json.dumps({
+                'type': event['type'],
+                'timestamp': to_millis(event['timestamp']),
+                'data': event['data'],
+            }, cls=DjangoJSONEncoder) + '\n'
+
+    response = StreamingHttpResponse(lines(), content_type='application/x-ndjson')
+    response['X-Window-End'] = str(end)
+    return response
+
+def analytics_events(request):
+    """Event totals per type and per ``interval`` seconds over the last ``hours``.
+
+    Served by the analytics storage backend, so with OpenSearch configured
+    the aggregation runs in the search store instead of the events table.
+    """
+    try:
+        hours = int(request.GET.get('hours', 24))
+        interval = int(request.GET.get('interval', 3600))
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'hours and interval must be integers'}, status=400)
+    if hours <= 0 or interval <= 0 or hours * 3600 // interval > ANALYTICS_MAX_BUCKETS:
+        return JsonResponse({'status': 'error', 'message': 'Invalid time range'}, status=400)
+
+    end = timezone.now()
+    start = end - timedelta(hours=hours)
+    try:
+        result = get_analytics_backend().event_stats(start, end, interval)
+    except Exception as e:
+        logger.error(f'Analytics query failed: {e}')
+        return JsonResponse({'status': 'error', 'message': 'Analytics backend unavailable'}, status=502)
+
+    return JsonResponse({
+        'start': to_millis(start),
+        'end': to_millis(end),
+        'interval': interval,
+        **result
+    })
+
+def analytics_pages(request):
+    """Heatmaps, rage and dead clicks, scroll depth and time on page over the last ``hours``.
+
+    Covers one page with ``?page=<url>``, all pages otherwise. The range is
+    rounded out to whole analytics windows (see core/analytics.py).
+    """
+    try:
+        hours = int(request.GET.get('hours', 24))
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'hours must be an integer'}, status=400)
+    if hours <= 0 or hours > PAGE_ANALYTICS_MAX_HOURS:
+        return JsonResponse({'status': 'error', 'message': 'Invalid time range'}, status=400)
+
+    page_url = request.GET.get('page') or None
+    config = analytics.get_analytics_settings()
+    end = timezone.now()
+    start = analytics.window_start(end - timedelta(hours=hours), config['WINDOW_SECONDS'])
+    result = analytics.page_analytics(page_url, start, end, config)
+
+    return JsonResponse({
+        'page': page_url,
+        'start': to_millis(start),
+        'end': to_millis(end),
+        'window': config['WINDOW_SECONDS'],
+        **analytics.describe(result, config)
+    })
+
+def search_sessions(request):
+    """Sessions matching ``q``, newest first, with facet counts (see core/search.py).
+
+    Filters: ``browser``, ``page`` (exact URL), ``date`` (YYYY-MM-DD, UTC) and
+    ``has_errors`` (true/false). Pages follow the ``next`` cursor via ``before``.
+    """
+    config = get_search_settings()
+    filters = {'browser': request.GET.get('browser', '').lower(), 'page': request.GET.get('page', '')}
+    try:
+        limit = min(int(request.GET.get('limit', config['PAGE_SIZE'])), config['MAX_PAGE_SIZE'])
+        if request.GET.get('date'):
+            filters['date'] = datetime.strptime(request.GET['date'], '%Y-%m-%d').date()
+        cursor = decode_cursor(request.GET['before']) if request.GET.get('before') else None
+    except (ValueError, UnicodeDecodeError):
+        return JsonResponse({'status': 'error', 'message': 'Invalid limit, date or cursor'}, status=400)
+    if limit <= 0:
+        return JsonResponse({'status': 'error', 'message': 'Invalid limit'}, status=400)
+    has_errors = request.GET.get('has_errors', '').lower()
+    if has_errors:
+        if has_errors not in ('true', 'false', '1', '0'):
+            return JsonResponse({'status': 'error', 'message': 'has_errors must be true or false'}, status=400)
+        filters['has_errors'] = has_errors in ('true', '1')
+
+    try:
+        result = get_search_backend().search(parse_query(request.GET.get('q', ''), config), filters, cursor, limit)
+    except Exception as e:
+        logger.error(f'Session search failed: {e}')
+        return JsonResponse({'status': 'error', 'message': 'Search backend unavailable'}, status=502)
+
+    # Sessions deleted since they were indexed drop out here
+    sessions = Session.objects.only(*LISTING_FIELDS).select_related('summary').in_bulk(result['ids'])
+    page = [sessions[session_id] for session_id in map(UUID, map(str, result['ids'])) if session_id in sessions]
+    return JsonResponse({
+        'results': [search_result(session) for session in page],
+        'next': encode_cursor(page[-1]) if result['has_more'] and page else None,
+        'facets': result['facets'],
+    })
+
+def search_result(session):
+    summary = getattr(session, 'summary', None)
+    return {
+        'id': str(session.id),
+        'start_time': to_millis(session.start_time),
+        'end_time': to_millis(session.end_time) if session.end_time else None,
+        'is_active': session.is_active,
+        'page_url': session.page_url,
+        'page_title': session.page_title,
+        'event_count': summary.event_count if summary else 0,
+        'error_count': summary.error_count if summary else 0,
+        'url': reverse('session_detail', args=[session.id]),
+    }
+
+def to_millis(value):
+    return int(value.timestamp() * 1000)
+
+def from_millis(value):
+    return datetime.fromtimestamp(value / 1000, tz=dt_timezone.utc)
+
+@admission_control
 @csrf_protect
 @require_http_methods(['POST'])
 def telemetry(request):
     try:
-        logger.info('Received telemetry request')
-        logger.debug(f'Request body: {request.body.decode()}')
-        
-        data = json.loads(request.body)
+        metrics.BYTES_RECEIVED.inc(len(request.body), transport='http')
+
+        # Opt-in compact encoding for pointer and scroll streams
+        if request.content_type == 'application/octet-stream':
+            return record_packed(request)
+
+        started = time.perf_counter()
+        data = load_telemetry_payload(request)
+        metrics.DECODE_SECONDS.observe(time.perf_counter() - started, transport='http')
         event_type = data.get('type')
-        logger.info(f'Processing telemetry event type: {event_type}')
-        logger.debug(f'Telemetry data: {json.dumps(data, indent=2)}')
+        # Per-request logging; formatting the payload is skipped unless debug logging is on
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'Processing telemetry event type: {event_type}')
+            logger.debug(f'Telemetry data: {json.dumps(data, indent=2)}')
         
         if event_type == 'session_start':
             # Create new session
-            session = Session.objects.create(
-                page_url=data.get('pageUrl', ''),
-                page_title=data.get('pageTitle', ''),
-                user_agent=data.get('userAgent', ''),
-                screen_width=data.get('screenResolution', {}).get('width', 0),
-                screen_height=data.get('screenResolution', {}).get('height', 0),
-                window_width=data.get('windowSize', {}).get('width', 0),
-                window_height=data.get('windowSize', {}).get('height', 0),
-                page_html=data.get('pageHtml', ''),
-                page_styles=data.get('pageStyles', '')
-            )
+            try:
+                session, missing = create_session(data)
+            except SnapshotError as e:
+                return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
             logger.info(f'Created new session: {session.id}')
-            return JsonResponse({'status': 'success', 'session_id': str(session.id)})
+            return JsonResponse({
+                'status': 'success',
+                'session_id': str(session.id),
+                'missing_snapshots': missing,
+                'sampling': client_policy()
+            })
             
+        elif event_type == 'batch':
+            return record_batch(data)
+
         # Handle all event types (click, mousemove, keypress, etc.)
-        elif event_type in ['click', 'mousemove', 'keypress', 'scroll', 'resize', 'input']:
+        elif event_type in EVENT_TYPES:
             session_id = data.get('session_id')
             if not session_id:
                 logger.error('No session ID provided in event data')
                 return JsonResponse({
                     'status': 'error',
-                    'message': 'No session ID provided',
-                    'received_data': data
+                    'message': 'No session ID provided'
                 }, status=400)
                 
             try:
@@ -122,34 +475,33 @@ def telemetry(request):
                 logger.error(f'Session not found: {session_id}')
                 return JsonResponse({
                     'status': 'error',
-                    'message': f'Session not found: {session_id}',
-                    'received_data': data
+                    'message': f'Session not found: {session_id}'
                 }, status=404)
                 
-            event = Event.objects.create(
-                session=session,
-                type=event_type,
-                timestamp=timezone.now(),
-                data=data.get('data', {})
-            )
-            logger.info(f'Created new event: {event.type} for session {session_id}')
+            event = build_event(session, data)
+            sampler = get_sampler(session.id)
+            if sampler is None or sampler.reduce([event]):
+                store_events([event])
+                publish_events_sync(session.id, [event])
+            logger.debug(f'Created new event: {event.type} for session {session_id}')
             return JsonResponse({'status': 'success'})
             
         else:
             logger.warning(f'Unknown event type: {event_type}')
             return JsonResponse({
                 'status': 'error',
-                'message': f'Unknown event type: {event_type}',
-                'received_data': data
+                'message': f'Unknown event type: {event_type}'
             }, status=400)
             
     except json.JSONDecodeError as e:
         logger.error(f'Invalid JSON received: {str(e)}')
         return JsonResponse({
             'status': 'error',
-            'message': f'Invalid JSON: {str(e)}',
-            'received_body': request.body.decode()
+            'message': f'Invalid JSON: {str(e)}'
         }, status=400)
+    except RequestDataTooBig:
+        # Answered with a 413 by admission_control
+        raise
     except Exception as e:
         logger.error(f'Error processing telemetry: {str(e)}')
         return JsonResponse({
@@ -157,5 +509,95 @@ def telemetry(request):
             'message': str(e)
         }, status=500)
 
+def load_telemetry_payload(request):
+    # sendBeacon can't set headers, so beacons post a form carrying the CSRF token and a JSON payload
+    if request.content_type in ('multipart/form-data', 'application/x-www-form-urlencoded'):
+        return json.loads(request.POST.get('payload', ''))
+    return json.loads(request.body)
+
+def record_batch(data):
+    session_id = data.get('session_id')
+    if not session_id:
+        return JsonResponse({
+            'status': 'error',
+            'message': 'No session ID provided'
+        }, status=400)
+
+    try:
+        events = parse_batch(data)
+    except BatchError as e:
+        logger.warning(f'Rejected telemetry batch for session {session_id}: {e}')
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+
+    return persist_events(session_id, events)
+
+def record_packed(request):
+    session_id = request.GET.get('session_id')
+    if not session_id:
+        return JsonResponse({
+            'status': 'error',
+            'message': 'No session ID provided'
+        }, status=400)
+
+    try:
+        with metrics.DECODE_SECONDS.time(transport='http_packed'):
+            events = parse_packed(request.body)
+    except DecodeError as e:
+        logger.warning(f'Rejected packed frame for session {session_id}: {e}')
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+
+    if not events:
+        return JsonResponse({'status': 'success', 'accepted': 0})
+    return persist_events(session_id, events)
+
+def persist_events(session_id, events):
+    # One session lookup and one transaction for the whole batch
+    try:
+        session = Session.objects.only('id').get(id=session_id)
+    except (Session.DoesNotExist, ValueError):
+        logger.error(f'Session not found: {session_id}')
+        return JsonResponse({
+            'status': 'error',
+            'message': f'Session not found: {session_id}'
+        }, status=404)
+
+    recorded = [build_event(session, event, timestamp) for _, event, timestamp in events]
+    sampler = get_sampler(session.id)
+    if sampler is not None:
+        recorded = sampler.reduce(recorded)
+    if recorded:
+        store_events(recorded)
+        publish_events_sync(session.id, recorded)
+
+    logger.debug(f'Recorded batch of {len(events)} events for session {session_id} ({len(recorded)} stored)')
+    return JsonResponse({
+        'status': 'success',
+        'accepted': len(events),
+        'stored': len(recorded),
+        'seq': max(seq for seq, _, _ in events)
+    })
+
+@admission_control
+@csrf_protect
+@require_http_methods(['POST'])
+def snapshot_upload(request):
+    """Accept the body of a snapshot that session_start announced by hash."""
+    try:
+        data = json.loads(request.body)
+        blob = upload_snapshot(data.get('hash'), data.get('content'))
+    except json.JSONDecodeError as e:
+        return JsonResponse({'status': 'error', 'message': f'Invalid JSON: {str(e)}'}, status=400)
+    except SnapshotError as e:
+        logger.warning(f'Rejected snapshot upload: {e}')
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    return JsonResponse({'status': 'success', 'hash': blob.hash})
+
+def metrics_view(request):
+    """Ingest metrics in the Prometheus text format (see core/metrics.py)."""
+    if not metrics.get_metrics_settings()['ENABLED']:
+        raise Http404('Metrics are disabled')
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@ensure_csrf_cookie
 def test_page(request):
     return render(request, 'core/test.html')
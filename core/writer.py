@@ -0,0 +1,122 @@
+"""
+Database writer for the WebSocket consumers.
+
+``database_sync_to_async`` runs every call on one shared thread per process,
+so each session's writes would queue behind every other session's. Consumers
+hand their database work to ``run_in_writer`` instead. Jobs go onto a
+bounded queue of QUEUE_SIZE, and submitters wait once it is full. CONCURRENCY
+workers run the jobs on a thread pool, one database connection per thread.
+
+A consumer awaits each job before submitting its next, so one connection's
+jobs still run in order. On SQLite the pool has a single thread, since
+SQLite serializes writes. It is still not the only writer there (see
+core/database.py). Jobs are kept short; slow work such as finalizing a
+session runs elsewhere (core/summaries.py).
+"""
+import asyncio
+import logging
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+WRITER_DEFAULTS = {
+    'ENABLED': True,  # False runs jobs through database_sync_to_async as before
+    'CONCURRENCY': 4,  # Threads, and so database connections, running jobs
+    'QUEUE_SIZE': 1000,  # Jobs waiting per process before submitters wait too
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+# One queue and set of workers per event loop; asyncio queues can't be shared between loops
+_writers = weakref.WeakKeyDictionary()
+
+
+def get_writer_settings():
+    return {**WRITER_DEFAULTS, **getattr(settings, 'TELEMETRY_DB_WRITER', {})}
+
+
+def _get_executor(concurrency):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='db-writer')
+        return _executor
+
+
+def _run_job(func, args):
+    # As database_sync_to_async does: drop connections that errored or outlived CONN_MAX_AGE
+    close_old_connections()
+    try:
+        return True, func(*args)
+    except Exception as e:
+        # Returned rather than raised through the worker: a traceback holding the worker's
+        # frame lets anything that clears traceback frames finalize the worker coroutine
+        return False, e
+    finally:
+        close_old_connections()
+
+
+class DatabaseWriter:
+    def __init__(self, loop, concurrency, queue_size):
+        self.loop = loop
+        self.executor = _get_executor(concurrency)
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.workers = [loop.create_task(self._work()) for _ in range(concurrency)]
+
+    async def run(self, func, *args, kind='write'):
+        future = self.loop.create_future()
+        metrics.WRITER_QUEUE_DEPTH.inc()
+        try:
+            await self.queue.put((func, args, future, time.perf_counter(), kind))
+        except BaseException:
+            metrics.WRITER_QUEUE_DEPTH.dec()
+            raise
+        return await future
+
+    async def _work(self):
+        while True:
+            func, args, future, enqueued, kind = await self.queue.get()
+            metrics.WRITER_QUEUE_DEPTH.dec()
+            metrics.WRITER_QUEUE_WAIT.observe(time.perf_counter() - enqueued, kind=kind)
+            if future.cancelled():
+                # The connection went away while the job was queued
+                continue
+            ok, result = await self.loop.run_in_executor(self.executor, _run_job, func, args)
+            if future.cancelled():
+                continue
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+
+def queue_load():
+    """How full this process's fullest writer queue is, from 0 to 1; see core/admission.py."""
+    return max((writer.queue.qsize() / writer.queue.maxsize
+                for writer in list(_writers.values()) if writer.queue.maxsize), default=0.0)
+
+
+def get_writer():
+    loop = asyncio.get_running_loop()
+    writer = _writers.get(loop)
+    if writer is None:
+        config = get_writer_settings()
+        concurrency = 1 if connection.vendor == 'sqlite' else config['CONCURRENCY']
+        writer = _writers[loop] = DatabaseWriter(loop, concurrency, config['QUEUE_SIZE'])
+    return writer
+
+
+async def run_in_writer(func, *args, kind='write'):
+    """Run ``func(*args)`` on the database writer pool and return its result."""
+    if not get_writer_settings()['ENABLED']:
+        return await database_sync_to_async(func)(*args)
+    return await get_writer().run(func, *args, kind=kind)